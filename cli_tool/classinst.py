@@ -4,14 +4,13 @@ import os
 import sys
 import pickle
 import glob
-from statistics import mode
 import shutil
 import warnings
 import argparse
 import zlib
 
-from scipy.io import arff
-import pandas as pd
+import soundfile as sf
+
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.abspath(os.path.join(script_dir, '..'))
@@ -23,6 +22,14 @@ from dataset_gen.splitaudio import split_audiofile # pyright: ignore
 from dataset_gen.normalizedb import normalize_audio #pyright:ignore 
 from dataset_gen.extractFreqARFF import create_arff # pyright: ignore 
 from dataset_gen.cleandata import clean_file # pyright : ignore
+from dataset_gen.arffio import read_arff # pyright: ignore
+from dataset_gen.fusedextract import extract_audiofile, clean_rows, clip_starts # pyright: ignore
+# Imported through cli_tool like the dataset_gen modules, so they still resolve when the makefile copies this file
+# to the repo root on its own
+from cli_tool import predictcache # pyright: ignore
+from cli_tool import stagetimer # pyright: ignore
+from cli_tool import modelregistry # pyright: ignore
+from cli_tool import voting # pyright: ignore
 
 # Global constants, might add flag parsing later for this
 DEFAULT_MODEL_LOC = './config/instrumentclassifier'
@@ -33,42 +40,258 @@ SPLIT_DIR = TEMP_DIR + 'split/'
 NORMALIZE_DIR = TEMP_DIR + 'normalized/'
 ARFF_DIR = TEMP_DIR + 'arff/'
 NORMALIZE_DBFS = -20
+# Clips quieter than this many dBFS are skipped before analysis, None keeps every clip
+SILENCE_DBFS = None
 NUM_HARMONICS = 32
 
 # Put the model binary here
 
-def predict(model, arff_filename):
-    data, meta = arff.loadarff(arff_filename)
-    df = pd.DataFrame(data)
+# The number of harmonics the model was trained on. Models record how many columns they were fit with, and the
+# strongest harmonics come first in each row, so the extracted rows can just be cut down to match
+def model_harmonics(model, default=NUM_HARMONICS):
+    return getattr(model, 'n_features_in_', 2 * default) // 2
+
+def predict(model, arff_filename, timer=None, vote='majority'):
+    attrib, _, _ = stagetimer.run_stage(timer, 'load', read_arff, arff_filename, number_harmonics=model_harmonics(model))
+
+    return predict_rows(model, attrib, timer, vote)
+
+def exit_no_clips():
+    print('Error: no audible clips to classify. The audio is silent, or every clip is quieter than --gatedb')
+    sys.exit(1)
+
+# The class probabilities of every clip from one predict_proba call over all of them
+def predict_probabilities(model, attrib, timer=None):
+    if len(attrib) == 0:
+        exit_no_clips()
+
+    return stagetimer.run_stage(timer, 'predict', voting.clip_probabilities, model, attrib[:, :2 * model_harmonics(model)])
+
+# vote is one of voting.VOTE_METHODS, majority gives the mode of the clip predictions
+def predict_rows(model, attrib, timer=None, vote='majority'):
+    classes, probs = predict_probabilities(model, attrib, timer)
+
+    return voting.aggregate(classes, probs, vote)
+
+def print_result(result):
+    print('Instrument is:', result['instrument'])
+
+    total = sum(result['votes'].values())
+    for inst, count in result['votes'].items():
+        print('  ' + inst.ljust(12), count, 'of', total, 'clips')
+
+    if 'scores' in result:
+        print(result['method'], 'scores:')
+        for inst, score in result['scores'].items():
+            print('  ' + inst.ljust(12), score)
+
+    if 'timeline' in result:
+        print('Timeline:')
+        voting.print_timeline(result['timeline'])
+
+# Returns the model and the bytes it was loaded from, which are hashed for the prediction cache
+def load_model(model_filename=None):
+    if model_filename:
+        with open(model_filename, 'rb') as f:
+            model_bytes = f.read()
+        return pickle.loads(model_bytes), model_bytes
+
+    if not MODEL:
+        print('Error: no model is embedded in this script, pass one with -m <model.pkl>')
+        sys.exit(1)
+
+    # The embedded model is the compressed byte string gen_model.py writes
+    model_bytes = zlib.decompress(MODEL)
+    return pickle.loads(model_bytes), model_bytes
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             extract_features                                                             *
+*                                                                                                *
+* Parameters:       str audio_filename   - The audio file to analyze                             *
+*                   str tempfolder       - Where the intermediate files go                       *
+*                   float splitlen       - The length of each clip                               *
+*                   int normalizedb      - The level each clip is normalized to                  *
+*                   int number_harmonics - Harmonics kept from the FFT                           *
+*                   dict timer           - From stagetimer.new_timer to time each stage          *
+*                   float gatedb         - Clips quieter than this many dBFS are skipped, None   *
+*                                          keeps them all                                        *
+*                                                                                                *
+* Purpose:          Converts, splits, normalizes and analyzes the audio file the same way the    *
+*                   dataset was built. Wav files are split as they are, only other formats go    *
+*                   through ffmpeg                                                               *
+*                                                                                                *
+* Returns:          str - The cleaned arff file of the clips                                     *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def extract_features(audio_filename, tempfolder, splitlen, normalizedb, number_harmonics, timer=None,
+                     gatedb=SILENCE_DBFS):
+    wav_dir = tempfolder + 'wav/'
+    split_dir = tempfolder + 'split/'
+    normalize_dir = tempfolder + 'normalized/'
+    arff_dir = tempfolder + 'arff/'
+
+    os.makedirs(wav_dir, exist_ok=True)
+    if audio_filename.lower().endswith('.wav'):
+        wav_filename = audio_filename
+    else:
+        wav_filename = stagetimer.run_stage(timer, 'convert', convert_to_wav, audio_filename, wav_dir)
+
+    os.makedirs(split_dir, exist_ok=True)
+
+    # Silent slices would only be dropped by clean_file after being normalized and analyzed
+    stagetimer.run_stage(timer, 'split', split_audiofile, wav_filename, splitlen, split_dir, gatedb)
     
-    df.columns = meta.names()
+    filenames = glob.glob(split_dir + '/*.wav')
+    if not filenames:
+        exit_no_clips()
+    os.makedirs(normalize_dir, exist_ok=True)
+    stagetimer.run_stage(timer, 'normalize', lambda: [normalize_audio(filename, normalize_dir, normalizedb)
+                                                      for filename in filenames])
 
-    for column in df.columns:
-        if df[column].dtype == object:
-            df[column] = df[column].str.decode('utf-8')
+    # Analyze the audio file
+    os.makedirs(arff_dir, exist_ok=True) 
 
-    # print('Data head')
-    # print('=================================')
-    # print(df.head(10))
-    # print() 
+    with warnings.catch_warnings(action="ignore"):
+        stagetimer.run_stage(timer, 'extract', create_arff, normalize_dir, number_harmonics, 'dataset', arff_dir)
+    
+    # Clean up the arff file
+    stagetimer.run_stage(timer, 'clean', clean_file, arff_dir + 'datasetRaw.arff', arff_dir + 'datasetRaw.arff')
+
+    return arff_dir + 'datasetRaw.arff'
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             extract_rows                                                                 *
+*                                                                                                *
+* Parameters:       float hop - Seconds between the starts of neighbouring clips                 *
+*                   The rest are the same as extract_features                                    *
+*                                                                                                *
+* Purpose:          extract_features without writing clips to disk. The wav is streamed in       *
+*                   blocks and the clips of each block, overlapping ones as strided views, are   *
+*                   analyzed in memory, so an hour long recording is one pass in bounded memory  *
+*                   and overlap only adds FFTs. Unlike the arff the rows keep their clip order   *
+*                                                                                                *
+* Returns:          np.array, np.array - The cleaned feature rows of the clips, in time order,   *
+*                                        and the start of each clip in seconds                   *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def extract_rows(audio_filename, tempfolder, splitlen, hop, normalizedb, number_harmonics, timer=None,
+                 gatedb=SILENCE_DBFS):
+    if audio_filename.lower().endswith('.wav'):
+        wav_filename = audio_filename
+    else:
+        os.makedirs(tempfolder + 'wav/', exist_ok=True)
+        wav_filename = stagetimer.run_stage(timer, 'convert', convert_to_wav, audio_filename, tempfolder + 'wav/')
 
-    attrib = df.iloc[:, :-1].values
+    rows, clip_numbers, _ = stagetimer.run_stage(timer, 'extract', extract_audiofile, wav_filename, splitlen,
+                                                 number_harmonics, normalizedb, gatedb, hop=hop)
+    rows, clip_numbers = clean_rows(rows, clip_numbers)
 
-    predicted_insts = model.predict(attrib)
-    print('Instrument is:', mode(predicted_insts))
-    # for inst in predicted_insts:
-    #     print(inst)
+    return rows, clip_starts(clip_numbers, splitlen, hop, sf.info(wav_filename).samplerate)
 
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             classify_timeline                                                            *
+*                                                                                                *
+* Parameters:       model                - The loaded sklearn model                              *
+*                   str audio_filename   - The audio file to analyze                             *
+*                   args                 - The parsed command line arguments                     *
+*                   int number_harmonics - Harmonics to extract                                  *
+*                   dict timer           - From stagetimer.new_timer to time each stage          *
+*                                                                                                *
+* Purpose:          For recordings where the instrument changes. Predicts every clip in one      *
+*                   call, votes over the whole recording as usual, then smooths the clips in     *
+*                   time order and adds the time range each instrument played                    *
+*                                                                                                *
+* Returns:          dict - The predict_rows result with a timeline list                          *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def classify_timeline(model, audio_filename, args, number_harmonics, timer=None):
+    rows, starts = extract_rows(audio_filename, args.tempfolder, args.splitlen, args.hop, args.normalizedb,
+                                number_harmonics, timer, args.gatedb)
+    classes, probs = predict_probabilities(model, rows, timer)
+
+    result = voting.aggregate(classes, probs, args.vote)
+    labels = voting.smooth(probs, args.smooth, args.smoothwidth, args.switchprob)
+    result['timeline'] = voting.timeline(classes, labels, starts, args.splitlen)
+
+    return result
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             classify                                                                     *
+*                                                                                                *
+* Parameters:       str audio_filename - The audio file to analyze                               *
+*                   model              - The loaded sklearn model                                *
+*                   str model_hash     - The sha256 of the model file, part of the cache key     *
+*                   args               - The parsed command line arguments                       *
+*                   dict timer         - From stagetimer.new_timer to time each stage            *
+*                                                                                                *
+* Purpose:          Looks the file up in the prediction cache and only runs the pipeline on a    *
+*                   miss. The cache key covers the audio contents, the model and every setting   *
+*                   that changes the features, so a hit is always the result a full run would    *
+*                   give. With --hop the clips overlap and are analyzed in memory                *
+*                                                                                                *
+* Returns:          dict - The predicted instrument, the vote of every clip and with --timeline  *
+*                          the time range of each instrument                                     *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def classify(audio_filename, model, model_hash, args, timer=None):
+    # Extract at least as many harmonics as the model needs, predict only reads the ones it was trained on
+    number_harmonics = max(args.numharmonics, model_harmonics(model, args.numharmonics))
+
+    key = None
+    if not args.nocache:
+        params = {'splitlen': args.splitlen, 'normalizedb': args.normalizedb, 'numharmonics': number_harmonics,
+                  'silencedb': args.gatedb}
+        if args.hop is not None:
+            params['hop'] = args.hop
+        # Only added when set, so entries cached before these options existed still hit
+        if args.vote != 'majority':
+            params['vote'] = args.vote
+        if args.timeline:
+            params['timeline'] = {'smooth': args.smooth, 'width': args.smoothwidth, 'switchprob': args.switchprob}
+        key = predictcache.make_key(predictcache.hash_file(audio_filename), model_hash, params)
+
+        result = stagetimer.run_stage(timer, 'cache', predictcache.lookup, args.cachedir, key)
+        if result is not None:
+            print('Using cached prediction for', audio_filename)
+            return result
+
+    if args.timeline:
+        result = classify_timeline(model, audio_filename, args, number_harmonics, timer)
+    elif args.hop is not None:
+        rows, _ = extract_rows(audio_filename, args.tempfolder, args.splitlen, args.hop, args.normalizedb, number_harmonics, timer,
+                               args.gatedb)
+        result = predict_rows(model, rows, timer, args.vote)
+    else:
+        arff_filename = extract_features(audio_filename, args.tempfolder, args.splitlen, args.normalizedb, number_harmonics, timer,
+                                         args.gatedb)
+        result = predict(model, arff_filename, timer, args.vote)
+    result['audio'] = audio_filename
+
+    if key is not None:
+        predictcache.store(args.cachedir, key, result, args.cachesize * 1024 * 1024)
+
+    # Cleanup as long as the flag for keep has not been set
+    if not args.keep and os.path.exists(args.tempfolder):
+        shutil.rmtree(args.tempfolder)
+
+    return result
 
 __USAGE__ = 'python3 classinst.py <audiofile>'\
         'python3 classinst.py -m <model.pkl> <audiofile>'
 
 if __name__ == "__main__":
-    argv = sys.argv
-    argc = len(argv)
-    # Case in which a model is supplied
-    
-   
     end_help = '''
         Put the audio file you would like to analyze as the last argument. It should be an mp3 or mp4
     '''
@@ -77,57 +300,65 @@ if __name__ == "__main__":
                                      description='A program that takes in an audio file and determines what instrument is playing in it', epilog=end_help)
     
     parser.add_argument('-t', '--tempfolder', default='audiotmp/', help='The folder files will be kept in until the program finishes')
-    parser.add_argument('-s', '--splitlen', type=float, default=0.1, help='The length of each segment of the audio file')
+    parser.add_argument('-s', '--splitlen', type=float, default=None, help='The length of each segment of the audio file. Defaults to the split length a registry model was trained with, or 0.1')
+    parser.add_argument('--hop', type=float, default=None, help='Start a clip every this many seconds. Less than the split length overlaps the clips, giving more votes from short audio')
     parser.add_argument('-d', '--normalizedb', type=int, default=-20, help='The dbfs level to normalize the chopped up samples to. Default is -20') 
-    parser.add_argument('-n', '--numharmonics', type=int, default=32, help='The number of harmonics kept from the FFT, should be same as model provided')
+    parser.add_argument('--gatedb', type=float, default=SILENCE_DBFS, help='Skip clips quieter than this dBFS level instead of classifying them. Off by default, use the --gatedb the dataset was split with')
+    parser.add_argument('-n', '--numharmonics', type=int, default=32, help='The number of harmonics kept from the FFT. Raised to match the model if it was trained on more')
     parser.add_argument('-m', '--model', help='The model file used to predict the instrument')
+    parser.add_argument('--vote', choices=voting.VOTE_METHODS, default='majority', help='How the clips decide the instrument: majority counts each clip\'s prediction, weighted averages the class probabilities, logprob averages their logs')
+    parser.add_argument('--timeline', action='store_true', default=False, help='Also print the time ranges each instrument plays, for recordings where the instrument changes')
+    parser.add_argument('--smooth', choices=voting.SMOOTH_METHODS, default='hmm', help='How --timeline smooths the clips: a running median of the probabilities, or the most likely sequence when switching instrument is rare')
+    parser.add_argument('--smoothwidth', type=int, default=9, help='Clips in the --smooth median window')
+    parser.add_argument('--switchprob', type=float, default=0.01, help='--smooth hmm only, the chance of the instrument changing between neighbouring clips')
+    parser.add_argument('--registry', help='Use a model from this modelregistry.py folder instead of -m')
+    parser.add_argument('--modelname', help='The registry model to use')
+    parser.add_argument('--instruments', help='Comma separated instrument set, uses the registry model trained on exactly these instruments')
     parser.add_argument('-k', '--keep', action='store_true', default=False, help='Tells the program if it should delete temp files. Setting this flag will keep temp files')
+    parser.add_argument('--nocache', action='store_true', default=False, help='Always run the full pipeline, neither reading nor writing the prediction cache')
+    parser.add_argument('--cachedir', default=predictcache.DEFAULT_CACHE_DIR, help='Where cached predictions are kept')
+    parser.add_argument('--cachesize', type=float, default=predictcache.DEFAULT_MAX_BYTES / (1024 * 1024), help='Size in MB the prediction cache is kept under, least recently used entries are removed first')
+    
+    parser.add_argument('--profile', action='store_true', default=False, help='Print how long each stage took')
+    parser.add_argument('--profilejson', help='Also write the stage times to this json file')
+    parser.add_argument('--cprofile', choices=stagetimer.STAGES, help='Run this stage under cProfile and print its slowest functions')
+    parser.add_argument('--cprofileout', help='Save the cProfile stats of --cprofile to this file')
     
     parsed_args, unrecognized_args = parser.parse_known_args()
 
-    if parsed_args.tempfolder:
-        WAV_DIR = parsed_args.tempfolder + 'wav/'
-        SPLIT_DIR = parsed_args.tempfolder + 'split/'
-        NORMALIZE_DIR = parsed_args.tempfolder + 'normalized/'
-        ARFF_DIR = parsed_args.tempfolder + 'arff/'
-
-    audio_filename = unrecognized_args[0] 
-    if audio_filename == None:
+    if not unrecognized_args:
         parser.print_help()
         sys.exit(1)
+    audio_filename = unrecognized_args[0] 
 
-    os.makedirs(WAV_DIR, exist_ok=True)
-    wav_filename = convert_to_wav(audio_filename, WAV_DIR) 
-
-    os.makedirs(SPLIT_DIR, exist_ok=True)
-
-    split_audiofile(wav_filename, SPLIT_LEN, SPLIT_DIR)
-    
-    filenames = glob.glob(SPLIT_DIR + '/*.wav')
-    os.makedirs(NORMALIZE_DIR, exist_ok=True)
-    for filename in filenames:
-        normalize_audio(filename, NORMALIZE_DIR, NORMALIZE_DBFS)
-
-    # Analyze the audio file
-    os.makedirs(ARFF_DIR, exist_ok=True) 
+    timer = None
+    if parsed_args.profile or parsed_args.profilejson or parsed_args.cprofile:
+        timer = stagetimer.new_timer(parsed_args.cprofile, parsed_args.cprofileout)
 
-    with warnings.catch_warnings(action="ignore"):
-        create_arff(NORMALIZE_DIR, NUM_HARMONICS, 'dataset', ARFF_DIR) 
-    
-    # Clean up the arff file
-    clean_file(ARFF_DIR + 'datasetRaw.arff', ARFF_DIR + 'datasetRaw.arff')
-    
-    # load the model
-    loadad_model = ''
-    if parsed_args.model:
-        with open(parsed_args.model, 'rb') as f:
-            MODEL = pickle.load(f)
+    if parsed_args.registry:
+        try:
+            registry = modelregistry.open_registry(parsed_args.registry)
+            model_name = parsed_args.modelname
+            if model_name is None:
+                instruments = parsed_args.instruments.split(',') if parsed_args.instruments else None
+                model_name = modelregistry.find_model(parsed_args.registry, instruments)
+            model, meta = stagetimer.run_stage(timer, 'model', modelregistry.get_model, registry, model_name)
+        except modelregistry.RegistryError as e:
+            print('Error:', e)
+            sys.exit(1)
+        model_hash = meta['sha256']
+        if parsed_args.splitlen is None:
+            parsed_args.splitlen = meta['splitlen']
     else:
-        loadad_model = pickle.loads(MODEL)
+        model, model_bytes = stagetimer.run_stage(timer, 'model', load_model, parsed_args.model)
+        model_hash = predictcache.hash_bytes(model_bytes)
 
-    predict(MODEL, ARFF_DIR + 'datasetRaw.arff')
+    if parsed_args.splitlen is None:
+        parsed_args.splitlen = SPLIT_LEN
 
-    # Cleanup as long as the flag for keep has not been set
-    if not parsed_args.keep:
-        shutil.rmtree(parsed_args.tempfolder)
-        
+    print_result(classify(audio_filename, model, model_hash, parsed_args, timer))
+
+    if parsed_args.profile:
+        stagetimer.print_timer(timer)
+    if parsed_args.profilejson:
+        stagetimer.write_timer(timer, audio_filename, parsed_args.profilejson)
@@ -0,0 +1,227 @@
+'''
+**************************************************************************************************
+* Filename:    instclassifier.py                                                                 *
+*                                                                                                *
+* Description: Classifies audio that is already decoded into a numpy array, for programs that    *
+*              hold the audio in memory and would otherwise have to write it out for             *
+*              classinst.py. The model is loaded once, then each call splits, gates, normalizes  *
+*              and runs the FFT on the samples in memory with the same code fusedextract.py      *
+*              uses, so the clips give the rows the dataset_gen scripts would write for them.    *
+*                                                                                                *
+*              One InstrumentClassifier can be shared by many threads. Each call only reads the  *
+*              model, and the numpy and scipy FFT work happens outside the GIL. The pyfftw       *
+*              backend reuses its plan buffers, so with it the FFT is done one call at a time.   *
+*              A classifier made on a modelregistry.py model picks up a replaced model on a      *
+*              later call, while calls already running finish with the model they started with.  *
+*                                                                                                *
+* Usage:       from instclassifier import InstrumentClassifier                                   *
+*              classifier = InstrumentClassifier('0.1datasetRawModel.pkl')                       *
+*              result = classifier.classify_array(samples, 44100)                                *
+*              results = classifier.classify_batch([samples1, samples2], 44100)                  *
+*              result = classifier.classify_timeline(samples, 44100)                             *
+*              classifier = InstrumentClassifier(registry='registry/', model_name='<name>')      *
+*                                                                                                *
+*              python3 instclassifier.py <model.pkl> <file.wav> [file.wav ...]                   *
+*                   Reads the wavs with soundfile and classifies them as one batch               *
+*                                                                                                *
+**************************************************************************************************
+'''
+import os
+import sys
+import threading
+import contextlib
+
+import numpy as np
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+# Lets the cli_tool and dataset_gen modules be imported when this file is imported from another folder
+sys.path.append(os.path.abspath(os.path.join(script_dir, '..')))
+from cli_tool.classinst import load_model, model_harmonics, SPLIT_LEN, NORMALIZE_DBFS, SILENCE_DBFS, NUM_HARMONICS # pyright: ignore
+from dataset_gen.fusedextract import sample_rows, clip_starts # pyright: ignore
+from dataset_gen import fftbackend # pyright: ignore
+from cli_tool import modelregistry # pyright: ignore
+from cli_tool import voting # pyright: ignore
+
+# pyfftw plans share their input and output buffers between calls, the other backends have no shared state
+PYFFTW_LOCK = threading.Lock()
+
+class InstrumentClassifier:
+    '''
+    * ****************************************************************************************** *
+    *                                                                                            *
+    * Name:             __init__                                                                 *
+    *                                                                                            *
+    * Parameters:       str model_filename   - The pickled model. None uses the one embedded in  *
+    *                                          classinst.py                                      *
+    *                   float splitlen       - The length of each clip in seconds. None uses the *
+    *                                          registry model's split length, or SPLIT_LEN       *
+    *                   int normalizedb      - The level each clip is normalized to              *
+    *                   float silencedb      - Clips quieter than this are skipped, None keeps   *
+    *                                          them all                                          *
+    *                   int number_harmonics - Harmonics kept from the FFT, raised to match the  *
+    *                                          model if it was trained on more                   *
+    *                   str registry         - A modelregistry.py folder to take the model from  *
+    *                                          instead of model_filename                         *
+    *                   str model_name       - The registry model to use                         *
+    *                   float hop            - Seconds between clip starts. Shorter than the     *
+    *                                          split length the clips overlap, giving more votes *
+    *                                          from short audio. None puts them back to back     *
+    *                   str vote             - One of voting.VOTE_METHODS, how the clips decide  *
+    *                                                                                            *
+    * ****************************************************************************************** *
+    '''
+    def __init__(self, model_filename=None, splitlen=None, normalizedb=NORMALIZE_DBFS, silencedb=SILENCE_DBFS,
+                 number_harmonics=NUM_HARMONICS, registry=None, model_name=None, hop=None,
+                 vote='majority'):
+        self.splitlen = splitlen
+        self.vote_method = vote
+        self.hop = hop
+        self.normalizedb = normalizedb
+        self.silencedb = silencedb
+        self.number_harmonics = number_harmonics
+
+        self.registry = None
+        self.model = None
+        if registry is not None:
+            self.registry = modelregistry.open_registry(registry)
+            self.model_name = model_name
+            self.current_model() # Loads it now so the first request does not pay for it
+        else:
+            self.model, _ = load_model(model_filename)
+
+        # Picked here so threads never race to pick it on their first FFT
+        self.fft_lock = PYFFTW_LOCK if fftbackend.current_backend() == 'pyfftw' else contextlib.nullcontext()
+
+    # The model and split length to use for one call. Taken once per call so a reload part way through
+    # cannot mix two models
+    def current_model(self):
+        if self.registry is None:
+            return self.model, self.splitlen if self.splitlen is not None else SPLIT_LEN
+
+        model, meta = modelregistry.get_model(self.registry, self.model_name)
+        if self.splitlen is not None:
+            return model, self.splitlen
+        return model, meta['splitlen'] if meta['splitlen'] is not None else SPLIT_LEN
+
+    '''
+    * ****************************************************************************************** *
+    *                                                                                            *
+    * Name:             features                                                                 *
+    *                                                                                            *
+    * Parameters:       np.array samples - The audio, one sample per row and one column per      *
+    *                                      channel, or 1d for mono. Floats in [-1, 1] or 16 bit  *
+    *                                      integers                                              *
+    *                   int samplerate   - The sample rate of samples                            *
+    *                   model            - The model the rows are for                            *
+    *                   float splitlen   - The length of each clip in seconds                    *
+    *                                                                                            *
+    * Purpose:          Makes the feature rows classinst.py would read back from its cleaned     *
+    *                   arff file with fusedextract.sample_rows. Clips below silencedb are       *
+    *                   skipped and the rest are normalized and analyzed                         *
+    *                                                                                            *
+    * Returns:          np.array, np.array - One row per clip, only the harmonics the model was  *
+    *                                        trained on, and the start of each clip in seconds   *
+    *                                                                                            *
+    * ****************************************************************************************** *
+    '''
+    def features(self, samples, samplerate, model, splitlen):
+        harmonics = model_harmonics(model, self.number_harmonics)
+        with self.fft_lock:
+            rows, clip_numbers = sample_rows(samples, samplerate, splitlen, max(self.number_harmonics, harmonics),
+                                             self.normalizedb, self.silencedb, self.hop)
+
+        return rows[:, :2 * harmonics], clip_starts(clip_numbers, splitlen, self.hop, samplerate)
+
+    # The same result dict classinst.predict gives, instrument is None when no clip was loud enough
+    def vote(self, classes, probs):
+        if len(probs) == 0:
+            return {'instrument': None, 'votes': {}, 'method': self.vote_method, 'clips': 0}
+
+        result = voting.aggregate(classes, probs, self.vote_method)
+        result['clips'] = len(probs)
+        return result
+
+    def classify_array(self, samples, samplerate):
+        model, splitlen = self.current_model()
+        rows, _ = self.features(samples, samplerate, model, splitlen)
+        if len(rows) == 0:
+            return self.vote(None, rows)
+
+        return self.vote(*voting.clip_probabilities(model, rows))
+
+    '''
+    * ****************************************************************************************** *
+    *                                                                                            *
+    * Name:             classify_timeline                                                        *
+    *                                                                                            *
+    * Parameters:       np.array samples   - The audio, shaped as for classify_array             *
+    *                   int samplerate     - The sample rate of samples                          *
+    *                   str smooth         - One of voting.SMOOTH_METHODS                        *
+    *                   int width          - Clips in the median window                          *
+    *                   float switch_prob  - hmm only, the chance of the instrument changing     *
+    *                                        between neighbouring clips                          *
+    *                                                                                            *
+    * Returns:          dict - The classify_array result with the time range of each instrument  *
+    *                          under timeline                                                    *
+    *                                                                                            *
+    * ****************************************************************************************** *
+    '''
+    def classify_timeline(self, samples, samplerate, smooth='hmm', width=9, switch_prob=0.01):
+        model, splitlen = self.current_model()
+        rows, starts = self.features(samples, samplerate, model, splitlen)
+        if len(rows) == 0:
+            result = self.vote(None, rows)
+            result['timeline'] = []
+            return result
+
+        classes, probs = voting.clip_probabilities(model, rows)
+        result = self.vote(classes, probs)
+        result['timeline'] = voting.timeline(classes, voting.smooth(probs, smooth, width, switch_prob), starts,
+                                             splitlen)
+        return result
+
+    '''
+    * ****************************************************************************************** *
+    *                                                                                            *
+    * Name:             classify_batch                                                           *
+    *                                                                                            *
+    * Parameters:       np.array[] arrays    - The recordings, each shaped as for classify_array *
+    *                   samplerate           - One rate for every recording, or a list of them   *
+    *                                                                                            *
+    * Purpose:          Extracts the clips of every recording, then runs the model once over     *
+    *                   all of them, which costs far less than one predict call per recording.   *
+    *                   Raises ValueError when there is not one samplerate per recording         *
+    *                                                                                            *
+    * Returns:          dict[] - The classify_array result of each recording, in order           *
+    *                                                                                            *
+    * ****************************************************************************************** *
+    '''
+    def classify_batch(self, arrays, samplerate):
+        samplerates = samplerate if isinstance(samplerate, (list, tuple)) else [samplerate] * len(arrays)
+        if len(samplerates) != len(arrays):
+            raise ValueError('classify_batch got %d recordings but %d samplerates' % (len(arrays), len(samplerates)))
+
+        model, splitlen = self.current_model()
+        rows = [self.features(samples, rate, model, splitlen)[0] for samples, rate in zip(arrays, samplerates)]
+        counts = [len(recording_rows) for recording_rows in rows]
+        if sum(counts) == 0:
+            return [self.vote(None, recording_rows) for recording_rows in rows]
+
+        classes, probs = voting.clip_probabilities(model, np.concatenate(rows))
+        bounds = np.cumsum(counts)[:-1]
+
+        return [self.vote(classes, recording_probs) for recording_probs in np.split(probs, bounds)]
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print('python3 instclassifier.py <model.pkl> <file.wav> [file.wav ...]')
+        sys.exit(1)
+
+    import soundfile as sf
+
+    classifier = InstrumentClassifier(sys.argv[1])
+    recordings = [sf.read(filename, dtype='float32') for filename in sys.argv[2:]]
+    results = classifier.classify_batch([samples for samples, _ in recordings], [rate for _, rate in recordings])
+
+    for filename, result in zip(sys.argv[2:], results):
+        print(filename + ':', result['instrument'], result['votes'])
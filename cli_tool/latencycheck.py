@@ -0,0 +1,186 @@
+'''
+**************************************************************************************************
+* Filename:    latencycheck.py                                                                   *
+*                                                                                                *
+* Description: Guards classinst.py against getting slower. Makes the same synthetic violin clip  *
+*              every time, classifies it a few times with --profilejson and compares the median  *
+*              time of each stage with a stored baseline. Exits with 1, naming the stages, when  *
+*              any stage is slower than its baseline by more than the tolerance.                 *
+*                                                                                                *
+*              Stage times depend on the machine, so make the baseline on the machine the check  *
+*              runs on with --update. The check always runs on a wav clip so it does not depend  *
+*              on ffmpeg. --mp3 also runs an mp3 of the clip, which times conversion too,        *
+*              against its own baseline. Without an mp3 baseline its stages are only reported.   *
+*                                                                                                *
+* Usage:       python3 latencycheck.py [--update] [--mp3] [--tolerance <fraction>] [--runs <n>]  *
+*                   Run with --help for the model, baseline file and slack options               *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import json
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+import numpy as np
+import soundfile as sf
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+# scaletest.py in the project root makes the synthetic recordings
+sys.path.append(os.path.abspath(os.path.join(script_dir, '..')))
+from scaletest import synth_recording, INSTRUMENTS # pyright: ignore
+
+DEFAULT_BASELINE = os.path.join(script_dir, 'latency_baseline.json')
+DEFAULT_MODEL = os.path.join(script_dir, '0.1datasetRawModel.pkl')
+CLIP_SECONDS = 5.0
+CLIP_SAMPLERATE = 22050
+CLIP_SEED = 0
+# Slower by this fraction of the baseline fails the check
+DEFAULT_TOLERANCE = 0.5
+# ...and by at least this many seconds, so stages that take a few milliseconds do not fail on noise
+DEFAULT_SLACK = 0.05
+
+# Writes the test clip as a wav, or as an mp3 made from it with ffmpeg. Returns its filename
+def make_clip(outdir, kind='wav'):
+    wav_filename = os.path.join(outdir, 'violin_latencycheck.wav')
+    samples = synth_recording(INSTRUMENTS['violin'], CLIP_SECONDS, CLIP_SAMPLERATE, np.random.default_rng(CLIP_SEED))
+    sf.write(wav_filename, samples, CLIP_SAMPLERATE, subtype='PCM_16')
+
+    if kind == 'wav':
+        return wav_filename
+
+    mp3_filename = os.path.join(outdir, 'violin_latencycheck.mp3')
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'quiet', '-i', wav_filename, mp3_filename], check=True)
+    return mp3_filename
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             measure                                                                      *
+*                                                                                                *
+* Parameters:       str clip_filename  - The audio to classify                                   *
+*                   str model_filename - The model to classify it with                           *
+*                   int runs           - How many times to run classinst.py                      *
+*                   str workdir        - Scratch folder                                          *
+*                                                                                                *
+* Purpose:          Runs classinst.py as a user would, without the prediction cache, and takes   *
+*                   the median of each stage over the runs                                       *
+*                                                                                                *
+* Returns:          dict - Stage name to median wall seconds                                     *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def measure(clip_filename, model_filename, runs, workdir):
+    report_filename = os.path.join(workdir, 'profile.json')
+
+    times = {}
+    for run in range(runs):
+        cmd = ['python3', 'classinst.py', '--nocache', '-m', model_filename, '-t', os.path.join(workdir, 'tmp/'),
+               '--profilejson', report_filename, clip_filename]
+        completed = subprocess.run(cmd, cwd=script_dir, capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(completed.stdout + completed.stderr)
+            print('Error: classinst.py failed on run', run + 1)
+            sys.exit(1)
+
+        with open(report_filename, 'r') as f:
+            report = json.load(f)
+
+        for stage in report['stages']:
+            times.setdefault(stage['stage'], []).append(stage['wall_s'])
+        times.setdefault('total', []).append(report['total_s'])
+
+    return {stage: statistics.median(values) for stage, values in times.items()}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             compare                                                                      *
+*                                                                                                *
+* Parameters:       dict current    - Stage name to median seconds from this run                 *
+*                   dict baseline   - The same from the baseline                                 *
+*                   float tolerance - Allowed slowdown as a fraction of the baseline             *
+*                   float slack     - Allowed slowdown in seconds, both have to be exceeded      *
+*                                                                                                *
+* Returns:          str[] - The stages that regressed                                            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def compare(current, baseline, tolerance, slack):
+    regressed = []
+
+    print('Stage       baseline ms    now ms   change')
+    for stage, seconds in current.items():
+        if stage not in baseline:
+            print(stage.ljust(10), '%12s %9.1f' % ('-', seconds * 1000), '  new stage')
+            continue
+
+        limit = baseline[stage] * (1 + tolerance)
+        failed = seconds > limit and seconds - baseline[stage] > slack
+        change = (seconds / baseline[stage] - 1) * 100 if baseline[stage] > 0 else 0
+        print(stage.ljust(10), '%12.1f %9.1f %+7.0f%%' % (baseline[stage] * 1000, seconds * 1000, change),
+              '  REGRESSED' if failed else '')
+        if failed:
+            regressed.append(stage)
+
+    return regressed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='latencycheck.py', description='Fails when a classinst.py stage gets slower than its baseline')
+    parser.add_argument('--update', action='store_true', default=False, help='Measure and save a new baseline instead of checking')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='The baseline json file')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='The model classinst.py is run with')
+    parser.add_argument('--runs', type=int, default=3, help='Runs to take the median of')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE, help='Allowed slowdown of a stage as a fraction of its baseline')
+    parser.add_argument('--slack', type=float, default=DEFAULT_SLACK, help='Allowed slowdown of a stage in seconds, a stage only fails when both are exceeded')
+    parser.add_argument('--mp3', action='store_true', default=False, help='Also time an mp3 of the clip, conversion included. Needs ffmpeg')
+    args = parser.parse_args()
+
+    kinds = ['wav']
+    if args.mp3:
+        if shutil.which('ffmpeg') is None:
+            print('Error: --mp3 needs ffmpeg to encode the clip')
+            sys.exit(1)
+        kinds.append('mp3')
+
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baselines = json.load(f)
+
+    if not args.update and 'wav' not in baselines:
+        print('Error: no wav baseline in', args.baseline + ', make one with python3 latencycheck.py --update')
+        sys.exit(1)
+
+    regressed = []
+    for kind in kinds:
+        workdir = tempfile.mkdtemp(prefix='latencycheck_')
+        current = measure(make_clip(workdir, kind), os.path.abspath(args.model), args.runs, workdir)
+        shutil.rmtree(workdir)
+
+        if args.update:
+            baselines[kind] = current
+            print('Saved the', kind, 'baseline to', args.baseline)
+            for stage, seconds in current.items():
+                print('  ' + stage.ljust(10), '%9.1f ms' % (seconds * 1000))
+            continue
+
+        print(kind, 'clip')
+        if kind not in baselines:
+            print('No', kind, 'baseline yet, its stages are only reported. Make one with --update --' + kind)
+        regressed += [kind + ' ' + stage for stage in compare(current, baselines.get(kind, {}), args.tolerance, args.slack)]
+
+    if args.update:
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=1, sort_keys=True)
+        sys.exit()
+
+    if regressed:
+        print('Error: slower than the baseline:', ', '.join(regressed))
+        sys.exit(1)
+
+    print('No stage is slower than its baseline')
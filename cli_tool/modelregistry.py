@@ -0,0 +1,332 @@
+'''
+**************************************************************************************************
+* Filename:    modelregistry.py                                                                  *
+*                                                                                                *
+* Description: A folder of models served side by side, one per instrument set or harmonic count. *
+*              Each model is stored as <name>.json and <name>.<sha>.joblib. The .json records    *
+*              the instruments it predicts, the harmonics and split length it was trained with,  *
+*              the .joblib file it points to and that file's sha256.                             *
+*                                                                                                *
+*              Models are only loaded the first time they are asked for, and are loaded with     *
+*              joblib's mmap_mode so their numpy arrays stay in the page cache instead of being  *
+*              copied into each process. Worker processes serving one model share its pages.     *
+*              Linear models keep their coefficients mapped; sklearn's decision trees copy their *
+*              nodes out when they are loaded, so for them only the file read is shared.         *
+*                                                                                                *
+*              A model is reloaded when its .json changes. add_model writes a new .joblib named  *
+*              after its own checksum and only then replaces the .json with os.replace, so the   *
+*              .json always points at a complete file that matches it. Requests already running  *
+*              keep the model object they started with, and the old file stays mapped until they *
+*              finish, so nothing in flight is dropped. The version before the new one is kept   *
+*              for readers that just read the old .json, anything older is removed.              *
+*                                                                                                *
+*              Errors are raised as RegistryError for the caller to handle.                      *
+*                                                                                                *
+* Usage:       python3 modelregistry.py add <registry> <model.pkl> [--name <name>]               *
+*                                          [--splitlen <seconds>]                                *
+*                   Copies a gen_model.py pickle into the registry                               *
+*                                                                                                *
+*              python3 modelregistry.py list <registry>                                          *
+*                   Prints every model and its metadata                                          *
+*                                                                                                *
+*              python3 modelregistry.py verify <registry>                                        *
+*                   Checks every model file against its checksum                                 *
+*                                                                                                *
+**************************************************************************************************
+'''
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import hashlib
+import argparse
+import threading
+
+import joblib
+
+MODEL_EXT = '.joblib'
+META_EXT = '.json'
+# How often get_model looks for a changed model. Checking is one stat, this keeps it off every request
+RELOAD_CHECK_SECONDS = 1.0
+HASH_BLOCK_BYTES = 1024 * 1024
+# gen_model.py names models after their dataset, which starts with the split length, e.g. 0.1datasetRawModel.pkl
+SPLITLEN_PATTERN = re.compile(r'^(\d+(?:\.\d+)?)')
+# Characters of the sha256 put in a model's file name
+FILE_SHA_CHARS = 16
+
+class RegistryError(Exception):
+    pass
+
+def file_sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+# Writes through a temp file and os.replace, so readers only ever see the old file or the new one
+def replace_file(filename, write):
+    tempfilename = filename + '.tmp'
+    write(tempfilename)
+    os.replace(tempfilename, filename)
+
+def splitlen_from_name(name):
+    match = SPLITLEN_PATTERN.match(os.path.basename(name))
+    return float(match.group(1)) if match else None
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             model_metadata                                                               *
+*                                                                                                *
+* Parameters:       model               - A fitted sklearn model                                 *
+*                   str name            - The name it is registered under                        *
+*                   float splitlen      - The clip length its dataset was made with              *
+*                   str source          - The file it came from                                  *
+*                                                                                                *
+* Purpose:          Reads what a model was trained on from the model itself: sklearn models      *
+*                   keep their classes and feature count                                         *
+*                                                                                                *
+* Returns:          dict - The contents of the model's .json, less the checksum                  *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def model_metadata(model, name, splitlen=None, source=None):
+    return {'name': name,
+            'instruments': sorted(str(inst) for inst in getattr(model, 'classes_', [])),
+            'harmonics': getattr(model, 'n_features_in_', 0) // 2,
+            'splitlen': splitlen,
+            'source': source,
+            'added': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             add_model                                                                    *
+*                                                                                                *
+* Parameters:       str registry_dir    - The registry folder, made if missing                   *
+*                   model               - A fitted sklearn model                                 *
+*                   str name            - The name to register it under, replacing any model     *
+*                                         already there                                          *
+*                   float splitlen      - The clip length its dataset was made with              *
+*                   str source          - The file it came from                                  *
+*                                                                                                *
+* Purpose:          Saves the model uncompressed, which joblib needs to memory map it, hashes it *
+*                   and moves it to a file named after the hash, then writes its metadata        *
+*                   pointing at that file. Running servers pick the new model up on their next   *
+*                   request                                                                      *
+*                                                                                                *
+* Returns:          dict - The metadata written                                                  *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def add_model(registry_dir, model, name, splitlen=None, source=None):
+    os.makedirs(registry_dir, exist_ok=True)
+    meta_filename = os.path.join(registry_dir, name + META_EXT)
+    old_file = None
+    if os.path.exists(meta_filename):
+        with open(meta_filename, 'r') as f:
+            old_file = json.load(f).get('file')
+
+    tempfilename = os.path.join(registry_dir, name + MODEL_EXT + '.tmp')
+    joblib.dump(model, tempfilename)
+    meta = model_metadata(model, name, splitlen, source)
+    meta['sha256'] = file_sha256(tempfilename)
+    meta['file'] = name + '.' + meta['sha256'][:FILE_SHA_CHARS] + MODEL_EXT
+    os.replace(tempfilename, os.path.join(registry_dir, meta['file']))
+
+    def write_meta(filename):
+        with open(filename, 'w') as f:
+            json.dump(meta, f, indent=1)
+    replace_file(meta_filename, write_meta)
+
+    for filename in model_versions(registry_dir, name):
+        if filename not in [meta['file'], old_file]:
+            os.remove(os.path.join(registry_dir, filename))
+
+    return meta
+
+# Every versioned .joblib of one model
+def model_versions(registry_dir, name):
+    pattern = re.compile(re.escape(name) + r'\.[0-9a-f]{%d}' % FILE_SHA_CHARS + re.escape(MODEL_EXT) + '$')
+    return [filename for filename in os.listdir(registry_dir) if pattern.match(filename)]
+
+# The .joblib a model's metadata points to. Registries made before versioned files used <name>.joblib
+def model_file(registry_dir, meta):
+    return os.path.join(registry_dir, meta.get('file', meta['name'] + MODEL_EXT))
+
+def add_pickle(registry_dir, pickle_filename, name=None, splitlen=None):
+    with open(pickle_filename, 'rb') as f:
+        model = pickle.load(f)
+
+    if name is None:
+        name = os.path.splitext(os.path.basename(pickle_filename))[0]
+    if splitlen is None:
+        splitlen = splitlen_from_name(pickle_filename)
+
+    return add_model(registry_dir, model, name, splitlen, os.path.abspath(pickle_filename))
+
+def read_metadata(registry_dir):
+    metas = {}
+    for filename in sorted(os.listdir(registry_dir)):
+        if not filename.endswith(META_EXT):
+            continue
+        with open(os.path.join(registry_dir, filename), 'r') as f:
+            meta = json.load(f)
+        metas[meta['name']] = meta
+
+    return metas
+
+# A dict holding the loaded models of one registry, shared by every thread of a process
+def open_registry(registry_dir):
+    if not os.path.isdir(registry_dir):
+        raise RegistryError('model registry %s does not exist' % registry_dir)
+
+    return {'dir': registry_dir, 'models': {}, 'lock': threading.Lock()}
+
+def meta_stamp(registry, name):
+    stat = os.stat(os.path.join(registry['dir'], name + META_EXT))
+    return (stat.st_mtime_ns, stat.st_size)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             load_entry                                                                   *
+*                                                                                                *
+* Parameters:       dict registry  - From open_registry                                          *
+*                   str name       - The model to load                                           *
+*                                                                                                *
+* Purpose:          Reads the metadata, checks the model file against its checksum and maps it.  *
+*                   A model whose file is missing or does not match is not loaded, so a damaged  *
+*                   copy is never served                                                         *
+*                                                                                                *
+* Returns:          dict - The entry kept in the registry, None if the files do not match        *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def load_entry(registry, name):
+    stamp = meta_stamp(registry, name)
+    with open(os.path.join(registry['dir'], name + META_EXT), 'r') as f:
+        meta = json.load(f)
+
+    model_filename = model_file(registry['dir'], meta)
+    if not os.path.exists(model_filename) or file_sha256(model_filename) != meta['sha256']:
+        return None
+
+    return {'meta': meta, 'model': joblib.load(model_filename, mmap_mode='r'), 'stamp': stamp,
+            'checked': time.monotonic()}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             get_model                                                                    *
+*                                                                                                *
+* Parameters:       dict registry  - From open_registry                                          *
+*                   str name       - The model to use                                            *
+*                                                                                                *
+* Purpose:          Loads the model on first use, and at most every RELOAD_CHECK_SECONDS checks  *
+*                   whether its .json changed and loads the new one if so. The swap only         *
+*                   replaces the registry's reference, callers holding the old model keep it.    *
+*                   If the new files do not check out the old model keeps being served. Raises   *
+*                   RegistryError when there is no model to serve at all                         *
+*                                                                                                *
+* Returns:          model, dict - The model and its metadata                                     *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def get_model(registry, name):
+    entry = registry['models'].get(name)
+    if entry is not None and time.monotonic() - entry['checked'] < RELOAD_CHECK_SECONDS:
+        return entry['model'], entry['meta']
+
+    with registry['lock']:
+        entry = registry['models'].get(name)
+        if not os.path.exists(os.path.join(registry['dir'], name + META_EXT)):
+            if entry is None:
+                raise RegistryError('no model named %s in %s' % (name, registry['dir']))
+            return entry['model'], entry['meta']
+
+        if entry is None or meta_stamp(registry, name) != entry['stamp']:
+            new_entry = load_entry(registry, name)
+            if new_entry is not None:
+                if entry is not None:
+                    print('Reloaded model', name)
+                entry = new_entry
+            elif entry is None:
+                raise RegistryError('model %s is missing or does not match its checksum' % name)
+        entry['checked'] = time.monotonic()
+        registry['models'][name] = entry
+
+    return entry['model'], entry['meta']
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             find_model                                                                   *
+*                                                                                                *
+* Parameters:       str registry_dir   - The registry folder                                     *
+*                   str[] instruments  - The instrument set wanted, None for any                 *
+*                   int harmonics      - The harmonic count wanted, None for any                 *
+*                   float splitlen     - The split length wanted, None for any                   *
+*                                                                                                *
+* Purpose:          Picks a model by what it predicts rather than its name. When several match   *
+*                   the one with the most harmonics is used. Raises RegistryError when none do   *
+*                                                                                                *
+* Returns:          str - The name of the model                                                  *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def find_model(registry_dir, instruments=None, harmonics=None, splitlen=None):
+    matches = [meta for meta in read_metadata(registry_dir).values()
+               if (instruments is None or meta['instruments'] == sorted(instruments))
+               and (harmonics is None or meta['harmonics'] == harmonics)
+               and (splitlen is None or meta['splitlen'] == splitlen)]
+
+    if not matches:
+        raise RegistryError('no model in %s matches instruments %s harmonics %s split length %s' %
+                            (registry_dir, instruments, harmonics, splitlen))
+
+    return max(matches, key=lambda meta: meta['harmonics'])['name']
+
+def print_registry(registry_dir):
+    print('Name'.ljust(40), 'Harmonics', 'Split', ' Instruments')
+    for name, meta in read_metadata(registry_dir).items():
+        print(name.ljust(40), str(meta['harmonics']).rjust(9), str(meta['splitlen']).rjust(5), '', ' '.join(meta['instruments']))
+
+def verify_registry(registry_dir):
+    bad = []
+    for name, meta in read_metadata(registry_dir).items():
+        model_filename = model_file(registry_dir, meta)
+        ok = os.path.exists(model_filename) and file_sha256(model_filename) == meta['sha256']
+        print(name.ljust(40), 'ok' if ok else 'CHECKSUM MISMATCH')
+        if not ok:
+            bad.append(name)
+
+    return bad
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='modelregistry.py', description='Manages a folder of models served side by side')
+    parser.add_argument('mode', choices=['add', 'list', 'verify'])
+    parser.add_argument('registry', help='The registry folder')
+    parser.add_argument('model', nargs='?', help='add only, the gen_model.py .pkl file to add')
+    parser.add_argument('--name', help='add only, the name to register the model under. Defaults to its filename')
+    parser.add_argument('--splitlen', type=float, help='add only, the clip length the dataset was made with. Defaults to the number the filename starts with')
+    args = parser.parse_args()
+
+    if args.mode == 'add':
+        if args.model is None:
+            print('Error: add needs the model file to add')
+            sys.exit(1)
+        meta = add_pickle(args.registry, args.model, args.name, args.splitlen)
+        print('Added', meta['name'], '-', meta['harmonics'], 'harmonics,', ' '.join(meta['instruments']))
+    elif not os.path.isdir(args.registry):
+        print('Error: model registry', args.registry, 'does not exist')
+        sys.exit(1)
+    elif args.mode == 'list':
+        print_registry(args.registry)
+    elif args.mode == 'verify':
+        if verify_registry(args.registry):
+            sys.exit(1)
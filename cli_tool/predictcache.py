@@ -0,0 +1,148 @@
+'''
+**************************************************************************************************
+* Filename:    predictcache.py                                                                   *
+*                                                                                                *
+* Description: An on-disk cache of classinst.py results. Each entry is a small json file named   *
+*              after a hash of everything that decides the prediction: the contents of the audio *
+*              file, the model, and the split length, normalization level and harmonic count.    *
+*              Resubmitting the same track with the same settings skips conversion, splitting,   *
+*              normalizing, the FFT and the model entirely.                                      *
+*                                                                                                *
+*              Entries are touched every time they are read, so their mtime is the last time     *
+*              they were used. Once the cache grows past its size limit the least recently used  *
+*              entries are removed.                                                              *
+*                                                                                                *
+**************************************************************************************************
+'''
+import os
+import json
+import time
+import hashlib
+
+DEFAULT_CACHE_DIR = './config/predictcache/'
+# 10 MB holds tens of thousands of entries
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+HASH_BLOCK_BYTES = 1024 * 1024
+
+def hash_file(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             make_key                                                                     *
+*                                                                                                *
+* Parameters:       str audio_hash  - hash_file of the input audio                               *
+*                   str model_hash  - Hash of the pickled model                                  *
+*                   dict params     - The pipeline settings that change the features             *
+*                                                                                                *
+* Returns:          str - The cache key                                                          *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def make_key(audio_hash, model_hash, params):
+    fingerprint = json.dumps({'audio': audio_hash, 'model': model_hash, 'params': params}, sort_keys=True)
+
+    return hashlib.sha256(fingerprint.encode()).hexdigest()
+
+def entry_filename(cache_dir, key):
+    return os.path.join(cache_dir, key + '.json')
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             lookup                                                                       *
+*                                                                                                *
+* Parameters:       str cache_dir - The cache directory                                          *
+*                   str key       - From make_key                                                *
+*                                                                                                *
+* Returns:          dict - The stored result, None on a miss                                     *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def lookup(cache_dir, key):
+    filename = entry_filename(cache_dir, key)
+
+    try:
+        with open(filename, 'r') as f:
+            entry = json.load(f)
+        # Marks the entry as recently used
+        os.utime(filename, None)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    return entry
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             store                                                                        *
+*                                                                                                *
+* Parameters:       str cache_dir  - The cache directory                                         *
+*                   str key        - From make_key                                               *
+*                   dict result    - The prediction and vote breakdown to keep                   *
+*                   int max_bytes  - Evict least recently used entries past this size            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def store(cache_dir, key, result, max_bytes=DEFAULT_MAX_BYTES):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    entry = dict(result)
+    entry['created'] = time.time()
+
+    # Written to a temp file first so two runs storing at once never leave half an entry behind
+    filename = entry_filename(cache_dir, key)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(entry, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+    evict(cache_dir, max_bytes)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             evict                                                                        *
+*                                                                                                *
+* Parameters:       str cache_dir  - The cache directory                                         *
+*                   int max_bytes  - The size the cache has to fit in                            *
+*                                                                                                *
+* Purpose:          Removes the least recently used entries until the cache fits                 *
+*                                                                                                *
+* Returns:          int - The number of entries removed                                          *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def evict(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    entries = []
+    total_bytes = 0
+    for name in os.listdir(cache_dir):
+        if not name.endswith('.json'):
+            continue
+        try:
+            stat = os.stat(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+        total_bytes += stat.st_size
+
+    num_removed = 0
+    for _, size, name in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass # Another run evicted it first
+        total_bytes -= size
+        num_removed += 1
+
+    return num_removed
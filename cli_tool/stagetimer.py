@@ -0,0 +1,105 @@
+'''
+**************************************************************************************************
+* Filename:    stagetimer.py                                                                     *
+*                                                                                                *
+* Description: Times the stages of a classinst.py run: ffmpeg conversion, splitting, pydub       *
+*              normalization, the FFT and arff writing, cleaning, reading the arff back and the  *
+*              model, so a slow classification shows where the time went. One stage can also be  *
+*              run under cProfile to see which functions inside it are slow.                     *
+*                                                                                                *
+*              A timer is a dict made by new_timer and passed to every stage. Stages run without *
+*              one are not timed, so the normal path pays nothing.                               *
+*                                                                                                *
+**************************************************************************************************
+'''
+import io
+import json
+import time
+import pstats
+import cProfile
+
+# The stages classinst.py reports, in the order they run
+STAGES = ['model', 'cache', 'convert', 'split', 'normalize', 'extract', 'clean', 'load', 'predict']
+# Functions printed from a cProfile run, by cumulative time
+CPROFILE_LINES = 20
+
+# cprofile_stage is the stage to run under cProfile, its stats are saved to cprofile_filename
+def new_timer(cprofile_stage=None, cprofile_filename=None):
+    return {'stages': [], 'start': time.perf_counter(), 'cprofile_stage': cprofile_stage,
+            'cprofile_filename': cprofile_filename}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             run_stage                                                                    *
+*                                                                                                *
+* Parameters:       dict timer   - From new_timer, None runs the stage untimed                   *
+*                   str name     - The stage, one of STAGES                                      *
+*                   func         - The stage itself                                              *
+*                   args         - Passed on to func                                             *
+*                                                                                                *
+* Purpose:          Runs the stage and records its wall and cpu time. The stage picked for       *
+*                   cProfile is run under it, which slows it down, so its time is marked as      *
+*                   profiled                                                                     *
+*                                                                                                *
+* Returns:          What func returns                                                            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def run_stage(timer, name, func, *args, **kwargs):
+    if timer is None:
+        return func(*args, **kwargs)
+
+    profiled = timer['cprofile_stage'] == name
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+
+    if profiled:
+        profiler = cProfile.Profile()
+        result = profiler.runcall(func, *args, **kwargs)
+    else:
+        result = func(*args, **kwargs)
+
+    timer['stages'].append({'stage': name, 'wall_s': time.perf_counter() - wall_start,
+                            'cpu_s': time.process_time() - cpu_start, 'profiled': profiled})
+
+    if profiled:
+        save_cprofile(profiler, timer['cprofile_filename'])
+
+    return result
+
+def save_cprofile(profiler, filename):
+    if filename:
+        profiler.dump_stats(filename)
+
+    output = io.StringIO()
+    pstats.Stats(profiler, stream=output).sort_stats('cumulative').print_stats(CPROFILE_LINES)
+    print(output.getvalue())
+    if filename:
+        print('cProfile stats saved to', filename, '- open them with python3 -m pstats', filename)
+
+# The seconds of wall time each stage took, stages run more than once are added together
+def stage_totals(timer):
+    totals = {}
+    for stage in timer['stages']:
+        totals[stage['stage']] = totals.get(stage['stage'], 0) + stage['wall_s']
+
+    return totals
+
+def timer_report(timer, audio_filename):
+    return {'audio': audio_filename, 'total_s': time.perf_counter() - timer['start'], 'stages': timer['stages']}
+
+def print_timer(timer):
+    report = timer_report(timer, None)
+    total = report['total_s']
+
+    print('Stage        wall ms    cpu ms   share')
+    for stage in timer['stages']:
+        print(stage['stage'].ljust(10), '%9.1f %9.1f %6.1f%%' % (stage['wall_s'] * 1000, stage['cpu_s'] * 1000,
+                                                              100 * stage['wall_s'] / total if total > 0 else 0),
+              '(under cProfile)' if stage['profiled'] else '')
+    print('total'.ljust(10), '%9.1f' % (total * 1000))
+
+def write_timer(timer, audio_filename, filename):
+    with open(filename, 'w') as f:
+        json.dump(timer_report(timer, audio_filename), f, indent=1)
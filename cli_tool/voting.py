@@ -0,0 +1,165 @@
+'''
+**************************************************************************************************
+* Filename:    voting.py                                                                         *
+*                                                                                                *
+* Description: Turns the model's output for every clip of a recording into a result. All clips   *
+*              go through predict_proba in one call, then the class probabilities are combined:  *
+*                                                                                                *
+*              majority  - Each clip votes for its most likely instrument, the most votes wins.  *
+*                          The same answer the mode of model.predict gives                       *
+*              weighted  - The mean probability of each instrument over the clips, so unsure     *
+*                          clips count for less                                                  *
+*              logprob   - The mean log probability, as if the clips were independent evidence.  *
+*                          One clip that rules an instrument out counts heavily against it       *
+*                                                                                                *
+*              For recordings where the instrument changes, timeline smooths the sequence of     *
+*              clips and cuts it into time ranges, one instrument each:                          *
+*                                                                                                *
+*              median    - A running median over each instrument's probability track             *
+*              hmm       - The most likely instrument sequence when switching instrument costs   *
+*                          the log of switch_prob, found with the Viterbi algorithm              *
+*                                                                                                *
+**************************************************************************************************
+'''
+import numpy as np
+from scipy.ndimage import median_filter
+
+VOTE_METHODS = ['majority', 'weighted', 'logprob']
+SMOOTH_METHODS = ['none', 'median', 'hmm']
+# Probabilities are floored at this before taking logs, trees give exact zeros
+LOG_FLOOR = 1e-6
+# Silence longer than this in seconds between clips ends a time range. Shorter gaps are the quiet clips between notes
+MAX_GAP_SECONDS = 0.5
+
+# The classes and one row of probabilities per clip. Models without predict_proba give each clip's prediction all
+# of its weight
+def clip_probabilities(model, rows):
+    classes = np.array([str(inst) for inst in model.classes_])
+    if hasattr(model, 'predict_proba'):
+        return classes, model.predict_proba(rows)
+
+    probs = np.zeros((len(rows), len(classes)))
+    probs[np.arange(len(rows)), np.searchsorted(classes, model.predict(rows).astype(str))] = 1
+    return classes, probs
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             aggregate                                                                    *
+*                                                                                                *
+* Parameters:       np.array classes  - The instrument of each probability column                *
+*                   np.array probs    - One row of class probabilities per clip                  *
+*                   str method        - One of VOTE_METHODS                                      *
+*                                                                                                *
+* Returns:          dict - The chosen instrument, the hard votes of every clip and, for          *
+*                          weighted and logprob, each instrument's score                         *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def aggregate(classes, probs, method='majority'):
+    hard = probs.argmax(axis=1)
+    counts = np.bincount(hard, minlength=len(classes))
+    # Most votes first, ties in the order the clips were first predicted, like statistics.mode
+    first_seen = np.full(len(classes), len(hard))
+    first_seen[hard[::-1]] = np.arange(len(hard))[::-1]
+    order = np.lexsort((first_seen, -counts))
+    votes = {str(classes[i]): int(counts[i]) for i in order if counts[i] > 0}
+
+    if method == 'majority':
+        return {'instrument': next(iter(votes)), 'votes': votes, 'method': method}
+
+    if method == 'weighted':
+        scores = probs.mean(axis=0)
+    else:
+        scores = np.log(np.maximum(probs, LOG_FLOOR)).mean(axis=0)
+
+    ranked = np.argsort(-scores, kind='stable')
+    return {'instrument': str(classes[ranked[0]]), 'votes': votes, 'method': method,
+            'scores': {str(classes[i]): round(float(scores[i]), 6) for i in ranked}}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             smooth                                                                       *
+*                                                                                                *
+* Parameters:       np.array probs     - One row of class probabilities per clip, in time order  *
+*                   str method         - One of SMOOTH_METHODS                                   *
+*                   int width          - Clips in the median window                              *
+*                   float switch_prob  - hmm only, the chance of changing instrument between two *
+*                                        neighbouring clips                                      *
+*                                                                                                *
+* Returns:          np.array - The class index of each clip after smoothing                      *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def smooth(probs, method='median', width=9, switch_prob=0.01):
+    if method == 'none' or len(probs) == 0:
+        return probs.argmax(axis=1)
+
+    if method == 'median':
+        return median_filter(probs, size=(width, 1), mode='nearest').argmax(axis=1)
+
+    # Viterbi over the clips. Every step is one vectorized update over all instrument pairs
+    num_classes = probs.shape[1]
+    log_emit = np.log(np.maximum(probs, LOG_FLOOR))
+    if num_classes == 1:
+        return np.zeros(len(probs), dtype=int)
+    log_trans = np.full((num_classes, num_classes), np.log(switch_prob / (num_classes - 1)))
+    np.fill_diagonal(log_trans, np.log(1 - switch_prob))
+
+    back = np.empty((len(probs), num_classes), dtype=np.int32)
+    score = log_emit[0] - np.log(num_classes)
+    for clip in range(1, len(probs)):
+        step = score[:, None] + log_trans
+        back[clip] = step.argmax(axis=0)
+        score = step[back[clip], np.arange(num_classes)] + log_emit[clip]
+
+    path = np.empty(len(probs), dtype=int)
+    path[-1] = score.argmax()
+    for clip in range(len(probs) - 1, 0, -1):
+        path[clip - 1] = back[clip, path[clip]]
+
+    return path
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             timeline                                                                     *
+*                                                                                                *
+* Parameters:       np.array classes  - The instrument of each class index                       *
+*                   np.array labels   - The smoothed class index of each clip                    *
+*                   np.array starts   - The start of each clip in seconds, in time order         *
+*                   float clip_len    - The length of a clip in seconds                          *
+*                   float max_gap     - Seconds of skipped quiet clips that still join a range   *
+*                                                                                                *
+* Purpose:          Joins runs of clips with the same instrument into time ranges. A longer gap  *
+*                   between clips, where the recording was silent, also ends a range             *
+*                                                                                                *
+* Returns:          dict[] - {start, end, instrument, clips} for each range, in time order       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def timeline(classes, labels, starts, clip_len, max_gap=MAX_GAP_SECONDS):
+    if len(labels) == 0:
+        return []
+
+    breaks = np.flatnonzero((labels[1:] != labels[:-1]) | (np.diff(starts) > clip_len + max_gap)) + 1
+    firsts = np.concatenate(([0], breaks))
+    lasts = np.concatenate((breaks, [len(labels)])) - 1
+    # Overlapping clips would make neighbouring ranges overlap, a range ends where the next one starts
+    ends = starts[lasts] + clip_len
+    ends[:-1] = np.minimum(ends[:-1], starts[firsts[1:]])
+
+    return [{'start': round(float(starts[first]), 3), 'end': round(float(end), 3),
+             'instrument': str(classes[labels[first]]), 'clips': int(last - first + 1)}
+            for first, last, end in zip(firsts, lasts, ends)]
+
+def format_time(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return '%d:%02d:%05.2f' % (hours, minutes, seconds)
+
+def print_timeline(segments):
+    for segment in segments:
+        print(format_time(segment['start']), '-', format_time(segment['end']), ' ', segment['instrument'].ljust(12),
+              segment['clips'], 'clips')
@@ -0,0 +1,321 @@
+'''
+**************************************************************************************************
+* Filename:    clipsweep.py                                                                      *
+*                                                                                                *
+* Description: Compares clip lengths without rebuilding the dataset for each one. The makefiles  *
+*              bake AUDIO_FILE_LEN into every folder and dataset name, so trying 0.05, 0.1 and   *
+*              0.25 second clips that way means three full split, normalize and FFT runs.        *
+*                                                                                                *
+*              Here every full length wav is decoded once, a block at a time, by one worker.     *
+*              Each block is cut into clips of every length with the same gate and analysis      *
+*              fusedextract.py uses, and the partial clip at the end of a block is carried over  *
+*              to the next one, so hour long recordings never sit in memory whole. The rows      *
+*              match what the pipeline writes when it is given the same --gatedb, --dedupe and a *
+*              --hop to match --overlap, rounded and cleaned as classinst.py reads them back.    *
+*              Then one decision tree per length is searched, trained and scored at the same     *
+*              time, the same way gen_model.py trains them, and one table compares the lengths:  *
+*                                                                                                *
+*                  rows            - Clips that made it through the gate and cleaning            *
+*                  extract ms/s    - Time to extract the features of a second of audio           *
+*                  accuracy        - On the held out split                                       *
+*                  predict us/row  - Time for the model to predict one clip                      *
+*                  latency ms/s    - Extraction and prediction for a second of audio, about what *
+*                                    classinst.py spends per second of input after decoding      *
+*                                                                                                *
+* Usage:       python3 clipsweep.py <wav dir> [--lengths 0.05 0.1 0.25] [options]                *
+*                   Run with --help for the worker count, overlap and output options             *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import csv
+import time
+import pickle
+import warnings
+import argparse
+import multiprocessing
+
+import numpy as np
+import soundfile as sf
+from sklearn.model_selection import train_test_split, GroupShuffleSplit
+from sklearn.metrics import accuracy_score
+
+# Lets the dataset_gen and model_gen modules be imported when this file is run from another folder
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from dataset_gen.fusedextract import analyze_clips, analyze_frames, clean_rows # pyright: ignore
+from dataset_gen.splitaudio import gate_windows, gate_frames, frame_sizes, count_frames # pyright: ignore
+from dataset_gen.extractFreqARFF import instrument_from_filename # pyright: ignore
+from dataset_gen.arffio import write_arff # pyright: ignore
+from dataset_gen.manifest import list_inputs # pyright: ignore
+from dataset_gen.procpool import parse_max_processes, initial_workers # pyright: ignore
+from model_gen.gen_model import search_tree, model_cost # pyright: ignore
+
+DEFAULT_LENGTHS = [0.05, 0.1, 0.25]
+DEFAULT_RESULTS = 'clipsweep_results.csv'
+RESULT_FIELDS = ['seconds', 'hop', 'rows', 'extract_s', 'extract_ms_per_s', 'train_s', 'accuracy', 'nodes',
+                 'predict_us_per_row', 'latency_ms_per_s']
+# The same held out share gen_model.py uses
+TEST_SIZE = 0.25
+# Seconds of audio decoded at a time
+DECODE_BLOCK_SECONDS = 30
+
+# Seconds between clip starts for a clip length, None for back to back clips
+def hop_for(seconds, overlap):
+    return seconds * (1 - overlap) if overlap > 0 else None
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             extract_span                                                                 *
+*                                                                                                *
+* Parameters:       dict state        - One clip length's progress through a recording: the      *
+*                                       'carry' samples, 'first_clip' number, 'rows', 'clips'    *
+*                                       and 'seen' hashes for --dedupe                           *
+*                   np.array samples  - The next block of mono float32 samples                   *
+*                   int samplerate    - The sample rate of the recording                         *
+*                   float seconds     - The clip length                                          *
+*                   dict settings     - As for sweep_file                                        *
+*                   bool last         - The end of the recording, back to back clips then keep   *
+*                                       the short clip at the end like the pipeline does         *
+*                                                                                                *
+* Purpose:          Extracts the whole clips of the carried samples and the block, and keeps the *
+*                   samples of the clip that runs past the block's end for the next call         *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def extract_span(state, samples, samplerate, seconds, settings, last=False):
+    samples = np.concatenate([state['carry'], samples])
+    hop = hop_for(seconds, settings['overlap'])
+    samples_per_split, hop_samples = frame_sizes(seconds, hop, samplerate)
+
+    if hop is None:
+        num_samples = len(samples) if last else len(samples) // samples_per_split * samples_per_split
+        span, state['carry'] = samples[:num_samples], samples[num_samples:]
+        keep, _, _ = gate_windows(span, samples_per_split, settings['gatedb'], state['seen'])
+        rows, clip_idx = analyze_clips(span, keep, samples_per_split, samplerate, settings['harmonics'],
+                                       settings['dbfs'])
+    else:
+        num_clips = count_frames(len(samples), samples_per_split, hop_samples)
+        span = samples[:(num_clips - 1) * hop_samples + samples_per_split] if num_clips > 0 else samples[:0]
+        state['carry'] = samples[num_clips * hop_samples:]
+        keep, _, _ = gate_frames(span, samples_per_split, hop_samples, settings['gatedb'], state['seen'])
+        rows, clip_idx = analyze_frames(span, keep, samples_per_split, hop_samples, samplerate, settings['harmonics'],
+                                        settings['dbfs'])
+
+    state['rows'].append(rows)
+    state['clips'].append(clip_idx + state['first_clip'])
+    state['first_clip'] += len(keep)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             sweep_file                                                                   *
+*                                                                                                *
+* Parameters:       tuple task - (wav filename, dict settings) where settings holds the clip     *
+*                                'lengths', 'harmonics', 'dbfs', 'gatedb', 'overlap' and         *
+*                                'dedupe'                                                        *
+*                                                                                                *
+* Purpose:          Decodes one recording a block at a time and extracts its rows at every clip  *
+*                   length from each block. Runs in a worker process                             *
+*                                                                                                *
+* Returns:          dict - The instrument, seconds of audio, decode time and per length rows and *
+*                          extraction time                                                       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def sweep_file(task):
+    filename, settings = task
+    info = sf.info(filename)
+
+    states = {seconds: {'carry': np.empty(0, dtype=np.float32), 'first_clip': 0, 'rows': [], 'clips': [],
+                        'seen': set() if settings['dedupe'] else None} for seconds in settings['lengths']}
+    extract_time = {seconds: 0 for seconds in settings['lengths']}
+    decode_time = 0
+
+    blocks = sf.blocks(filename, blocksize=int(DECODE_BLOCK_SECONDS * info.samplerate), dtype='float32', always_2d=True)
+    while True:
+        start = time.perf_counter()
+        block = next(blocks, None)
+        if block is not None:
+            block = np.ascontiguousarray(block[:, 0]) if block.shape[1] == 1 else block.mean(axis=1)
+        decode_time += time.perf_counter() - start
+
+        for seconds, state in states.items():
+            start = time.perf_counter()
+            extract_span(state, block if block is not None else np.empty(0, dtype=np.float32), info.samplerate,
+                         seconds, settings, last=block is None)
+            extract_time[seconds] += time.perf_counter() - start
+
+        if block is None:
+            break
+
+    rows = {}
+    for seconds, state in states.items():
+        start = time.perf_counter()
+        features = np.concatenate(state['rows']) if state['rows'] else np.empty((0, 2 * settings['harmonics']))
+        rows[seconds], _ = clean_rows(features, np.concatenate(state['clips']))
+        extract_time[seconds] += time.perf_counter() - start
+
+    return {'filename': filename, 'instrument': instrument_from_filename(filename),
+            'audio_s': info.frames / info.samplerate, 'decode_s': decode_time, 'rows': rows, 'extract_s': extract_time}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             train_length                                                                 *
+*                                                                                                *
+* Parameters:       tuple task - (clip length, rows, labels, recording of each row, bool         *
+*                                by_source)                                                      *
+*                                                                                                *
+* Purpose:          Searches and trains a tree for one clip length with gen_model.search_tree    *
+*                   and scores it on a held out split. by_source holds out whole recordings,     *
+*                   otherwise rows are split at random like gen_model.py does. Runs in a worker  *
+*                   process                                                                      *
+*                                                                                                *
+* Returns:          dict - The model, its accuracy, training time and cost                       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def train_length(task):
+    seconds, X, y, sources, by_source = task
+
+    if by_source:
+        train_idx, test_idx = next(GroupShuffleSplit(n_splits=1, test_size=TEST_SIZE, random_state=0).split(X, y, sources))
+        X_train, X_test, y_train, y_test = X[train_idx], X[test_idx], y[train_idx], y[test_idx]
+    else:
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=TEST_SIZE, random_state=0)
+
+    start = time.perf_counter()
+    # The lengths are already trained in parallel, joblib warns that the search inside runs as one job
+    with warnings.catch_warnings(action='ignore'):
+        model = search_tree(X_train, y_train)
+    train_time = time.perf_counter() - start
+
+    cost = model_cost(model, X_test)
+    return {'seconds': seconds, 'model': model, 'train_s': train_time,
+            'accuracy': accuracy_score(y_test, model.predict(X_test)), 'nodes': cost['nodes'],
+            'predict_us_per_row': cost['us_per_row']}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             run_sweep                                                                    *
+*                                                                                                *
+* Parameters:       str[] filenames - The full length, instrument tagged wavs                    *
+*                   dict settings   - As for sweep_file                                          *
+*                   int num_workers - Processes for both the extraction and the training         *
+*                   bool by_source  - Hold out whole recordings instead of random rows           *
+*                   str arff_dir    - Also write each length's dataset here as                   *
+*                                     <seconds>datasetRaw.arff, None skips it                    *
+*                   str models_dir  - Also save each length's model here as                      *
+*                                     <seconds>datasetRawModel.pkl, None skips it                *
+*                                                                                                *
+* Returns:          dict[] - One result row per clip length, with the fields in RESULT_FIELDS    *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def run_sweep(filenames, settings, num_workers, by_source=False, arff_dir=None, models_dir=None):
+    lengths = settings['lengths']
+    audio_secs = 0
+    decode_time = 0
+    extract_time = {seconds: 0 for seconds in lengths}
+    rows = {seconds: [] for seconds in lengths}
+    labels = {seconds: [] for seconds in lengths}
+    sources = {seconds: [] for seconds in lengths}
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(num_workers) as pool:
+        for source, result in enumerate(pool.imap(sweep_file, [(filename, settings) for filename in filenames])):
+            audio_secs += result['audio_s']
+            decode_time += result['decode_s']
+            for seconds in lengths:
+                extract_time[seconds] += result['extract_s'][seconds]
+                rows[seconds].append(result['rows'][seconds])
+                labels[seconds].extend([result['instrument']] * len(result['rows'][seconds]))
+                sources[seconds].extend([source] * len(result['rows'][seconds]))
+    print('Extracted', len(filenames), 'recordings,', round(audio_secs, 1), 's of audio at', len(lengths),
+          'clip lengths in %.1fs, %.1fs of it decoding' % (time.perf_counter() - start, decode_time))
+
+    tasks = []
+    for seconds in lengths:
+        X = np.concatenate(rows[seconds]) if rows[seconds] else np.empty((0, 2 * settings['harmonics']))
+        y = np.array(labels[seconds])
+        if len(set(y)) < 2:
+            print('Error: the', seconds, 's clips cover fewer than two instruments, there is nothing to compare')
+            sys.exit(1)
+        if arff_dir is not None:
+            os.makedirs(arff_dir, exist_ok=True)
+            write_arff(os.path.join(arff_dir, str(seconds) + 'datasetRaw.arff'), 'dataset', settings['harmonics'], X, y)
+        tasks.append((seconds, X, y, np.array(sources[seconds]), by_source))
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(min(num_workers, len(tasks))) as pool:
+        trained = pool.map(train_length, tasks)
+    print('Trained', len(trained), 'models in %.1fs' % (time.perf_counter() - start))
+    print()
+
+    results = []
+    for (seconds, X, _, _, _), result in zip(tasks, trained):
+        if models_dir is not None:
+            os.makedirs(models_dir, exist_ok=True)
+            with open(os.path.join(models_dir, str(seconds) + 'datasetRawModel.pkl'), 'wb') as f:
+                pickle.dump(result['model'], f)
+
+        extract_ms_per_s = 1000 * extract_time[seconds] / audio_secs
+        predict_ms_per_s = len(X) / audio_secs * result['predict_us_per_row'] / 1000
+        hop = hop_for(seconds, settings['overlap'])
+        results.append({'seconds': seconds, 'hop': hop if hop is not None else seconds, 'rows': len(X),
+                        'extract_s': round(extract_time[seconds], 3), 'extract_ms_per_s': round(extract_ms_per_s, 3),
+                        'train_s': round(result['train_s'], 3), 'accuracy': round(result['accuracy'], 4),
+                        'nodes': result['nodes'], 'predict_us_per_row': round(result['predict_us_per_row'], 3),
+                        'latency_ms_per_s': round(extract_ms_per_s + predict_ms_per_s, 3)})
+
+    return results
+
+def print_results(results):
+    print('Clip s    Hop s     Rows  Extract s  Extract ms/s  Train s  Accuracy  Nodes  Predict us/row  Latency ms/s')
+    for result in results:
+        print('%6g %8g %8d %10.2f %13.2f %8.2f %9.4f %6d %15.2f %13.2f' % (
+            result['seconds'], result['hop'], result['rows'], result['extract_s'], result['extract_ms_per_s'],
+            result['train_s'], result['accuracy'], result['nodes'], result['predict_us_per_row'],
+            result['latency_ms_per_s']))
+
+def write_results(filename, results):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        writer.writeheader()
+        writer.writerows(results)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='clipsweep.py', description='Extracts, trains and scores every clip length from one decode of the audio')
+    parser.add_argument('wavdir', help='Directory of full length wav files named <instrument>_<title>.wav, like the pipeline --from extract input')
+    parser.add_argument('--lengths', type=float, nargs='+', default=DEFAULT_LENGTHS, help='The clip lengths in seconds to compare')
+    parser.add_argument('--overlap', type=float, default=0, help='Fraction each clip overlaps the next, 0.5 starts a clip every half clip length. Defaults to back to back clips')
+    parser.add_argument('-r', '--harmonics', type=int, default=32, help='Number of harmonics to include in the fft')
+    parser.add_argument('-d', '--dbfs', type=int, default=-20, help='The db level each clip is normalized to')
+    parser.add_argument('--gatedb', type=float, default=-60, help='Clips quieter than this are skipped')
+    parser.add_argument('--dedupe', action='store_true', default=False, help='Skip exact duplicate clips within a file, as the pipeline targets do')
+    parser.add_argument('-w', '--workers', type=parse_max_processes, default='auto', help='Processes for extraction and training, auto uses one per cpu')
+    parser.add_argument('--bysource', action='store_true', default=False, help='Hold out whole recordings instead of random clips, so no test clip shares a recording with a training clip')
+    parser.add_argument('--arffdir', default=None, help='Also write each length\'s dataset here, named like the makefile names them')
+    parser.add_argument('--modeldir', default=None, help='Also save each length\'s model here, named like gen_model.py names them')
+    parser.add_argument('--results', default=DEFAULT_RESULTS, help='The csv the table is written to')
+    args = parser.parse_args()
+
+    if not 0 <= args.overlap < 1:
+        print('Error: --overlap must be at least 0 and less than 1')
+        sys.exit(1)
+
+    filenames = [row['path'] for row in sorted(list_inputs(args.wavdir), key=lambda row: row['size'], reverse=True)]
+    if not filenames:
+        print('Error: no wav files in', args.wavdir)
+        sys.exit(1)
+
+    settings = {'lengths': sorted(set(args.lengths)), 'harmonics': args.harmonics, 'dbfs': args.dbfs,
+                'gatedb': args.gatedb, 'overlap': args.overlap, 'dedupe': args.dedupe}
+    results = run_sweep(filenames, settings, initial_workers(args.workers), args.bysource, args.arffdir, args.modeldir)
+
+    print_results(results)
+    write_results(args.results, results)
+    print('Saved the table to', args.results)
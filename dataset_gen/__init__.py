@@ -0,0 +1,15 @@
+'''
+**************************************************************************************************
+* Filename:    __init__.py                                                                       *
+*                                                                                                *
+* Description: The dataset_gen modules import each other by their bare names, the way they are   *
+*              found when one of them is run as a script from this folder. Importing any of them *
+*              as dataset_gen.<module> from another folder runs this first, which puts this      *
+*              folder on sys.path so those imports resolve there too.                            *
+*                                                                                                *
+**************************************************************************************************
+'''
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
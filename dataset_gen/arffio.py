@@ -0,0 +1,632 @@
+'''
+**************************************************************************************************
+* Filename:    arffio.py                                                                         *
+*                                                                                                *
+* Description: Reads and writes the arff datasets used by dataset_gen, model_gen and cli_tool.   *
+*              Rows are written a block at a time straight from numpy arrays, and read back with *
+*              pandas' C parser directly into float arrays and instrument label codes, skipping  *
+*              scipy's arff parser and the byte string decoding that goes with it.               *
+*                                                                                                *
+*              Each row's pairs are sorted by amplitude, so the first k pairs of a dataset built *
+*              with more harmonics are exactly the row a k harmonic build would have produced.   *
+*              This holds for Normalized rows too since they are ratios to the first pair. The   *
+*              readers take number_harmonics to load only those leading columns, so one dataset  *
+*              extracted at the largest harmonic count serves every smaller one.                 *
+*                                                                                                *
+* Usage:       python3 arffio.py --bench <rows> [--harmonics <n>] [--tempfolder <dir>]           *
+*                                   [--noread]                                                   *
+*                   Times the old csv.writer / scipy.io.arff path and % formatting per row       *
+*                   against this module on a synthetic dataset of <rows> rows, and checks the    *
+*                   written text is the same as % per row gives                                  *
+*                                                                                                *
+**************************************************************************************************
+'''
+import os
+import re
+import sys
+import csv
+import time
+import filecmp
+import argparse
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import pandas as pd
+
+# How many rows are formatted and written in one go
+WRITE_BLOCK_ROWS = 65536
+# Largest %.Nf value times 10**N format_block scales itself. Below it the float product is within half a unit of the
+# exact one and rint rounds it the way % does, except next to a tie, which is checked for
+MAX_SCALED = 2 ** 53
+# Largest %d value format_block truncates itself, the uint64 digits it is written from hold anything smaller
+MAX_WHOLE = 2 ** 63
+# The formats format_block builds with numpy, any other format falls back to one % per row
+BLOCK_FORMAT = re.compile(r'^%(?:\.(\d)f|d)$')
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             attribute_names                                                              *
+*                                                                                                *
+* Parameters:       int number_harmonics - The number of harmonics in each row                   *
+*                                                                                                *
+* Returns:          str[] - The numeric attribute names, ampl1, freq1, ampl2, freq2, ...         *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def attribute_names(number_harmonics):
+    names = []
+    for i in range(1, number_harmonics+1):
+        names.append('ampl' + str(i))
+        names.append('freq' + str(i))
+
+    return names
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             make_header                                                                  *
+*                                                                                                *
+* Parameters:       str relation         - The relation name                                     *
+*                   int number_harmonics - The number of harmonics in each row                   *
+*                   str[] instruments    - The instruments in the dataset. None leaves the list  *
+*                                          off so it can be filled in later                      *
+*                                                                                                *
+* Returns:          str[] - The header lines, ending with @data                                  *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def make_header(relation, number_harmonics, instruments=None):
+    return make_named_header(relation, attribute_names(number_harmonics), instruments)
+
+# The same header for any list of numeric attributes, used for feature sets other than ampl/freq pairs
+def make_named_header(relation, names, instruments=None):
+    header_lines = ['@relation ' + relation + '\n']
+    for name in names:
+        header_lines.append('@attribute ' + name + ' numeric\n')
+
+    if instruments is None:
+        header_lines.append('@attribute instrument\n')
+    else:
+        header_lines.append('@attribute instrument {' + ','.join(sorted(instruments)) + '}\n')
+
+    header_lines.append('@data\n')
+
+    return header_lines
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             read_header                                                                  *
+*                                                                                                *
+* Parameters:       str filename - The arff file to read the header of                           *
+*                                                                                                *
+* Returns:          str[], str[], int - The attribute names, the instruments listed in the       *
+*                                       header (None if there is no list) and the number of      *
+*                                       lines up to and including @data                          *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def read_header(filename):
+    names = []
+    classes = None
+    num_lines = 0
+
+    with open(filename, 'r') as f:
+        for line in f:
+            num_lines += 1
+            line = line.strip()
+
+            if line.lower().startswith('@attribute'):
+                parts = line.split(None, 2)
+                names.append(parts[1])
+                # Nominal attribute, this is the list of instruments
+                if len(parts) > 2 and parts[2].startswith('{'):
+                    classes = [inst.strip() for inst in parts[2].strip('{}').split(',') if inst.strip()]
+            elif line.lower() == '@data':
+                break
+
+    return names, classes, num_lines
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             feature_formats                                                              *
+*                                                                                                *
+* Parameters:       int number_harmonics - The number of harmonics in each row                   *
+*                   bool normalize       - If the rows are ratios to the fundamental             *
+*                                                                                                *
+* Purpose:          Raw frequencies are whole bin numbers, so they are written without decimals *
+*                   everything else gets 6 decimal places like the old round(x, 6) rows          *
+*                                                                                                *
+* Returns:          str[] - A printf style format for each numeric column                        *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def feature_formats(number_harmonics, normalize=False):
+    if normalize:
+        return ['%.6f'] * (2 * number_harmonics)
+
+    return ['%.6f', '%d'] * number_harmonics
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             write_rows                                                                   *
+*                                                                                                *
+* Parameters:       file outfile       - An open text file positioned after the header           *
+*                   np.array features  - 2d array of numeric attributes, one row per sample      *
+*                   str[] labels       - The instrument of each row                              *
+*                   str[] fmt          - printf style format per column, see feature_formats     *
+*                                                                                                *
+* Purpose:          Writes the data rows a block at a time, each block formatted by format_block *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def write_rows(outfile, features, labels, fmt=None):
+    features = np.asarray(features, dtype=np.float64)
+    if len(features) == 0:
+        return
+
+    if fmt is None:
+        fmt = ['%.6f'] * features.shape[1]
+
+    labels = np.asarray(labels, dtype=str)
+    for start in range(0, len(features), WRITE_BLOCK_ROWS):
+        outfile.write(format_block(features[start:start + WRITE_BLOCK_ROWS], labels[start:start + WRITE_BLOCK_ROWS], fmt))
+
+# Two ascii digits packed in a little endian uint16 for every number 0 to 99, tens digit first in memory. The
+# second hundred are the same pairs as leading digits, with zero bytes in place of the leading zeros
+DIGIT_PAIRS = np.array([(48 + n // 10) | ((48 + n % 10) << 8) for n in range(100)] +
+                       [(48 + n // 10 if n >= 10 else 0) | ((48 + n % 10 if n > 0 else 0) << 8) for n in range(100)],
+                       dtype='<u2')
+
+# The decimal digits of q, an unsigned integer array, as ascii codes along a new last axis. width must be even,
+# the digits are made two at a time. With blank the leading zeros are zero bytes, but the units digit stays
+def digit_bytes(q, width, blank=False):
+    pairs = np.empty(q.shape + (width // 2,), dtype='<u2')
+    for pos in range(width // 2 - 1, -1, -1):
+        q, pair = np.divmod(q, q.dtype.type(100))
+        if blank:
+            pair += (q == 0) * q.dtype.type(100)
+        pairs[..., pos] = DIGIT_PAIRS[pair]
+        if blank and pos == width // 2 - 1:
+            pairs[..., pos] |= np.uint16(48 << 8)
+    return pairs.view(np.uint8)
+
+# The block with one % per row, what format_block falls back to
+def percent_rows(features, labels, fmt):
+    row_fmt = ','.join(fmt) + ',%s\n'
+    return ''.join([row_fmt % (*row, label) for row, label in zip(features.tolist(), labels)])
+
+def unsigned(values):
+    return values.astype(np.uint32 if values.max(initial=0) < 2 ** 32 else np.uint64)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             format_block                                                                 *
+*                                                                                                *
+* Parameters:       np.array features  - 2d float array of numeric attributes                    *
+*                   np.array labels    - The instrument of each row                              *
+*                   str[] fmt          - printf style format per column                          *
+*                                                                                                *
+* Purpose:          Formats a block of rows with numpy instead of a % per row. Every %.Nf column *
+*                   is scaled to an integer, every %d column truncated, and their digits are     *
+*                   written into one byte matrix with a fixed width per column kind. Unused      *
+*                   leading digit places are left as zero bytes, which are dropped at the end.   *
+*                   The text is the same as % per row gives, byte for byte. Blocks with nan or   *
+*                   inf, values too large to scale exactly or other formats use % per row        *
+*                                                                                                *
+* Returns:          str - The data lines of the block                                            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def format_block(features, labels, fmt):
+    matches = [BLOCK_FORMAT.match(col_fmt) for col_fmt in fmt]
+    if not all(matches) or not np.isfinite(features).all():
+        return percent_rows(features, labels, fmt)
+
+    rows, cols = features.shape
+    places = np.array([int(match.group(1)) if match.group(1) is not None else -1 for match in matches])
+    magnitude = np.abs(features)
+    label_bytes = np.char.encode(labels, 'utf-8')
+
+    # Every kind of column, %d columns and %.Nf columns grouped by N, gets one fixed width: sign, whole digits,
+    # then for %.Nf the point and N decimals, then the comma. Places that print nothing hold 0
+    kinds = []
+    widths = np.zeros(cols, dtype=np.int64)
+    for decimals in np.unique(places):
+        idx = np.flatnonzero(places == decimals)
+        if decimals < 0:
+            truncated = np.trunc(magnitude[:, idx])
+            if truncated.max(initial=0) >= MAX_WHOLE:
+                return percent_rows(features, labels, fmt)
+            whole = unsigned(truncated)
+            fraction = None
+            minus = (features[:, idx] < 0) & (whole > 0)
+        else:
+            product = magnitude[:, idx] * 10.0 ** decimals
+            if product.max(initial=0) >= MAX_SCALED:
+                return percent_rows(features, labels, fmt)
+            # product is off from the exact value by at most product * 2**-53, so rint rounds it the way % rounds
+            # the exact value unless it is about that close to a tie. The few that are get their digits from %
+            scaled = np.rint(product)
+            near_tie = np.abs(np.abs(product - scaled) - 0.5) <= (product + 1) * 2.0 ** -52
+            tie_rows, tie_cols = np.nonzero(near_tie)
+            scaled[tie_rows, tie_cols] = [int(('%.*f' % (int(decimals), value)).replace('.', ''))
+                                          for value in magnitude[tie_rows, idx[tie_cols]].tolist()]
+            scaled = unsigned(scaled)
+            whole, fraction = np.divmod(scaled, scaled.dtype.type(10 ** decimals))
+            minus = np.signbit(features[:, idx])
+
+        whole_width = len(str(int(whole.max(initial=0))))
+        whole_width += whole_width % 2
+        decimal_width = decimals + decimals % 2 if decimals > 0 else 0
+        widths[idx] = whole_width + decimal_width + 2 + (decimal_width > 0)
+        kinds.append((decimals, idx, whole, fraction, minus, whole_width, decimal_width))
+
+    starts = np.concatenate(([0], np.cumsum(widths)))
+    lines = np.empty((rows, starts[-1] + label_bytes.dtype.itemsize + 1), dtype=np.uint8)
+
+    for decimals, idx, whole, fraction, minus, whole_width, decimal_width in kinds:
+        # Columns of a kind that sit evenly spaced in the line, like the ampl/freq pairs, are written in
+        # place through a strided view. Any other layout is built apart and copied a column at a time
+        steps = np.diff(starts[idx])
+        evenly_spaced = len(idx) == 1 or (steps == steps[0]).all()
+        if evenly_spaced:
+            step = steps[0] if len(steps) else widths[idx[0]]
+            block = as_strided(lines[:, starts[idx[0]]:], shape=(rows, len(idx), widths[idx[0]]),
+                               strides=(lines.strides[0], step, 1), writeable=True)
+        else:
+            block = np.empty((rows, len(idx), widths[idx[0]]), dtype=np.uint8)
+
+        block[..., 0] = np.where(minus, 45, 0)
+        block[..., 1:1 + whole_width] = digit_bytes(whole, whole_width, blank=True)
+
+        if decimal_width > 0:
+            block[..., 1 + whole_width] = 46
+            block[..., 2 + whole_width:-1] = digit_bytes(fraction, decimal_width)
+            # An odd N makes one more decimal place than it prints, its leading 0
+            if decimals % 2:
+                block[..., 2 + whole_width] = 0
+        block[..., -1] = 44
+
+        if not evenly_spaced:
+            for col, col_block in zip(idx, np.moveaxis(block, 1, 0)):
+                lines[:, starts[col]:starts[col + 1]] = col_block
+
+    lines[:, starts[-1]:-1] = label_bytes.view(np.uint8).reshape(rows, label_bytes.dtype.itemsize)
+    lines[:, -1] = 10
+
+    return lines[lines != 0].tobytes().decode('utf-8')
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             write_arff                                                                   *
+*                                                                                                *
+* Parameters:       str filename         - The arff file to create                               *
+*                   str relation         - The relation name                                     *
+*                   int number_harmonics - The number of harmonics in each row                   *
+*                   np.array features    - 2d array of numeric attributes, one row per sample    *
+*                   str[] labels         - The instrument of each row                            *
+*                   bool normalize       - If the rows are ratios to the fundamental             *
+*                                                                                                *
+* Purpose:          Writes a whole arff file, header included                                    *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def write_arff(filename, relation, number_harmonics, features, labels, normalize=False):
+    with open(filename, 'w') as outfile:
+        outfile.writelines(make_header(relation, number_harmonics, set(labels)))
+        write_rows(outfile, features, labels, feature_formats(number_harmonics, normalize))
+
+def stored_harmonics(names):
+    # The last attribute is the instrument, the rest are ampl/freq pairs
+    return (len(names) - 1) // 2
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             harmonic_columns                                                             *
+*                                                                                                *
+* Parameters:       str[] names          - Every attribute name in the file                      *
+*                   int number_harmonics - How many harmonics to keep. None keeps all of them    *
+*                                                                                                *
+* Returns:          str[] - The leading ampl/freq columns for number_harmonics and the           *
+*                           instrument column                                                    *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def harmonic_columns(names, number_harmonics=None):
+    if number_harmonics is None or number_harmonics >= stored_harmonics(names):
+        return names
+
+    return names[:2 * number_harmonics] + [names[-1]]
+
+def column_dtypes(names, dtype=np.float64):
+    dtypes = {name: dtype for name in names[:-1]}
+    dtypes[names[-1]] = str
+
+    return dtypes
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             read_arff_frame                                                              *
+*                                                                                                *
+* Parameters:       str filename               - The arff file to read                           *
+*                   str[] enabled_instruments  - Only keep these instruments, ['all'] for all    *
+*                   int number_harmonics       - Only read this many leading harmonics. None     *
+*                                                reads every harmonic in the file                *
+*                                                                                                *
+* Purpose:          Reads the data section with pandas' C parser. Expects a cleaned file         *
+*                                                                                                *
+* Returns:          pd.DataFrame - The rows with the instrument as a str in the last column      *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def read_arff_frame(filename, enabled_instruments = ['all'], number_harmonics=None):
+    names, _, header_len = read_header(filename)
+    usecols = harmonic_columns(names, number_harmonics)
+
+    df = pd.read_csv(filename, skiprows=header_len, header=None, names=names, usecols=usecols, # type: ignore
+                     dtype=column_dtypes(usecols), engine='c')
+    if enabled_instruments != ['all']:
+        df = df[df[names[-1]].isin(enabled_instruments)]
+
+    return df
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             read_arff                                                                    *
+*                                                                                                *
+* Parameters:       str filename               - The arff file to read                           *
+*                   str[] enabled_instruments  - Only keep these instruments, ['all'] for all    *
+*                   dtype dtype                - The float type of the returned features         *
+*                   int number_harmonics       - Only read this many leading harmonics. None     *
+*                                                reads every harmonic in the file                *
+*                                                                                                *
+* Purpose:          Reads an arff dataset straight into arrays ready for sklearn                 *
+*                                                                                                *
+* Returns:          np.array, np.array, str[] - The features, an int label code per row and the  *
+*                                               instrument each code stands for                  *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def read_arff(filename, enabled_instruments = ['all'], dtype=np.float64, number_harmonics=None):
+    names, classes, header_len = read_header(filename)
+    usecols = harmonic_columns(names, number_harmonics)
+
+    dtypes = column_dtypes(usecols, dtype)
+    dtypes[names[-1]] = 'category'
+    df = pd.read_csv(filename, skiprows=header_len, header=None, names=names, usecols=usecols, dtype=dtypes, # type: ignore
+                     engine='c')
+
+    labels = df[names[-1]]
+    if enabled_instruments != ['all']:
+        keep = labels.isin(enabled_instruments).values
+        df = df[keep]
+        labels = labels[keep]
+
+    if classes is None:
+        classes = sorted(labels.cat.categories)
+    if enabled_instruments != ['all']:
+        classes = [inst for inst in classes if inst in enabled_instruments]
+    labels = labels.cat.set_categories(classes)
+
+    return df.iloc[:, :-1].to_numpy(dtype=dtype), labels.cat.codes.to_numpy(), list(classes)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             iter_arff_chunks                                                             *
+*                                                                                                *
+* Parameters:       str filename               - The arff file to read                           *
+*                   int chunk_size             - Rows per chunk                                  *
+*                   str[] enabled_instruments  - Only keep these instruments, ['all'] for all    *
+*                   int number_harmonics       - Only read this many leading harmonics. None     *
+*                                                reads every harmonic in the file                *
+*                                                                                                *
+* Purpose:          Reads the data section a chunk at a time so the whole file never has to be   *
+*                   in memory. Rows with missing values are dropped                              *
+*                                                                                                *
+* Returns:          generator of (np.array, np.array) - The features and instrument of each row *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def iter_arff_chunks(filename, chunk_size, enabled_instruments = ['all'], number_harmonics=None):
+    names, _, header_len = read_header(filename)
+    usecols = harmonic_columns(names, number_harmonics)
+
+    reader = pd.read_csv(filename, skiprows=header_len, header=None, names=names, usecols=usecols, # type: ignore
+                         dtype=column_dtypes(usecols), chunksize=chunk_size, engine='c')
+    for chunk in reader:
+        chunk = chunk.dropna()
+        if enabled_instruments != ['all']:
+            chunk = chunk[chunk[names[-1]].isin(enabled_instruments)]
+
+        yield chunk.iloc[:, :-1].values, chunk.iloc[:, -1].values
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             find_classes                                                                 *
+*                                                                                                *
+* Parameters:       str filename   - The arff file or headerless csv to look in                  *
+*                   int chunk_size - Rows read at a time if the labels have to be scanned        *
+*                   int skiprows   - Lines before the data. None reads them from the arff header *
+*                                                                                                *
+* Returns:          str[] - The instruments in the file. Taken from the header when it lists    *
+*                           them, otherwise only the label column is read to find them           *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def find_classes(filename, chunk_size=1000000, skiprows=None):
+    if skiprows is None:
+        names, classes, skiprows = read_header(filename)
+        if classes:
+            return classes
+        label_col = len(names) - 1
+    else:
+        # Headerless csv, the label is the last field of the first row
+        with open(filename, 'r') as f:
+            first = f.readline()
+        if not first:
+            return []
+        label_col = first.count(',')
+
+    seen_insts = set()
+    reader = pd.read_csv(filename, skiprows=skiprows, header=None, usecols=[label_col], dtype=str, # type: ignore
+                         chunksize=chunk_size, engine='c')
+    for chunk in reader:
+        seen_insts.update(chunk.iloc[:, 0].dropna().unique())
+
+    return sorted(seen_insts)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             is_bad_row                                                                   *
+*                                                                                                *
+* Parameters:       str line    - A data line from an arff file                                  *
+*                   int numcols - The number of attributes in the header                         *
+*                                                                                                *
+* Purpose:          A row is bad when it is short, or its first amplitude is 0 or nan. Those     *
+*                   come from silence or clips without enough audio for a full FFT               *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def is_bad_row(line, numcols):
+    fields = line.rstrip('\n').split(',')
+    if len(fields) != numcols:
+        return True
+
+    try:
+        first = float(fields[0])
+    except ValueError:
+        return True
+
+    return first == 0.0 or first != first # nan is the only value not equal to itself
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             benchmark                                                                    *
+*                                                                                                *
+* Parameters:       int num_rows         - Rows in the synthetic dataset                         *
+*                   int number_harmonics - Harmonics per row                                     *
+*                   str tempfolder       - Where to put the benchmark files                      *
+*                   bool read            - Also time the readers. scipy.io.arff needs several GB *
+*                                          for a few million rows                                *
+*                                                                                                *
+* Purpose:          Times the old round()/csv.writer writer, one % per row and scipy.io.arff     *
+*                   against write_rows and read_arff on the same data and prints the results.    *
+*                   Also checks write_rows prints the same text as % per row, on the data and on *
+*                   values of every magnitude it scales itself, exact ties included              *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def benchmark(num_rows, number_harmonics=32, tempfolder='arffbench/', read=True):
+    from scipy.io import arff
+
+    os.makedirs(tempfolder, exist_ok=True)
+    rng = np.random.default_rng(0)
+
+    features = np.empty((num_rows, 2 * number_harmonics))
+    features[:, 0::2] = rng.random((num_rows, number_harmonics)) * 2000000
+    features[:, 1::2] = rng.integers(1, 2000, (num_rows, number_harmonics))
+    instruments = ['violin', 'trumpet', 'tuba', 'flute', 'chello']
+    labels = np.array(instruments)[rng.integers(0, len(instruments), num_rows)]
+    header = make_header('bench', number_harmonics, instruments)
+
+    old_filename = tempfolder + 'old.arff'
+    new_filename = tempfolder + 'new.arff'
+    results = []
+
+    # The write path extractFreqARFF used, one round() and list extend per value then csv.writer per row
+    start = time.perf_counter()
+    with open(old_filename, 'w') as outfile:
+        outfile.writelines(header)
+        outcsv = csv.writer(outfile)
+        # A block of rows at a time so millions of rows are never python floats all at once
+        for block_start in range(0, num_rows, WRITE_BLOCK_ROWS):
+            block = features[block_start:block_start + WRITE_BLOCK_ROWS].tolist()
+            for row, label in zip(block, labels[block_start:block_start + WRITE_BLOCK_ROWS]):
+                data_row = []
+                for idx in range(0, len(row), 2):
+                    data_row.extend([round(row[idx], 6), round(int(row[idx + 1]), 6)])
+                data_row.extend([label])
+                outcsv.writerow(data_row)
+    results.append(['write', 'csv.writer', time.perf_counter() - start])
+
+    # The row at a time % formatting write_rows used before format_block
+    start = time.perf_counter()
+    with open(old_filename, 'w') as outfile:
+        outfile.writelines(header)
+        row_fmt = ','.join(feature_formats(number_harmonics)) + ',%s\n'
+        for block_start in range(0, num_rows, WRITE_BLOCK_ROWS):
+            block = features[block_start:block_start + WRITE_BLOCK_ROWS].tolist()
+            outfile.writelines([row_fmt % (*row, label) for row, label in
+                                zip(block, labels[block_start:block_start + WRITE_BLOCK_ROWS])])
+    results.append(['write', '% per row', time.perf_counter() - start])
+
+    start = time.perf_counter()
+    with open(new_filename, 'w') as outfile:
+        outfile.writelines(header)
+        write_rows(outfile, features, labels, feature_formats(number_harmonics))
+    results.append(['write', 'arffio.write_rows', time.perf_counter() - start])
+
+    # The read path gen_model and classinst used
+    if read:
+        start = time.perf_counter()
+        data, meta = arff.loadarff(old_filename)
+        df = pd.DataFrame(data)
+        df.columns = meta.names()
+        for column in df.columns:
+            if df[column].dtype == object:
+                df[column] = df[column].str.decode('utf-8')
+        old_X = df.iloc[:, :-1].values
+        results.append(['read', 'scipy.io.arff', time.perf_counter() - start])
+
+    start = time.perf_counter()
+    new_X, codes, classes = read_arff(new_filename)
+    results.append(['read', 'arffio.read_arff', time.perf_counter() - start])
+
+    # The paths should agree on the data
+    if read:
+        assert np.allclose(old_X, new_X)
+    assert np.allclose(np.trunc(features[:, 1::2]), new_X[:, 1::2]) and np.allclose(features[:, 0::2], new_X[:, 0::2])
+    assert (np.array(classes)[codes] == labels).all()
+
+    # The % per row file was written last to old_filename
+    assert filecmp.cmp(old_filename, new_filename, shallow=False)
+    sweep_rows = min(num_rows, WRITE_BLOCK_ROWS)
+    sweep = 10.0 ** rng.uniform(-12, np.log10(MAX_SCALED / 1e6), (sweep_rows, 2 * number_harmonics))
+    sweep *= rng.choice([-1.0, 1.0], sweep.shape)
+    sweep[:, 0] = (rng.integers(0, 10 ** 9, sweep_rows) + 0.5) / 10.0 ** rng.integers(0, 10, sweep_rows)
+    sweep_fmt = feature_formats(number_harmonics)
+    assert format_block(sweep, labels[:sweep_rows], sweep_fmt) == percent_rows(sweep, labels[:sweep_rows], sweep_fmt)
+
+    print('Rows:', num_rows, 'Harmonics:', number_harmonics)
+    print('=================================')
+    for op, path, seconds in results:
+        print(op.ljust(6), path.ljust(20), '%.2fs' % seconds, '%.0f rows/s' % (num_rows / seconds))
+
+    os.remove(old_filename)
+    os.remove(new_filename)
+
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='arffio.py', description='Benchmarks the arff reader and writer')
+    parser.add_argument('--bench', type=int, required=True, help='Number of rows in the benchmark dataset')
+    parser.add_argument('-r', '--harmonics', type=int, default=32, help='Harmonics per row')
+    parser.add_argument('-p', '--tempfolder', default='arffbench/', help='Where to write the benchmark files')
+    parser.add_argument('--noread', action='store_true', default=False, help='Skip the scipy.io.arff read, which runs out of memory on millions of rows')
+
+    args = parser.parse_args()
+    benchmark(args.bench, args.harmonics, args.tempfolder, not args.noread)
+    sys.exit()
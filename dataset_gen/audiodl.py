@@ -20,15 +20,15 @@
 * ********************************************************************************************** *
 '''
 from pytube import YouTube
-import tqdm
 
 import csv
 import base64
 import os
 import sys
-import subprocess
 import datetime
 
+from procpool import run_commands, parse_max_processes # pyright: ignore
+
 '''
 * ********************************************************************************************** *
 *                                                                                                *
@@ -41,6 +41,8 @@ import datetime
 * Purpose:          Downloads the audio of a YouTube video, and tags the filename with the passed*
 *                   in instrument name                                                           *
 *                                                                                                *
+* Returns:          str - The path of the downloaded file, None if the download failed           *
+*                                                                                                *
 * ********************************************************************************************** *
 '''
 def download_audio(link, instrument, outdir):
@@ -51,9 +53,10 @@ def download_audio(link, instrument, outdir):
         #print('Downloading:', row[0], video.title) #type: ignore
         
         outfilename = instrument + '_' + base64.urlsafe_b64encode(video.title.encode()).decode('UTF-8') #type: ignore 
-        video.download(filename=outfilename + '.mp4', output_path=outdir) #type: ignore 
+        return video.download(filename=outfilename + '.mp4', output_path=outdir) #type: ignore 
     except:
         print('Failed to download ', link)
+        return None
 
 '''
 * ********************************************************************************************** *
@@ -63,7 +66,8 @@ def download_audio(link, instrument, outdir):
 * Parameters:       csv.reader csv    - csv containg 2 columns: Instrument, the tagged instrument*
 *                                       and Link, the YouTube link                               *
 *                   str outdir        - The folder to place the download file in                 *
-*                   int max_processes - The maximum number of subprocesses allowed to exist      *
+*                   max_processes     - The maximum number of subprocesses allowed to exist, or  *
+*                                       'auto' to adjust it while downloading (see procpool.py)  *
 *                                                                                                *
 * Purpose:          Downloads the audio of all YouTube videos in the csv, then tags all of their *
 *                   filenames.                                                                   *
@@ -82,32 +86,13 @@ def download_audios(csv, outdir, max_processes):
     if not os.path.exists(outdir):
         os.mkdir(outdir)
     
-    processes = []
     commands = []
 
     for row in csv:
         commands.append(dl_cmd + " " + '"' + row[1] + '"' + " " + row[0] + " " + outdir)
 
-    pbar = tqdm.tqdm(desc='Downloading audio', total=len(commands))
-
-    conversion_num = 0
-    while commands: 
-        # Fill up the currently running processes to the max allowed
-        while len(processes) < max_processes and commands:
-            processes.append(subprocess.Popen(commands.pop(), shell=True))
-        
-        completed_processes = []     
-        for process in processes:
-            if process.poll() is not None:
-                completed_processes.append(process)
-                conversion_num += 1
-                pbar.update(1)
-        
-        for process in completed_processes:
-            processes.remove(process) 
-    
-    for process in processes:
-        process.wait()
+    # Downloads mostly wait on the network, so 'auto' may run many more of them than there are cpus
+    run_commands(commands, max_processes, 'Downloading audio')
 
 
 __USAGE__ = 'python3 audiodl.py <csv> <outdir> <max_proccesses>'\
@@ -128,7 +113,7 @@ if __name__ == "__main__":
         inheader = incsv.__next__();
         # inst_i = inheader.index('Instrument')
         # link_i = inheader.index('Link')
-        download_audios(incsv, argv[2], int(argv[3]))
+        download_audios(incsv, argv[2], parse_max_processes(argv[3]))
 
         infile.close()
     else:
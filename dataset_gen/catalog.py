@@ -0,0 +1,362 @@
+'''
+**************************************************************************************************
+* Filename:    catalog.py                                                                        *
+*                                                                                                *
+* Description: A SQLite catalog of the source recordings and the clips cut from them, so counts  *
+*              per instrument or per video are a query instead of a walk over millions of files  *
+*              and a split of every filename. Stages record into it from the manifests they      *
+*              write (manifest.py) once they finish, so only one process ever writes to it.      *
+*                                                                                                *
+*              sources - One row per recording: its name, instrument, the video title decoded    *
+*                        from the filename audiodl.py gave it, duration, samplerate and the last *
+*                        stage it went through                                                   *
+*              clips   - One row per clip per stage: the folder it is in, its source recording,  *
+*                        its offset into that recording, duration, instrument and dBFS level     *
+*                                                                                                *
+*              The indexes cover clip counts per instrument, sampling the same number of clips   *
+*              of every instrument and train/test splits that keep every clip of a video on the  *
+*              same side, so clips of one recording never end up in both.                        *
+*                                                                                                *
+* Usage:       python3 catalog.py record <catalog> <stage> <folder>                              *
+*                   Adds the clips listed in the folder's manifest, replacing any it already had *
+*                   for that folder                                                              *
+*                                                                                                *
+*              python3 catalog.py counts <catalog> <folder>                                      *
+*                   Prints the clips and videos of each instrument in the folder                 *
+*                                                                                                *
+*              python3 catalog.py sources <catalog>                                              *
+*                   Prints every recording with its instrument, length and status                *
+*                                                                                                *
+*              python3 catalog.py sample <catalog> <folder> <clips per instrument> <outfile>     *
+*                   Writes a manifest of a random, instrument balanced sample of the folder      *
+*                                                                                                *
+*              python3 catalog.py split <catalog> <folder> <test fraction> <train> <test>        *
+*                   Writes train and test manifests with each video's clips all on one side      *
+*                                                                                                *
+*              The manifests written can be handed to extractFreqARFF.py -b --inputs. Manifests  *
+*              can only list a clip pack a whole shard at a time, so sample and split need a     *
+*              folder of wav clips                                                               *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import base64
+import random
+import sqlite3
+
+from manifest import iter_manifest, manifest_filename, write_manifest # pyright: ignore
+from clippack import is_shard, read_shard_index # pyright: ignore
+
+CATALOG_NAME = 'catalog.db'
+# Seed for sample and split, so the same catalog gives the same sets
+DEFAULT_SEED = 0
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    label TEXT NOT NULL,
+    title TEXT,
+    duration REAL,
+    samplerate INTEGER,
+    status TEXT
+);
+
+CREATE TABLE IF NOT EXISTS clips (
+    id INTEGER PRIMARY KEY,
+    folder TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    source_id INTEGER REFERENCES sources(id),
+    offset REAL,
+    duration REAL,
+    label TEXT NOT NULL,
+    dbfs REAL
+);
+
+-- Counts per instrument and the videos of each instrument are answered from this index alone
+CREATE INDEX IF NOT EXISTS clips_folder_label_source ON clips (folder, label, source_id);
+CREATE INDEX IF NOT EXISTS clips_source ON clips (source_id);
+'''
+
+def open_catalog(filename):
+    conn = sqlite3.connect(filename)
+    conn.executescript(SCHEMA)
+
+    return conn
+
+# Clips are kept per folder, the same stage can be run for more than one clip length
+def folder_key(folder):
+    return os.path.abspath(folder)
+
+# The video title audiodl.py encoded into the filename, <instrument>_<base64 title>. None when it is not one
+def decode_title(name):
+    parts = os.path.splitext(name)[0].split('_', 1)
+    if len(parts) < 2:
+        return None
+
+    try:
+        return base64.urlsafe_b64decode(parts[1].encode()).decode('UTF-8')
+    except ValueError:
+        return None
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             source_id                                                                    *
+*                                                                                                *
+* Parameters:       sqlite3.Connection conn  - The open catalog                                  *
+*                   dict ids                 - Source name to id of the sources seen so far      *
+*                   str name                 - The recording's file name                         *
+*                   str label                - The recording's instrument                        *
+*                                                                                                *
+* Purpose:          Looks up the id of a source recording, adding it if the catalog does not     *
+*                   have it yet. ids saves going back to the database for every clip             *
+*                                                                                                *
+* Returns:          int - The id, None for clips without a source                                *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def source_id(conn, ids, name, label):
+    if not name:
+        return None
+
+    if name not in ids:
+        conn.execute('INSERT OR IGNORE INTO sources (name, label, title) VALUES (?, ?, ?)',
+                     (name, label, decode_title(name)))
+        ids[name] = conn.execute('SELECT id FROM sources WHERE name = ?', (name,)).fetchone()[0]
+
+    return ids[name]
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             record_sources                                                               *
+*                                                                                                *
+* Parameters:       str filename   - The catalog                                                 *
+*                   [dict] rows    - Manifest rows of full length recordings                     *
+*                   str status     - The stage they are going through                            *
+*                                                                                                *
+* Purpose:          Adds or updates the recordings with their length and samplerate              *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def record_sources(filename, rows, status):
+    conn = open_catalog(filename)
+    with conn:
+        for row in rows:
+            name = os.path.basename(row['path'])
+            conn.execute('INSERT OR IGNORE INTO sources (name, label, title) VALUES (?, ?, ?)',
+                         (name, row['label'], decode_title(name)))
+            conn.execute('UPDATE sources SET duration = ?, samplerate = ?, status = ? WHERE name = ?',
+                         (row['duration'], row['samplerate'], status, name))
+    conn.close()
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             record_stage                                                                 *
+*                                                                                                *
+* Parameters:       str filename   - The catalog                                                 *
+*                   str stage      - The stage that wrote the folder, like split or normalize    *
+*                   str folder     - The stage's output folder, read through its manifest        *
+*                                                                                                *
+* Purpose:          Replaces the catalog's clips for the folder with the ones in its manifest,   *
+*                   a chunk of the manifest at a time. Clip packs are listed in the manifest by  *
+*                   shard, their clips come from the shard indexes. Every source seen gets its   *
+*                   status set to the stage                                                      *
+*                                                                                                *
+* Returns:          int - The number of clips recorded                                           *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def record_stage(filename, stage, folder):
+    conn = open_catalog(filename)
+    key = folder_key(folder)
+    ids = {}
+    num_clips = 0
+
+    with conn:
+        conn.execute('DELETE FROM clips WHERE folder = ?', (key,))
+
+        for chunk in iter_manifest(manifest_filename(folder)):
+            clips = []
+            for row in chunk:
+                if is_shard(row['path']):
+                    # name, offset, length, source, label, samplerate. Offsets into the recording are not kept in a pack
+                    for entry in read_shard_index(row['path']):
+                        clips.append((key, stage, entry[0], row['path'], source_id(conn, ids, entry[3], entry[4]), None,
+                                      entry[2] / entry[5], entry[4], None))
+                    continue
+
+                clips.append((key, stage, os.path.basename(row['path']), row['path'],
+                              source_id(conn, ids, row['source'], row['label']), row['offset'], row['duration'],
+                              row['label'], row['dbfs']))
+
+            conn.executemany('INSERT INTO clips (folder, stage, name, path, source_id, offset, duration, label, dbfs) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', clips)
+            num_clips += len(clips)
+
+        conn.executemany('UPDATE sources SET status = ? WHERE id = ?', [(stage, idx) for idx in ids.values()])
+
+    conn.close()
+    return num_clips
+
+# Clips and videos of each instrument in the folder, most clips first
+def label_counts(conn, folder):
+    return conn.execute('SELECT label, COUNT(*), COUNT(DISTINCT source_id) FROM clips WHERE folder = ? '
+                        'GROUP BY label ORDER BY COUNT(*) DESC', (folder_key(folder),)).fetchall()
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             balanced_sample                                                              *
+*                                                                                                *
+* Parameters:       sqlite3.Connection conn  - The open catalog                                  *
+*                   str folder               - The folder to sample                              *
+*                   int per_label            - Clips to take from each instrument. Instruments   *
+*                                              with fewer give all they have                     *
+*                   int seed                 - Seed for the sample                               *
+*                                                                                                *
+* Purpose:          Draws the same number of clips from every instrument so a model is not       *
+*                   trained mostly on whichever instrument has the most videos                   *
+*                                                                                                *
+* Returns:          [dict] - Manifest rows of the clips drawn                                    *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def balanced_sample(conn, folder, per_label, seed=DEFAULT_SEED):
+    rng = random.Random(seed)
+    key = folder_key(folder)
+
+    rows = []
+    for label, _, _ in label_counts(conn, folder):
+        ids = [row[0] for row in conn.execute('SELECT id FROM clips WHERE folder = ? AND label = ?', (key, label))]
+        chosen = sorted(rng.sample(ids, min(per_label, len(ids))))
+        rows.extend(clip_rows(conn, chosen))
+
+    return rows
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             group_split                                                                  *
+*                                                                                                *
+* Parameters:       sqlite3.Connection conn  - The open catalog                                  *
+*                   str folder               - The folder to split                               *
+*                   float test_fraction      - The share of each instrument's videos to test on  *
+*                   int seed                 - Seed for which videos are picked                  *
+*                                                                                                *
+* Purpose:          Splits by source video instead of by clip. Clips of one recording sound far  *
+*                   more alike than clips of two, so a clip level split puts near copies of the  *
+*                   test set in the training set and overstates the accuracy. Each instrument    *
+*                   with more than one video keeps at least one on each side                     *
+*                                                                                                *
+* Returns:          [dict], [dict] - Manifest rows of the train and the test clips               *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def group_split(conn, folder, test_fraction, seed=DEFAULT_SEED):
+    rng = random.Random(seed)
+    key = folder_key(folder)
+
+    sources = {}
+    for label, idx in conn.execute('SELECT DISTINCT label, source_id FROM clips WHERE folder = ? ORDER BY label, source_id',
+                                   (key,)):
+        sources.setdefault(label, []).append(idx)
+
+    test_sources = set()
+    for label, ids in sources.items():
+        rng.shuffle(ids)
+        num_test = round(len(ids) * test_fraction)
+        if len(ids) > 1:
+            num_test = min(max(num_test, 1), len(ids) - 1)
+        test_sources.update(ids[:num_test])
+
+    train = []
+    test = []
+    for idx, source in conn.execute('SELECT id, source_id FROM clips WHERE folder = ? ORDER BY id', (key,)):
+        (test if source in test_sources else train).append(idx)
+
+    return clip_rows(conn, train), clip_rows(conn, test)
+
+# Manifest rows for clip ids
+def clip_rows(conn, ids):
+    rows = []
+
+    for start in range(0, len(ids), 500):
+        chunk = ids[start : start + 500]
+        query = 'SELECT clips.path, clips.duration, clips.label, clips.offset, clips.dbfs, sources.name, ' \
+                'sources.samplerate FROM clips LEFT JOIN sources ON sources.id = clips.source_id ' \
+                'WHERE clips.id IN (' + ','.join('?' * len(chunk)) + ') ORDER BY clips.id'
+        for path, duration, label, offset, dbfs, source, samplerate in conn.execute(query, chunk):
+            rows.append({'path': path, 'size': os.path.getsize(path) if os.path.exists(path) else 0,
+                         'duration': duration, 'label': label, 'samplerate': samplerate, 'clips': 1,
+                         'source': source or '', 'offset': offset, 'dbfs': dbfs})
+
+    return rows
+
+def print_counts(filename, folder):
+    conn = open_catalog(filename)
+    counts = label_counts(conn, folder)
+    conn.close()
+
+    print(folder + ':', sum(count[1] for count in counts), 'clips')
+    for label, num_clips, num_sources in counts:
+        print('  ' + label.ljust(12), str(num_clips).rjust(10), 'clips from', num_sources, 'videos')
+
+def print_sources(filename):
+    conn = open_catalog(filename)
+    for name, label, title, duration, status in conn.execute('SELECT name, label, title, duration, status FROM sources '
+                                                             'ORDER BY label, name'):
+        print(label.ljust(12), (status or '').ljust(10), '%8.1fs' % (duration or 0), title or name)
+    conn.close()
+
+__USAGE__ = 'python3 catalog.py record <catalog> <stage> <folder>\n'\
+        'python3 catalog.py counts <catalog> <folder>\n'\
+        'python3 catalog.py sources <catalog>\n'\
+        'python3 catalog.py sample <catalog> <folder> <clips per instrument> <outfile>\n'\
+        'python3 catalog.py split <catalog> <folder> <test fraction> <train outfile> <test outfile>'
+
+if __name__ == '__main__':
+    argv = sys.argv
+    argc = len(argv)
+
+    if argc >= 4 and argv[1] in ['sample', 'split']:
+        conn = open_catalog(argv[2])
+        first = conn.execute('SELECT path FROM clips WHERE folder = ? LIMIT 1', (folder_key(argv[3]),)).fetchone()
+        conn.close()
+        if first is not None and is_shard(first[0]):
+            print('Error:', argv[3], 'is a clip pack, unpack it with clippack.py unpack and record that folder first')
+            sys.exit(1)
+
+    if argc == 5 and argv[1] == 'record':
+        print('Recorded', record_stage(argv[2], argv[3], argv[4]), 'clips from', argv[4], 'in', argv[2])
+    elif argc == 4 and argv[1] == 'counts':
+        print_counts(argv[2], argv[3])
+    elif argc == 3 and argv[1] == 'sources':
+        print_sources(argv[2])
+    elif argc == 6 and argv[1] == 'sample':
+        conn = open_catalog(argv[2])
+        rows = balanced_sample(conn, argv[3], int(argv[4]))
+        conn.close()
+
+        if os.path.exists(argv[5]):
+            os.remove(argv[5])
+        write_manifest(argv[5], rows)
+        print('Wrote', len(rows), 'clips to', argv[5])
+    elif argc == 7 and argv[1] == 'split':
+        conn = open_catalog(argv[2])
+        train, test = group_split(conn, argv[3], float(argv[4]))
+        conn.close()
+
+        for outfile, rows in [(argv[5], train), (argv[6], test)]:
+            if os.path.exists(outfile):
+                os.remove(outfile)
+            write_manifest(outfile, rows)
+            print('Wrote', len(rows), 'clips to', outfile)
+    else:
+        print(__USAGE__)
+        sys.exit(1)
@@ -18,11 +18,12 @@
 *                   <folder>    - The folder to clean arff files from                            *
 **************************************************************************************************
 '''
-import csv
 import sys
 import glob
 import os
 
+from arffio import read_header, is_bad_row # pyright: ignore
+
 __USAGE__ = "USAGE:"\
         "python3 cleandata.py <infile.arff> <outfile.arff> - cleans a single file"\
         "python3 cleandata.py <filesdir> - cleans all arff files in <filesdir>"
@@ -44,44 +45,28 @@ __USAGE__ = "USAGE:"\
 * ********************************************************************************************** *
 '''
 def clean_file(filename, outfilename):
-    file = open(filename, 'r')
-    header = []
-    numcols = 0
-
-    line = file.readline().strip()
-    while True:
-        header.append(line)
-        if line.startswith('@attribute'):
-            numcols += 1
+    names, _, header_len = read_header(filename)
+    numcols = len(names)
 
-        if line == '@data':
-            break
+    # Write to a temp file so cleaning in place never reads a half written file
+    tempfilename = outfilename + '.tmp'
+    num_removed = 0
 
+    with open(filename, 'r') as file, open(tempfilename, 'w') as outfile:
+        for _ in range(header_len):
+            outfile.write(file.readline())
 
-        line = file.readline().strip()
-    
-    incsv = csv.reader(file)
-    data = []
-    for row in incsv:
-        data.append(row) 
-
-    file.close()
-
-    # inCSV = csv.reader(file)
-    outfile = open(outfilename, 'w')
-    for line in header:
-        outfile.write(line + '\n')
-
-    outcsv = csv.writer(outfile)
-    
-    # excludes rows that have 0.0 ampl vals, nan, or all attributes are not filled 
-    for row in data:
-        if len(row) != numcols:
-            print('Short row:', row)
-        if row[0] != 'nan' and row[0] != '0.0' and len(row) == numcols:
-            outcsv.writerow(row)
+        # excludes rows that have 0.0 ampl vals, nan, or all attributes are not filled 
+        for line in file:
+            if not line.strip():
+                continue
+            if is_bad_row(line, numcols):
+                num_removed += 1
+                continue
+            outfile.write(line)
 
-    outfile.close()
+    os.replace(tempfilename, outfilename)
+    print('Removed', num_removed, 'bad rows from', filename)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,357 @@
+'''
+**************************************************************************************************
+* Filename:    clippack.py                                                                       *
+*                                                                                                *
+* Description: A packed store for split and normalized clips, so a dataset is a few hundred      *
+*              large files instead of millions of 0.1 second wavs. Globbing, copying to another  *
+*              host and running out of inodes stop being a problem.                              *
+*                                                                                                *
+*              A pack is a directory holding:                                                    *
+*                  _clippack.json    - Marks the directory as a pack                             *
+*                  <writer>_<n>.pcm  - Shards, the raw mono 16 bit samples of clip after clip    *
+*                  <writer>_<n>.csv  - The index of each shard, one line per clip:               *
+*                                      name,offset,length,source,label,samplerate                *
+*                                                                                                *
+*              offset and length are in samples. name is the filename the clip would have had   *
+*              as a wav, so clip names and instrument tags are the same either way. Every       *
+*              process writes its own shards, which are only renamed to .pcm/.csv once they are *
+*              closed, so many writers can share a pack and a reader never sees half a shard.   *
+*              Shards are read with np.memmap, one sequential pass per shard, and runs of clips *
+*              with the same length come back as one 2d array without copying.                   *
+*                                                                                                *
+*              splitaudio.py and normalizedb.py write packs with --pack. normalizedb.py,         *
+*              extractFreqARFF.py and spectrumcache.py read a pack wherever they read a folder   *
+*              of clips. A shard can be passed anywhere a list of clip files is taken.           *
+*                                                                                                *
+* Usage:       python3 clippack.py pack <wav folder> <pack dir>                                  *
+*                   Packs a folder of clips                                                      *
+*                                                                                                *
+*              python3 clippack.py unpack <pack dir> <wav folder>                                *
+*                   Writes every clip in the pack back out as a wav                              *
+*                                                                                                *
+*              python3 clippack.py info <pack dir>                                               *
+*                   Prints the number of shards, clips and clips per instrument                  *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import glob
+import csv
+import json
+import socket
+from collections import Counter
+
+import numpy as np
+import tqdm
+from scipy.io import wavfile
+
+PACK_INFO = '_clippack.json'
+SHARD_EXT = '.pcm'
+INDEX_EXT = '.csv'
+# Shards still being written, ignored by readers
+PART_EXT = '.part'
+INDEX_HEADER = ['name', 'offset', 'length', 'source', 'label', 'samplerate']
+# 256 MB is about 30000 clips of 0.1 seconds at 44.1 kHz
+SHARD_BYTES = 256 * 1024 * 1024
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             to_pcm16                                                                     *
+*                                                                                                *
+* Parameters:       np.array samples - Float samples in [-1, 1]                                  *
+*                                                                                                *
+* Purpose:          Quantizes samples the way soundfile does when splitaudio writes a 16 bit wav *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def to_pcm16(samples):
+    # Scaled by 32768 like libsndfile 1.1 and later, so 16 bit audio read as floats comes back exactly
+    return np.clip(np.round(np.asarray(samples, dtype=np.float64) * 32768), -32768, 32767).astype(np.int16)
+
+def is_pack(path):
+    return os.path.isfile(os.path.join(path, PACK_INFO))
+
+def is_shard(filename):
+    return filename.endswith(SHARD_EXT)
+
+def index_filename(shard):
+    return os.path.splitext(shard)[0] + INDEX_EXT
+
+def list_shards(pack_dir):
+    return sorted(glob.glob(os.path.join(pack_dir, '*' + SHARD_EXT)))
+
+# The shards of a pack, or the wavs of an ordinary folder of clips
+def list_clip_files(folder):
+    if is_pack(folder):
+        return list_shards(folder)
+
+    return glob.glob(folder + '*.wav')
+
+# The number of clips in a shard, or 1 for a wav
+def num_clips(filename):
+    if not is_shard(filename):
+        return 1
+
+    with open(index_filename(filename), 'r') as f:
+        return sum(1 for _ in f) - 1
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             open_writer                                                                  *
+*                                                                                                *
+* Parameters:       str pack_dir     - The pack to add clips to. Created if it does not exist    *
+*                   int shard_bytes  - Start a new shard once the current one is this big        *
+*                                                                                                *
+* Returns:          dict - The writer, pass it to write_clip and close_writer                    *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def open_writer(pack_dir, shard_bytes=SHARD_BYTES):
+    os.makedirs(pack_dir, exist_ok=True)
+
+    if not is_pack(pack_dir):
+        # Each process writes its own temp file so two writers starting at once do not collide
+        tempfilename = os.path.join(pack_dir, PACK_INFO + '.' + str(os.getpid()))
+        with open(tempfilename, 'w') as f:
+            json.dump({'dtype': 'int16', 'channels': 1}, f)
+        os.replace(tempfilename, os.path.join(pack_dir, PACK_INFO))
+
+    return {
+        'pack_dir': pack_dir,
+        # Unique to this process, so several processes and hosts can write to one pack
+        'prefix': socket.gethostname() + '_' + str(os.getpid()),
+        'shard_bytes': shard_bytes,
+        'shard_no': 0,
+        'shard': None,
+        'index': None,
+        'offset': 0,
+        # Every shard this writer has closed
+        'finished': [],
+    }
+
+def shard_basename(writer):
+    return os.path.join(writer['pack_dir'], '%s_%05d' % (writer['prefix'], writer['shard_no']))
+
+def start_shard(writer):
+    # Skip past shards left by an earlier process that had the same pid
+    while os.path.exists(shard_basename(writer) + SHARD_EXT):
+        writer['shard_no'] += 1
+
+    basename = shard_basename(writer)
+    writer['shard'] = open(basename + SHARD_EXT + PART_EXT, 'wb')
+    writer['index'] = open(basename + INDEX_EXT + PART_EXT, 'w', newline='')
+    csv.writer(writer['index']).writerow(INDEX_HEADER)
+    writer['offset'] = 0
+
+# Closes the current shard and moves it into place. Readers list the .pcm files, so it goes last
+def finish_shard(writer):
+    if writer['shard'] is None:
+        return
+
+    basename = shard_basename(writer)
+    writer['shard'].close()
+    writer['index'].close()
+    os.replace(basename + INDEX_EXT + PART_EXT, basename + INDEX_EXT)
+    os.replace(basename + SHARD_EXT + PART_EXT, basename + SHARD_EXT)
+
+    writer['shard'] = None
+    writer['index'] = None
+    writer['shard_no'] += 1
+    writer['finished'].append(basename + SHARD_EXT)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             write_clip                                                                   *
+*                                                                                                *
+* Parameters:       dict writer      - From open_writer                                          *
+*                   str name         - The filename the clip would have had as a wav             *
+*                   np.array samples - The clip as 16 bit mono samples                           *
+*                   int samplerate   - The sample rate of the clip                               *
+*                   str source       - The recording the clip came from                          *
+*                   str label        - The instrument of the clip                                *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def write_clip(writer, name, samples, samplerate, source, label):
+    if writer['shard'] is None:
+        start_shard(writer)
+
+    samples = np.ascontiguousarray(samples, dtype=np.int16)
+    writer['shard'].write(samples.tobytes())
+    csv.writer(writer['index']).writerow([name, writer['offset'], len(samples), os.path.split(source)[1], label,
+                                          samplerate])
+    writer['offset'] += len(samples)
+
+    if writer['offset'] * 2 >= writer['shard_bytes']:
+        finish_shard(writer)
+
+def close_writer(writer):
+    finish_shard(writer)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             read_shard_index                                                             *
+*                                                                                                *
+* Parameters:       str shard - The .pcm file of the shard                                       *
+*                                                                                                *
+* Returns:          [(str, int, int, str, str, int)] - name, offset, length, source, label and   *
+*                   samplerate of every clip, in the order they are stored                       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def read_shard_index(shard):
+    entries = []
+    with open(index_filename(shard), 'r', newline='') as f:
+        reader = csv.reader(f)
+        next(reader) # The header
+        for name, offset, length, source, label, samplerate in reader:
+            entries.append((name, int(offset), int(length), source, label, int(samplerate)))
+
+    return entries
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             iter_shard                                                                   *
+*                                                                                                *
+* Parameters:       str shard - The .pcm file of the shard                                       *
+*                                                                                                *
+* Returns:          generator of (str, str, int, np.array) - The name, label and samplerate of  *
+*                   each clip, and its samples as a read only view of the memory mapped shard    *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def iter_shard(shard):
+    entries = read_shard_index(shard)
+    if not entries:
+        return
+
+    samples = np.memmap(shard, dtype=np.int16, mode='r')
+    for name, offset, length, _, label, samplerate in entries:
+        yield name, label, samplerate, samples[offset : offset + length]
+
+def iter_pack(pack_dir):
+    for shard in list_shards(pack_dir):
+        yield from iter_shard(shard)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             iter_shard_batches                                                           *
+*                                                                                                *
+* Parameters:       str shard     - The .pcm file of the shard                                   *
+*                   int max_clips - The most clips in one batch                                  *
+*                                                                                                *
+* Purpose:          Groups runs of back to back clips with the same length and sample rate into  *
+*                   one 2d array, a view of the shard rather than a copy, so a whole batch can   *
+*                   go through the vectorized FFT at once                                        *
+*                                                                                                *
+* Returns:          generator of (int, list, np.array) - The samplerate, the read_shard_index    *
+*                   entries of the clips, and the clips one per row                              *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def iter_shard_batches(shard, max_clips=4096):
+    entries = read_shard_index(shard)
+    if not entries:
+        return
+
+    samples = np.memmap(shard, dtype=np.int16, mode='r')
+
+    start = 0
+    while start < len(entries):
+        _, first_offset, length, _, _, samplerate = entries[start]
+
+        # Extend the run while the next clip starts where the last ended and has the same format
+        stop = start + 1
+        while (stop < len(entries) and stop - start < max_clips and entries[stop][2] == length
+               and entries[stop][5] == samplerate and entries[stop][1] == first_offset + (stop - start) * length):
+            stop += 1
+
+        clips = samples[first_offset : first_offset + (stop - start) * length].reshape(stop - start, length)
+        yield samplerate, entries[start:stop], clips
+
+        start = stop
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             pack_folder                                                                  *
+*                                                                                                *
+* Parameters:       str wav_folder - Folder of clips to pack                                     *
+*                   str pack_dir   - The pack to add them to                                     *
+*                                                                                                *
+* Purpose:          Packs an existing folder of split or normalized clips. Stereo clips are      *
+*                   mixed down to mono                                                           *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def pack_folder(wav_folder, pack_dir):
+    filenames = sorted(glob.glob(wav_folder + '*.wav'))
+
+    writer = open_writer(pack_dir)
+    for filename in tqdm.tqdm(filenames, desc='Packing clips'):
+        samplerate, data = wavfile.read(filename)
+        if data.ndim > 1:
+            data = data.mean(axis=1)
+        if data.dtype != np.int16:
+            data = to_pcm16(data) if data.dtype.kind == 'f' else data.astype(np.int16)
+
+        name = os.path.split(filename)[1]
+        # The instrument tag, the same way extractFreqARFF.instrument_from_filename reads it
+        write_clip(writer, name, data, samplerate, name, name.split('_')[0])
+    close_writer(writer)
+
+    return len(filenames)
+
+def unpack(pack_dir, wav_folder):
+    os.makedirs(wav_folder, exist_ok=True)
+
+    num_clips = 0
+    for name, _, samplerate, samples in iter_pack(pack_dir):
+        wavfile.write(os.path.join(wav_folder, name), samplerate, np.array(samples))
+        num_clips += 1
+
+    return num_clips
+
+def print_info(pack_dir):
+    shards = list_shards(pack_dir)
+
+    counts = Counter()
+    num_bytes = 0
+    for shard in shards:
+        counts.update(entry[4] for entry in read_shard_index(shard))
+        num_bytes += os.path.getsize(shard)
+
+    print(pack_dir + ':', len(shards), 'shards,', sum(counts.values()), 'clips,', '%.1f MB' % (num_bytes / 1e6))
+    for inst, count in counts.most_common():
+        print('  ' + inst.ljust(12), count)
+
+__USAGE__ = 'python3 clippack.py pack <wav folder> <pack dir>\n'\
+        'python3 clippack.py unpack <pack dir> <wav folder>\n'\
+        'python3 clippack.py info <pack dir>'
+
+if __name__ == '__main__':
+    argv = sys.argv
+    argc = len(argv)
+
+    if argc == 4 and argv[1] == 'pack':
+        print('Packed', pack_folder(argv[2], argv[3]), 'clips into', argv[3])
+    elif argc == 4 and argv[1] == 'unpack':
+        if not is_pack(argv[2]):
+            print('Error:', argv[2], 'is not a clip pack')
+            sys.exit(1)
+        print('Wrote', unpack(argv[2], argv[3]), 'clips to', argv[3])
+    elif argc == 3 and argv[1] == 'info':
+        if not is_pack(argv[2]):
+            print('Error:', argv[2], 'is not a clip pack')
+            sys.exit(1)
+        print_info(argv[2])
+    else:
+        print(__USAGE__)
+        sys.exit(1)
@@ -9,7 +9,7 @@
 *                   <infolder>      - The folder to search for audiofiles                        *
 *                   <outfolder>     - The folder to store the converted fils. Gets created if    *
 *                                   it does not exist                                            *
-*                   <max_processes> - The max number of subprocesses allowed to spawn            *
+*                   <max_processes> - The max number of subprocesses allowed to spawn, or auto   *
 *                                                                                                *
 **************************************************************************************************
 '''
@@ -21,7 +21,9 @@ import glob
 import datetime 
 import time
 
-import tqdm
+from procpool import run_commands, parse_max_processes # pyright: ignore
+from workplan import size_cost # pyright: ignore
+from manifest import write_manifest, describe_file, manifest_filename # pyright: ignore
 
 '''
 * ********************************************************************************************** *
@@ -30,54 +32,38 @@ import tqdm
 *                                                                                                *
 * Parameters:       str[] filenames   - All the audio files to be converted                      *
 *                   str outpath       - The path to place converted files in                     *
-*                   int max_processes - The maximum number of subprocesses allowed to exist      *
+*                   max_processes     - The maximum number of subprocesses allowed to exist, or  *
+*                                       'auto' to adjust it while converting (see procpool.py)   *
 *                                                                                                *
 * Purpose:          Converts all audio files in the given directory to wav files. multithreaded  * 
-*                   by using subprocess to repeatedly call ffmpeg                                *
+*                   by using subprocess to repeatedly call ffmpeg. Writes a manifest of the wavs *
+*                   to outpath for the split stage (see manifest.py)                             *
 *                                                                                                *
 * ********************************************************************************************** *
 '''
 def convert_all_to_wav(filenames, outpath, max_processes):
-    ffmpeg_cmd = 'ffmpeg -i '
-    # output_log_cmd = '>> ffmpeg.log 2>&1'
-    output_log_cmd = ' -loglevel quiet'
-
     # Make the output Directory if it does not exist
     if not os.path.exists(outpath):
         os.makedirs(outpath, exist_ok=True)
     
-    split_filenames = [os.path.split(filename) for filename in filenames]
+    # One file per command, so longest first is just the biggest files first. Leaves the short ones to fill in at the end
+    filenames = sorted(filenames, key=size_cost, reverse=True)
+    outfilenames = [os.path.join(outpath, os.path.splitext(os.path.split(filename)[1])[0] + '.wav') for filename in filenames]
 
-    processes = []
+    # Run without a shell, so file names with spaces or quotes in them need no escaping
     commands = []
+    for filename, outfilename in zip(filenames, outfilenames):
+        commands.append([['ffmpeg', '-i', filename, outfilename, '-loglevel', 'quiet'], 1])
 
-    for filename in split_filenames:
-        no_ext = filename[1].split('.')
-        commands.append(ffmpeg_cmd + ' ' + filename[0] + '/' + filename[1] + ' ' + outpath + '/' + no_ext[0] + '.wav' + output_log_cmd)
-
-    pbar = tqdm.tqdm(desc='Converting to wav', total=len(commands))
-
-    conversion_num = 0
-    while commands: 
-        # Fill up the currently running processes to the max allowed
-        while len(processes) < max_processes and commands:
-            processes.append(subprocess.Popen(commands.pop(), shell=True))
-        
-        completed_processes = []     
-        for process in processes:
-            if process.poll() is not None:
-                completed_processes.append(process)
-                conversion_num += 1
-                pbar.update(1)
-        
-        for process in completed_processes:
-            processes.remove(process) 
+    # A file ffmpeg can not convert is skipped rather than stopping the build
+    run_commands(commands, max_processes, 'Converting to wav', allow_failures=True)
 
-    for process in processes:
-        process.wait()
+    # Lists the wavs for the split stage, a file ffmpeg could not convert is left out
+    if os.path.exists(manifest_filename(outpath)):
+        os.remove(manifest_filename(outpath))
+    write_manifest(manifest_filename(outpath), [describe_file(outfilename) for outfilename in outfilenames
+                                                if os.path.exists(outfilename)])
 
-    # for process in completed_processes:
-        # process.wait()
 '''
 * ********************************************************************************************** *
 *                                                                                                *
@@ -119,4 +105,4 @@ if __name__ == "__main__":
     filenames = glob.glob(argv[1]+'/*.mp4')
     filenames.extend(glob.glob(argv[1] + '/*.mp3'))
 
-    convert_all_to_wav(filenames, argv[2], int(argv[3]))
+    convert_all_to_wav(filenames, argv[2], parse_max_processes(argv[3]))
@@ -0,0 +1,191 @@
+'''
+**************************************************************************************************
+* Filename:    distextract.py                                                                    *
+*                                                                                                *
+* Description: Builds the dataset across several machines. A coordinator publishes the full      *
+*              length wav files, or ranges of their clips, as work units in a queue on a shared  *
+*              directory (see workqueue.py). Workers on any host that can see the directory      *
+*              claim units, run the split/normalize/FFT chain on them in memory (see             *
+*              fusedextract.py) and write one csv shard per unit. Once every unit is done the    *
+*              shards are merged into the arff dataset.                                          *
+*                                                                                                *
+* Usage:       python3 distextract.py publish <queue dir> <wav dir> [options]                    *
+*                   Creates the queue. See --help for the clip length, harmonics etc.            *
+*                                                                                                *
+*              python3 distextract.py worker <queue dir> [--lease <seconds>]                     *
+*                   Works on the queue until it is empty. Run as many of these as you like       *
+*                                                                                                *
+*              python3 distextract.py merge <queue dir> <outfile.arff> [--partitioned]           *
+*                   Combines the shards into the dataset                                         *
+*                                                                                                *
+*              python3 distextract.py status <queue dir>                                         *
+*                                                                                                *
+*              python3 distextract.py local <queue dir> <wav dir> <outfile.arff> --workers <n>   *
+*                   Publishes, runs n worker processes on this machine and merges                *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import glob
+import math
+import argparse
+import subprocess
+import time
+
+import soundfile as sf
+
+import workqueue # pyright: ignore
+from fusedextract import extract_to_csv # pyright: ignore
+from splitaudio import count_frames, frame_sizes # pyright: ignore
+from extractFreqARFF import combine_batches # pyright: ignore
+from spectrumcache import write_index # pyright: ignore
+from procpool import parse_max_processes, initial_workers # pyright: ignore
+from manifest import list_inputs # pyright: ignore
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             make_units                                                                   *
+*                                                                                                *
+* Parameters:       str[] filenames     - The full length wav files                              *
+*                   float seconds       - How long each clip should be                           *
+*                   int clips_per_unit  - Split recordings longer than this many clips into      *
+*                                         several units. None keeps one unit per file            *
+*                   float hop           - Seconds between clip starts, None for back to back     *
+*                                                                                                *
+* Returns:          dict[] - Work units of the form {path, start_clip, stop_clip}                *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def make_units(filenames, seconds, clips_per_unit=None, hop=None):
+    units = []
+    for filename in sorted(filenames):
+        path = os.path.abspath(filename)
+
+        if clips_per_unit is None:
+            units.append({'path': path, 'start_clip': 0, 'stop_clip': None})
+            continue
+
+        info = sf.info(filename)
+        if hop is None:
+            num_clips = math.ceil(info.frames / math.ceil(seconds * info.samplerate))
+        else:
+            num_clips = count_frames(info.frames, *frame_sizes(seconds, hop, info.samplerate))
+        for start in range(0, max(num_clips, 1), clips_per_unit):
+            units.append({'path': path, 'start_clip': start, 'stop_clip': min(start + clips_per_unit, num_clips)})
+
+    return units
+
+def publish(queue_dir, indir, seconds, number_harmonics, target_dBFS=-20, min_dbfs=None, dedupe=False,
+            clips_per_unit=None, spectra_dir=None, spectrum_pool=1, hop=None):
+    filenames = [row['path'] for row in list_inputs(indir)]
+    units = make_units(filenames, seconds, clips_per_unit, hop)
+
+    # The spectrum cache has to be somewhere every worker can write to, like the queue itself
+    if spectra_dir is not None:
+        spectra_dir = os.path.abspath(spectra_dir)
+        os.makedirs(spectra_dir, exist_ok=True)
+
+    config = {'seconds': seconds, 'harmonics': number_harmonics, 'dbfs': target_dBFS, 'gatedb': min_dbfs,
+              'dedupe': dedupe, 'spectra': spectra_dir, 'pool': spectrum_pool, 'hop': hop}
+    workqueue.create_queue(queue_dir, units, config)
+    print('Published', len(units), 'units from', len(filenames), 'files to', queue_dir)
+
+def process_unit(unit, config, tempfilename):
+    spectra_filename = None
+    if config.get('spectra'):
+        name = os.path.splitext(os.path.split(unit['path'])[1])[0]
+        spectra_filename = os.path.join(config['spectra'], '%s_%07d.npz' % (name, unit['start_clip']))
+
+    extract_to_csv(unit['path'], tempfilename, config['seconds'], config['harmonics'], config['dbfs'],
+                   config['gatedb'], config['dedupe'], unit['start_clip'], unit['stop_clip'], spectra_filename,
+                   config.get('pool', 1), config.get('hop'))
+
+def work(queue_dir, lease_seconds=60):
+    num_completed = workqueue.run_worker(queue_dir, process_unit, lease_seconds)
+    print(workqueue.make_worker_id(), 'completed', num_completed, 'units')
+
+def merge(queue_dir, outfilename, partitioned=False):
+    counts = workqueue.count_units(queue_dir)
+    if counts['pending'] > 0 or counts['leased'] > 0:
+        print('Error: the queue still has', counts['pending'], 'pending and', counts['leased'], 'leased units')
+        sys.exit(1)
+    if counts['failed'] > 0:
+        print('Error:', counts['failed'], 'units failed, see', os.path.join(queue_dir, workqueue.FAILED_DIR) + '.',
+              'Move them back to', workqueue.PENDING_DIR, 'to retry them')
+        sys.exit(1)
+
+    config = workqueue.read_config(queue_dir)
+    shards = sorted(glob.glob(os.path.join(queue_dir, workqueue.SHARDS_DIR, '*.csv')))
+    combine_batches(shards, outfilename, config['harmonics'], partitioned)
+    if config.get('spectra'):
+        write_index(config['spectra'])
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             run_local                                                                    *
+*                                                                                                *
+* Parameters:       int num_workers - The number of worker processes to start on this machine    *
+*                   The rest are the same as publish and merge                                   *
+*                                                                                                *
+* Purpose:          Runs the whole distributed build with worker processes on this machine.      *
+*                   Useful for testing the queue, since the workers only talk through the        *
+*                   queue directory just like they would across hosts                            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def run_local(queue_dir, indir, outfilename, num_workers, seconds, number_harmonics, target_dBFS=-20,
+              min_dbfs=None, dedupe=False, clips_per_unit=None, lease_seconds=60, partitioned=False, spectra_dir=None,
+              spectrum_pool=1, hop=None):
+    publish(queue_dir, indir, seconds, number_harmonics, target_dBFS, min_dbfs, dedupe, clips_per_unit, spectra_dir,
+            spectrum_pool, hop)
+
+    start = time.time()
+    script = os.path.abspath(__file__)
+    workers = [subprocess.Popen([sys.executable, script, 'worker', queue_dir, '--lease', str(lease_seconds)])
+               for _ in range(num_workers)]
+    for worker in workers:
+        worker.wait()
+    print('Workers finished in %.1fs' % (time.time() - start))
+
+    merge(queue_dir, outfilename, partitioned)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='distextract.py',
+                                     description='Builds the arff dataset with workers sharing a queue on a shared directory')
+    parser.add_argument('mode', choices=['publish', 'worker', 'merge', 'status', 'local'])
+    parser.add_argument('queue', help='The shared queue directory')
+    parser.add_argument('paths', nargs='*', help='publish: <wav dir>, merge: <outfile>, local: <wav dir> <outfile>')
+
+    parser.add_argument('-s', '--seconds', type=float, default=0.1, help='Length of each clip')
+    parser.add_argument('-r', '--harmonics', type=int, default=32, help='Number of harmonics to include in the fft')
+    parser.add_argument('-d', '--dbfs', type=int, default=-20, help='The db level each clip is normalized to')
+    parser.add_argument('--gatedb', type=float, default=None, help='Skip clips quieter than this level')
+    parser.add_argument('--hop', type=float, default=None, help='Start a clip every this many seconds so clips overlap. Defaults to back to back clips')
+    parser.add_argument('--dedupe', action='store_true', default=False, help='Skip exact duplicate clips within a file')
+    parser.add_argument('--clipsperunit', type=int, default=None, help='Split long recordings into units of this many clips')
+    parser.add_argument('--lease', type=float, default=60, help='Seconds a lease lasts without being renewed')
+    parser.add_argument('--partitioned', action='store_true', default=False, help='Merge into one arff per instrument')
+    parser.add_argument('-w', '--workers', type=parse_max_processes, default='auto', help='Worker processes for local mode, auto uses one per cpu')
+    parser.add_argument('--spectra', default=None, help='Also save every clip spectrum to this spectrum cache directory')
+    parser.add_argument('--pool', type=int, default=1, help='FFT bins averaged together in the spectrum cache')
+
+    args = parser.parse_args()
+
+    if args.mode == 'publish' and len(args.paths) == 1:
+        publish(args.queue, args.paths[0], args.seconds, args.harmonics, args.dbfs, args.gatedb, args.dedupe,
+                args.clipsperunit, args.spectra, args.pool, args.hop)
+    elif args.mode == 'worker':
+        work(args.queue, args.lease)
+    elif args.mode == 'merge' and len(args.paths) == 1:
+        merge(args.queue, args.paths[0], args.partitioned)
+    elif args.mode == 'status':
+        print(workqueue.count_units(args.queue))
+    elif args.mode == 'local' and len(args.paths) == 2:
+        run_local(args.queue, args.paths[0], args.paths[1], initial_workers(args.workers), args.seconds, args.harmonics, args.dbfs,
+                  args.gatedb, args.dedupe, args.clipsperunit, args.lease, args.partitioned, args.spectra, args.pool, args.hop)
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -23,15 +23,23 @@ import sys
 import os
 import glob
 import argparse 
-import subprocess
 import shutil
 
 from scipy.io import wavfile
-from scipy.fft import fft 
 import numpy as np
 import tqdm
 
+from partitioned import write_partitioned # pyright: ignore
+from arffio import make_header, write_arff, write_rows, feature_formats, find_classes # pyright: ignore
+from procpool import run_commands, parse_max_processes, planned_workers # pyright: ignore
+from workplan import num_batches, plan_batches # pyright: ignore
+from clippack import is_shard, iter_shard_batches # pyright: ignore
+from manifest import list_inputs, read_manifest, write_batches # pyright: ignore
+from fftbackend import rfft_abs, set_backend, backend_environment, BACKENDS # pyright: ignore
+
 SeenInstruments = set() 
+# The most clips one analysis command is given
+FILES_PER_PROCESS = 250
 
 # NEW FUNCS HERE
 
@@ -79,57 +87,28 @@ def wav2arff(fpath, openarffcsv, rawarffcsv, number_harmonics):
     return None
 
 # Allows me to import it
-# TODO: FIX REPEAT LATER, this is just a hacky solution for now
 def create_arff(audiofolder, number_harmonics, outarff_filename_starter, outdir):
     WavPathsList = glob.glob(audiofolder + '*.wav')
 
-    openarfffile = open(outdir + outarff_filename_starter + 'Normalized.arff', 'w',
-        newline='')
-    rawarffile = open(outdir + outarff_filename_starter + 'Raw.arff', 'w')
-    
-    for of in [openarfffile, rawarffile]:
-        of.write("@relation " + outarff_filename_starter + "\n")
-        for i in range(1, number_harmonics+1):
-            of.write("@attribute ampl" + str(i) + " numeric\n")
-            of.write("@attribute freq" + str(i) + " numeric\n")
-        of.write("@attribute instrument\n")
-        of.write("@data\n")
-        of.flush()
-
-    openarffcsv = csv.writer(openarfffile, delimiter=',', quotechar='"')
-    rawarffcsv = csv.writer(rawarffile, delimiter=',', quotechar='"')
+    rows = []
+    labels = []
 
     pbar = tqdm.tqdm(desc='Analyzing audio', total=len(WavPathsList))
-    for idx, path in enumerate(WavPathsList):
-        # print('Analyzing audio', str(idx) + '/' + str(totalfiles))
-        wav2arff(path, openarffcsv, rawarffcsv, number_harmonics) # N.P. add
+    for path in WavPathsList:
+        sortedfft = gen_FFT(path)
+        # Not enough peaks for a full row, cleandata.py would throw it out anyway
+        if len(sortedfft) >= number_harmonics:
+            rows.append(gen_features(sortedfft, number_harmonics))
+            labels.append(instrument_from_filename(path))
+            SeenInstruments.add(labels[-1])
         pbar.update(1)
 
-    openarfffile.close()
-    rawarffile.close()
+    raw = np.array(rows).reshape(-1, 2 * number_harmonics)
 
-    openarfffile = open(outdir + outarff_filename_starter +'Normalized.arff', 'r')
-    rawarffile = open(outdir + outarff_filename_starter +'Raw.arff', 'r')
-    
-    for file in [openarfffile, rawarffile]:
-        data = file.readlines()
-
-        for idx, line in enumerate(data):
-            if line == "@attribute instrument\n":
-                newline = '@attribute instrument {'
-                numinst = len(SeenInstruments)
-                for idy, inst in enumerate(SeenInstruments):
-                    if idy == (numinst - 1):
-                        newline += inst + '}\n'
-                    else:
-                        newline += inst + ','
-                data[idx] = newline
-                break 
-
-        file.close()            
-        outfile = open(file.name, 'w')
-        outfile.writelines(data)
-        outfile.close()
+    write_arff(outdir + outarff_filename_starter + 'Normalized.arff', outarff_filename_starter, number_harmonics,
+               normalize_features(raw), labels, normalize=True)
+    write_arff(outdir + outarff_filename_starter + 'Raw.arff', outarff_filename_starter, number_harmonics,
+               raw, labels)
 
 '''
 
@@ -152,210 +131,218 @@ def create_arff(audiofolder, number_harmonics, outarff_filename_starter, outdir)
 '''
 def gen_FFT(audio_file):
     samplerate, data = wavfile.read(audio_file)
-    normdata = list(data)
-    complexfft = fft(normdata)
-    absfft = np.abs(complexfft) # type:ignore
+    # Only the left half of the spectrum is used, so only the real fft of it is taken (see fftbackend.py)
+    absfft = rfft_abs(np.asarray(data, dtype=np.float64))
     
     # 6/4/2021, 6/6/2021 FFT ANALYSIS:
     # discard mirror image right of center, sort on amplitude.
-    freqstep = 1    # needed to find fundamental frequency and the harmonics
-    sortedfft = []
     # sort is pulling in low-frequency pulse noise below 100 Hz,
     # or possibly low-freq white noise for sine waves, so cut those out:
+    half = int(len(data)/2)
     nyquist = samplerate / 2.0      # 3/1/2023
-    perbin = nyquist / int(len(absfft)/2) # 3/1/2023
+    perbin = nyquist / half # 3/1/2023
     numbinsBelow100 = int(100 / perbin) # 3/1/2023
     # print("DEBUG numbinsBelow100 ", numbinsBelow100)
-    for ix in range(0, int(len(absfft)/2)):
-        if ix >= numbinsBelow100:   # 3/1/2023
-            sortedfft.append([absfft[ix], freqstep]) 
-        freqstep += 1
-    sortedfft.sort(reverse=True, key=lambda inst : inst[0])
+
+    # [amplitude, bin] pairs, bins numbered from 1, loudest first. A stable sort keeps equal amplitudes in bin order
+    amplitudes = absfft[numbinsBelow100:half]
+    order = np.argsort(-amplitudes, kind='stable')
+    sortedfft = np.column_stack((amplitudes[order], order + numbinsBelow100 + 1))
 
     return sortedfft
 
-def gen_arff_row(audiofilename, sortedfft, number_harmonics, normalize=False):
-    filename = os.path.split(audiofilename) 
-    instrument = filename[1].split('_')[0]
+'''
+***************************************************************************************************
+* Name:         gen_FFT_batch                                                                     *
+*                                                                                                 *
+* Description:  Does what gen_FFT and gen_features do for a whole batch of equal length clips at  *
+*               once. Only the top number_harmonics bins of each clip are sorted instead of the   *
+*               whole spectrum. Ties are broken by bin number like the stable sort in gen_FFT     *
+*                                                                                                 *
+* Parameters:   np.array clips        - 2d array of samples, one clip per row                     *
+*               int samplerate        - The sample rate of the clips                              *
+*               int number_harmonics  - How many (amplitude, frequency) pairs to keep             *
+*                                                                                                 *
+* Returns:      np.array - One raw feature row per clip, empty if the clips are too short to     *
+*                          have number_harmonics bins above 100 Hz                                *
+*                                                                                                 *
+***************************************************************************************************
+'''
+def gen_FFT_batch(clips, samplerate, number_harmonics):
+    clips = np.atleast_2d(clips)
+    half = clips.shape[1] // 2
+    if half == 0:
+        return np.empty((0, 2 * number_harmonics))
+
+    # Same low frequency cut as gen_FFT
+    perbin = (samplerate / 2.0) / half
+    numbinsBelow100 = int(100 / perbin)
+    if half - numbinsBelow100 < number_harmonics:
+        return np.empty((0, 2 * number_harmonics))
+
+    # The real fft is the left half of the full fft
+    absfft = rfft_abs(clips.astype(np.float64))[:, numbinsBelow100:half]
+
+    top = np.argpartition(-absfft, number_harmonics - 1, axis=1)[:, :number_harmonics]
+    top_ampl = np.take_along_axis(absfft, top, axis=1)
+    order = np.lexsort((top, -top_ampl), axis=1)
+    top = np.take_along_axis(top, order, axis=1)
+
+    features = np.empty((len(clips), 2 * number_harmonics))
+    features[:, 0::2] = np.take_along_axis(top_ampl, order, axis=1)
+    # gen_FFT numbers bins from 1
+    features[:, 1::2] = top + numbinsBelow100 + 1
+
+    return features
 
-    fundamentalAmplitude = sortedfft[0][0] * 1.0
-    fundamentalFrequency = sortedfft[0][1] * 1.0
+def instrument_from_filename(audiofilename):
+    filename = os.path.split(audiofilename)
+    return filename[1].split('_')[0]
 
-    data_row = []
+# The top number_harmonics (amplitude, frequency) pairs of a sorted fft flattened into one row
+def gen_features(sortedfft, number_harmonics, normalize=False):
+    harmonics = np.array(sortedfft[0:number_harmonics], dtype=np.float64)
 
-    for inst in sortedfft[0:number_harmonics]:
-        if normalize:
-            data_row.extend([round(inst[0]/fundamentalAmplitude, 6),
-                round(inst[1]/fundamentalFrequency, 6)])
-        else:
-            data_row.extend([round(inst[0], 6), round(inst[1], 6)])
+    if normalize:
+        # Ratios to the fundamental, silence gives nan which cleandata.py removes
+        with np.errstate(divide='ignore', invalid='ignore'):
+            harmonics = harmonics / harmonics[0]
+
+    return harmonics.ravel()
 
-    data_row.extend([instrument])
+# Turns raw rows into ratios of the fundamental's amplitude and frequency, for every row at once
+def normalize_features(raw):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normalized = raw.reshape(len(raw), -1, 2) / raw[:, None, 0:2]
 
-    return data_row 
+    return normalized.reshape(raw.shape)
 
-def batch_process(files, outfilename, outfolder, number_harmonics, normalize=False):
-    outfile = open(outfolder + outfilename, 'w')
-    outcsv = csv.writer(outfile)
+def gen_arff_row(audiofilename, sortedfft, number_harmonics, normalize=False):
+    data_row = list(np.round(gen_features(sortedfft, number_harmonics, normalize), 6))
+    data_row.extend([instrument_from_filename(audiofilename)])
+
+    return data_row
+
+# file_labels holds the instrument of each file, from its manifest row. None reads it from the filenames
+def batch_process(files, outfilename, outfolder, number_harmonics, normalize=False, file_labels=None):
+    rows = []
+    labels = []
+    if file_labels is None:
+        file_labels = [instrument_from_filename(file) for file in files]
+
+    for file, label in zip(files, file_labels): # Get the fft for each file that is given to the function
+        if is_shard(file):
+            # A clip pack shard, every run of equal length clips goes through the FFT at once
+            for samplerate, entries, clips in iter_shard_batches(file):
+                features = gen_FFT_batch(clips, samplerate, number_harmonics)
+                # Empty when the clips are too short for a full row, like the check below
+                if len(features) == 0:
+                    continue
+                rows.extend(normalize_features(features) if normalize else features)
+                labels.extend(entry[4] for entry in entries)
+            continue
 
-    for file in files: # Get the fft for each file that is given to the function
         sortedfft = gen_FFT(file)
-        outcsv.writerow(gen_arff_row(file, sortedfft, number_harmonics, normalize))
+        # Not enough peaks for a full row, cleandata.py would throw it out anyway
+        if len(sortedfft) >= number_harmonics:
+            rows.append(gen_features(sortedfft, number_harmonics, normalize))
+            labels.append(label)
 
-    outfile.close()
+    with open(outfolder + outfilename, 'w') as outfile:
+        write_rows(outfile, np.array(rows).reshape(-1, 2 * number_harmonics), labels,
+                   feature_formats(number_harmonics, normalize))
 
 def make_header_file(filename, number_harmonics, seen_insts, writeout=False):
-    header_lines = []
-    header_lines.append('@relation ' + filename + '\n')
-    for i in range(1, number_harmonics+1):
-        header_lines.append("@attribute ampl" + str(i) + " numeric\n")
-        header_lines.append("@attribute freq" + str(i) + " numeric\n")
-
-    inst_line = '@attribute instrument {'
-    num_inst = len(seen_insts)
-    for idx, inst in enumerate(seen_insts):
-        inst_line += inst
-        if idx != num_inst:
-            inst_line += ','
-        if idx == num_inst:
-            inst_line += '}'
-
-    header_lines.append("@data\n")
+    header_lines = make_header(filename, number_harmonics, seen_insts)
 
     if writeout:
-        outfile = open(filename, 'w')
-        outfile.writelines(header_lines) 
+        with open(filename, 'w') as outfile:
+            outfile.writelines(header_lines)
 
     return header_lines
 
-def combine_batches(filenames, outfilename, number_harmonics):
-    outdata = []
-    seen_insts = set()
+def combine_batches(filenames, outfilename, number_harmonics, partitioned=False):
+    if partitioned:
+        combine_partitioned(filenames, outfilename, number_harmonics)
+        return
 
-    pbar = tqdm.tqdm(desc='Merging csvs', total=len(filenames))
+    # Only the label column has to be parsed to build the header, the rows themselves are copied as text
+    seen_insts = set()
     for file in filenames:
-        infile = open(file, 'r')
-        incsv = csv.reader(infile)
-        for row in incsv:
-            outdata.append(row)
-            seen_insts.add(row[-1]) # The tagged instrument is always the last row
-            # TODO Remove debug
-            print('inst:',row[-1])
+        seen_insts.update(find_classes(file, skiprows=0))
 
-        pbar.update(1)
-    
     header_lines = make_header_file(outfilename, number_harmonics, seen_insts)
 
-    outfile = open(outfilename, 'w')
-    outfile.writelines(header_lines)
-    outcsv = csv.writer(outfile)
+    pbar = tqdm.tqdm(desc='Merging csvs', total=len(filenames))
+    with open(outfilename, 'w') as outfile:
+        outfile.writelines(header_lines)
+        for file in filenames:
+            with open(file, 'r') as infile:
+                shutil.copyfileobj(infile, outfile)
+            pbar.update(1)
+
+# Writes the merged batches as one arff per instrument into a directory named after outfilename
+def combine_partitioned(filenames, outfilename, number_harmonics):
+    outdir = os.path.splitext(outfilename)[0]
 
-    outcsv.writerows(outdata)
+    def batch_rows():
+        pbar = tqdm.tqdm(desc='Merging csvs', total=len(filenames))
+        for file in filenames:
+            with open(file, 'r') as infile:
+                yield from csv.reader(infile)
+            pbar.update(1)
 
-    outfile.close()
+    index = write_partitioned(outdir, os.path.split(outdir)[1], number_harmonics, batch_rows())
+    for inst, partition in index['partitions'].items():
+        print(inst + ':', partition['rows'], 'rows')
 
-def append_cmd(filenames, outfilename, tempfolder, number_harmonics, normalize=False):
-    cmd_tmpl = 'python3 extractFreqARFF.py'
-    cmd_tmpl += ' -b'
-    cmd_tmpl += ' --tempfolder ' + tempfolder 
-    cmd_tmpl += ' --outfile ' + outfilename
+# The files to analyze are passed in an inputs manifest, and the command is a list of arguments run without a shell
+def append_cmd(inputs, outfilename, tempfolder, number_harmonics, normalize=False):
+    cmd = ['python3', 'extractFreqARFF.py', '-b', '--tempfolder', tempfolder, '--outfile', outfilename]
 
     if normalize:
-        cmd_tmpl += ' --normalize'
-
-    cmd_tmpl += ' --harmonics ' + str(number_harmonics)
-    cmd_tmpl += ' --filenames'
+        cmd.append('--normalize')
 
-    for file in filenames:
-        cmd_tmpl += ' ' + file
+    cmd += ['--harmonics', str(number_harmonics), '--inputs', inputs]
     
-    return cmd_tmpl
+    return cmd
 
-def make_cmds_arr(filenames, tempfolder, number_harmonics, max_processes, normalize=False):
-    num_files = len(filenames) 
-    files_per_process = 250 # how many audio files each thread will analyze
-    num_processes = num_files // files_per_process
-    
-    if files_per_process == 0:
-        if num_files < max_processes:
-            files_per_process = 1
-        else:
-            files_per_process = filenames // max_processes 
+# Batches are balanced by the file sizes in the manifest, at most FILES_PER_PROCESS files each, largest batch first.
+# Returns the commands, the part file each writes and the temp folder of batch manifests
+def make_cmds_arr(rows, tempfolder, number_harmonics, max_processes, normalize=False):
+    costs = [row['size'] for row in rows]
+    batches = num_batches(len(rows), max_processes, FILES_PER_PROCESS)
+    batch_dir, planned = write_batches(plan_batches(rows, costs, batches))
 
     cmds = []
-    start_idx = 0
-    pid = 0 
+    part_files = []
+    for idx, (inputs, _, process_rows) in enumerate(planned):
+        part_files.append(tempfolder + 'part' + str(idx) + '.csv')
+        process_cmd = append_cmd(inputs, 'part' + str(idx) + '.csv', tempfolder, number_harmonics, normalize)
+        cmds.append([process_cmd, sum(row['clips'] for row in process_rows)])
 
-    for idx in range(0, num_processes):
-        end_idx = start_idx + files_per_process
-        
-        # Edge case checking
-        # Case reached if we have less files than max_processes or we somehow over reach array bounds
-        # Any extra files will get caught by leftover filenames
-        if end_idx > num_files: 
-            break
-        
-        process_files = filenames[start_idx:end_idx]
+    return cmds, part_files, batch_dir
 
-        # Edge case - if somehow we get a blank array skip this array
-        # Would only happnen if my process splitting code failed
-        if len(process_files) == 0:
-            continue
-
-        process_cmd = append_cmd(process_files, 'part' + str(idx) + '.csv', tempfolder, number_harmonics, normalize) 
-        cmds.append([process_cmd, len(process_files)])
-        start_idx = end_idx
-        pid = idx
-    
-    
-    leftover_filenames = filenames[start_idx:len(filenames)]
-    if len(leftover_filenames) > 0:
-        pid += 1
-        cmds.append([append_cmd(leftover_filenames, 'part' + str(pid) + '.csv', tempfolder, number_harmonics, normalize), len(leftover_filenames)])
-    
-    return cmds
-
-def multithreaded_FFT(infolder, outfilename, tempfolder, number_harmonics, max_processes, normalize=False):
+def multithreaded_FFT(infolder, outfilename, tempfolder, number_harmonics, max_processes, normalize=False, partitioned=False):
     os.makedirs(tempfolder, exist_ok=True)
 
-    filenames = glob.glob(infolder + '*.wav') # locate all wavfiles in the supplied dir
+    rows = list_inputs(infolder) # all wavfiles, or clip pack shards, from the manifest of the supplied dir
     
     # TODO handle max_processes of 1 getting passed in
     # if max_processes == 1: # If we're only running 1 process there is not need to split the workload
     #     batch_process(filenames, outfilename,)
     #     return
 
-    cmds = make_cmds_arr(filenames, tempfolder, number_harmonics, max_processes, normalize) # Generates all of the commands we need
-    running_processes = []
+    cmds, part_files, batch_dir = make_cmds_arr(rows, tempfolder, number_harmonics, planned_workers(max_processes), normalize) # Generates all of the commands we need
+    run_commands(cmds, max_processes, 'Analyzing Audio')
 
-    pbar = tqdm.tqdm(desc='Analyzing Audio', total=len(filenames))
-
-    while cmds:
-        while len(running_processes) < max_processes:
-            cmd_and_count = cmds.pop()
-            # Pass on the selected process along with the number of files it will normalize 
-            running_processes.append([subprocess.Popen(cmd_and_count[0], shell=True), cmd_and_count[1]])
-        
-        # See if any of the processes have completed, and remove them if they are
-        completed_processes = []
-        for cmd_and_count in running_processes:
-            if cmd_and_count[0].poll() is not None:
-                completed_processes.append(cmd_and_count)
-                pbar.update(cmd_and_count[1])
-
-        for process in completed_processes:
-            running_processes.remove(process)
-    
-    # Wait for all processes to complete once all cmds have been run
-    for cmd_and_count in running_processes:
-        cmd_and_count[0].wait()
-        pbar.update(cmd_and_count[1])
-
-    part_files = glob.glob(tempfolder + '*.csv')
-    combine_batches(part_files, outfilename, number_harmonics)
+    # Only the parts these commands wrote, a batch that found nothing to write is skipped
+    part_files = [part for part in part_files if os.path.exists(part)]
+    combine_batches(part_files, outfilename, number_harmonics, partitioned)
     
     # Remove the temporary files
     shutil.rmtree(tempfolder)
+    shutil.rmtree(batch_dir)
 
 __USAGE__ =                                                         \
 'python3 extractFreqARFF.py <Number of Harmonics> <audio dir> <outputfilename)>'
@@ -367,19 +354,23 @@ if __name__ == '__main__':
                                      description='A program that runs an FFT on a set of wav files and prodeces an arff dataset')
 
     parser.add_argument('-m', '--multithreaded', action='store_true', default=False, help='Run in multithreaded mode')
-    parser.add_argument('-t', '--threads', type=int, help='Max number of subprocesses for multithreaded mode')
+    parser.add_argument('-t', '--threads', type=parse_max_processes, help='Max number of subprocesses for multithreaded mode, or auto to adjust it as it runs')
 
     parser.add_argument('-b', '--batch', action='store_true', default=False, help='Run in batch process mode')
 
     parser.add_argument('-p', '--tempfolder', required=True, help='Temporary folder to store parts of the final arff file.')
 
     parser.add_argument('-f', '--filenames', nargs='+', type=str, help='Files to process (used for batch mode)') 
+    parser.add_argument('--inputs', help='A manifest of more files to process (used for batch mode, see manifest.py)')
     
     parser.add_argument('-i', '--infolder', help='The folder to grab audio files from for analysis')
     parser.add_argument('-o', '--outfile', required=True, help='Output arff filename (include extension)')
     parser.add_argument('-r','--harmonics', type=int, required=True, help='Number of harmonics to include in the fft')
 
     parser.add_argument('-n', '--normalize', action='store_true', default=False, help='Normalize freq and ampl to the fundamental')
+    parser.add_argument('--fft', choices=list(BACKENDS), help='FFT backend, see fftbackend.py. Defaults to $DATASET_FFT_BACKEND or scipy')
+    parser.add_argument('--fftworkers', type=int, default=1, help='Threads per FFT')
+    parser.add_argument('--partitioned', action='store_true', default=False, help='Write one cleaned arff file per instrument plus an index into a directory named after --outfile')
 
     args = parser.parse_args()
     
@@ -396,17 +387,28 @@ if __name__ == '__main__':
         print('Make sure if you are running in multithreaded mode that you have supplied the --infolder argument')
         parser.print_help()
         sys.exit(1)
-    if args.batch and not args.filenames:
+    if args.batch and not args.filenames and not args.inputs:
 
-        print('Error: Batch mode set but no filenames were provided with -f/--filenames')
+        print('Error: Batch mode set but no filenames were provided with -f/--filenames or --inputs')
         parser.print_help()
         sys.exit(1)
     
+    # The batch processes started by multithreaded mode inherit the backend through the environment
+    if args.fft:
+        set_backend(args.fft, args.fftworkers)
+        os.environ.update(backend_environment())
+
     # Batch mode
     if args.batch:
-        batch_process(args.filenames, args.outfile, args.tempfolder, args.harmonics)
+        filenames = args.filenames or []
+        file_labels = [instrument_from_filename(filename) for filename in filenames]
+        if args.inputs:
+            rows = read_manifest(args.inputs)
+            filenames = filenames + [row['path'] for row in rows]
+            file_labels.extend(row['label'] for row in rows)
+        batch_process(filenames, args.outfile, args.tempfolder, args.harmonics, args.normalize, file_labels)
     elif args.multithreaded: # multithreaded mode
-        multithreaded_FFT(args.infolder, args.outfile, args.tempfolder, args.harmonics, args.threads, args.normalize)
+        multithreaded_FFT(args.infolder, args.outfile, args.tempfolder, args.harmonics, args.threads, args.normalize, args.partitioned)
 
 
     sys.exit()
@@ -0,0 +1,204 @@
+'''
+**************************************************************************************************
+* Filename:    fftbackend.py                                                                     *
+*                                                                                                *
+* Description: The FFT used by every stage that analyzes clips. All clips are real and, for a    *
+*              given clip length and samplerate, the same size, so only the real half of the     *
+*              spectrum is computed and the plan for each size is made once and reused.          *
+*                                                                                                *
+*              scipy   - scipy.fft.rfft. Keeps its own cache of plans, and can split a batch     *
+*                        of clips over threads                                                   *
+*              numpy   - numpy.fft.rfft. Caches plans too, always one thread                     *
+*              pyfftw  - FFTW through pyfftw, only when it is installed. A plan is measured for  *
+*                        each batch shape and kept, with its aligned input and output buffers    *
+*                                                                                                *
+*              The backend and thread count come from DATASET_FFT_BACKEND and DATASET_FFT_WORKERS *
+*              when set, so every stage and the subprocesses it starts use the same one, or from *
+*              set_backend. Threads default to 1 since the stages already run one process per    *
+*              cpu. All backends give the same spectrum to within rounding.                      *
+*                                                                                                *
+* Usage:       python3 fftbackend.py list                                                        *
+*                   Prints the backends that can be used here                                    *
+*                                                                                                *
+*              python3 fftbackend.py bench <samplerate> <seconds> [seconds ...] [--clips <n>]    *
+*                                          [--workers <n>]                                       *
+*                   Times every backend on batches of clips of each length                       *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import time
+import argparse
+import math
+
+import numpy as np
+
+DEFAULT_BACKEND = 'scipy'
+BACKEND_VARIABLE = 'DATASET_FFT_BACKEND'
+WORKERS_VARIABLE = 'DATASET_FFT_WORKERS'
+# Plans kept by the pyfftw backend. Batches are mostly the same shape, the last of each shard is smaller
+PLAN_CACHE_SIZE = 8
+# How long pyfftw may spend measuring a plan, it is only done once per shape
+PLANNER_TIMELIMIT = 2.0
+
+# The backend in use: its name, thread count and the pyfftw plans made so far
+STATE = {'name': None, 'workers': 1, 'plans': {}}
+
+def scipy_rfft(clips, workers):
+    import scipy.fft
+    return scipy.fft.rfft(clips, axis=-1, workers=workers)
+
+def numpy_rfft(clips, workers):
+    return np.fft.rfft(clips, axis=-1)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             pyfftw_rfft                                                                  *
+*                                                                                                *
+* Parameters:       np.array clips  - Clips to transform, one per row                            *
+*                   int workers     - Threads FFTW may use                                       *
+*                                                                                                *
+* Purpose:          Looks up the plan for this shape and dtype, making and measuring it the      *
+*                   first time. The clips are copied into the plan's aligned input buffer and    *
+*                   the result is copied out, since the output buffer is reused by the next call *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def pyfftw_rfft(clips, workers):
+    import pyfftw.builders
+
+    key = (clips.shape, clips.dtype.str, workers)
+    plans = STATE['plans']
+    if key not in plans:
+        if len(plans) >= PLAN_CACHE_SIZE:
+            del plans[next(iter(plans))] # The oldest plan
+        plans[key] = pyfftw.builders.rfft(pyfftw.empty_aligned(clips.shape, dtype=clips.dtype), axis=-1, threads=workers,
+                                          planner_effort='FFTW_MEASURE', planning_timelimit=PLANNER_TIMELIMIT)
+
+    plan = plans[key]
+    plan.input_array[...] = clips
+    return plan().copy()
+
+def pyfftw_available():
+    try:
+        import pyfftw # pyright: ignore
+        return True
+    except ImportError:
+        return False
+
+# Name to (rfft function, whether it can be used here)
+BACKENDS = {
+    'scipy': (scipy_rfft, lambda: True),
+    'numpy': (numpy_rfft, lambda: True),
+    'pyfftw': (pyfftw_rfft, pyfftw_available),
+}
+
+def available_backends():
+    return [name for name, (_, available) in BACKENDS.items() if available()]
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             set_backend                                                                  *
+*                                                                                                *
+* Parameters:       str name     - One of BACKENDS                                               *
+*                   int workers  - Threads per transform                                         *
+*                                                                                                *
+* Purpose:          Picks the FFT rfft_abs uses. Exits with an error for a backend that is not   *
+*                   known or not installed                                                       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def set_backend(name, workers=1):
+    if name not in BACKENDS:
+        print('Error: unknown FFT backend', name + ', choose from', ', '.join(BACKENDS))
+        sys.exit(1)
+    if not BACKENDS[name][1]():
+        print('Error: FFT backend', name, 'is not installed here, available:', ', '.join(available_backends()))
+        sys.exit(1)
+
+    STATE['name'] = name
+    STATE['workers'] = max(1, int(workers))
+    STATE['plans'] = {}
+
+# The backend from the environment the first time a transform is needed
+def current_backend():
+    if STATE['name'] is None:
+        set_backend(os.environ.get(BACKEND_VARIABLE, DEFAULT_BACKEND), os.environ.get(WORKERS_VARIABLE, 1))
+
+    return STATE['name']
+
+# The same backend and threads for the subprocesses a stage starts
+def backend_environment():
+    current_backend()
+    return {BACKEND_VARIABLE: STATE['name'], WORKERS_VARIABLE: str(STATE['workers'])}
+
+def rfft(clips):
+    return BACKENDS[current_backend()][0](clips, STATE['workers'])
+
+# Magnitudes of the real half of the spectrum of each row of clips, bins 0 to n/2
+def rfft_abs(clips):
+    return np.abs(rfft(clips))
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             bench                                                                        *
+*                                                                                                *
+* Parameters:       int samplerate   - Samplerate of the clips                                   *
+*                   float[] lengths  - Clip lengths in seconds                                   *
+*                   int num_clips    - Clips per batch, as in a clip pack shard batch            *
+*                   int workers      - Threads per transform                                     *
+*                   int repeats      - Timed runs per backend, the fastest is kept               *
+*                                                                                                *
+* Purpose:          Times every available backend on random clips of each length, both a batch  *
+*                   at a time like the clip packs and one clip at a time like a folder of wavs,  *
+*                   and checks each backend gives the numpy spectrum                             *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def bench(samplerate, lengths, num_clips=4096, workers=1, repeats=3):
+    rng = np.random.default_rng(0)
+    names = available_backends()
+
+    print('Backends:', ', '.join(names), '-', workers, 'thread(s)')
+    for seconds in lengths:
+        clip_samples = math.ceil(seconds * samplerate)
+        clips = rng.integers(-32768, 32767, size=(num_clips, clip_samples)).astype(np.float64)
+        expected = np.abs(np.fft.rfft(clips, axis=-1))
+
+        print('%gs clips, %d samples:' % (seconds, clip_samples))
+        for name in names:
+            set_backend(name, workers)
+            rfft_abs(clips) # Plans are made here, outside the timing
+
+            batch_time = min(timed(lambda: rfft_abs(clips)) for _ in range(repeats))
+            single = clips[:min(num_clips, 256)]
+            single_time = min(timed(lambda: [rfft_abs(clip[None, :]) for clip in single]) for _ in range(repeats))
+            error = np.max(np.abs(rfft_abs(clips) - expected)) / np.max(expected)
+
+            print('  ' + name.ljust(8), '%10.0f clips/s batched' % (num_clips / batch_time),
+                  '%10.0f clips/s one at a time' % (len(single) / single_time), '  max relative error %.1e' % error)
+
+def timed(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    if len(sys.argv) == 2 and sys.argv[1] == 'list':
+        print('Available:', ', '.join(available_backends()))
+        print('In use:', current_backend())
+        sys.exit()
+
+    parser = argparse.ArgumentParser(prog='fftbackend.py', description='Benchmarks the FFT backends on clip sized transforms')
+    parser.add_argument('mode', choices=['bench'])
+    parser.add_argument('samplerate', type=int, help='Samplerate of the clips')
+    parser.add_argument('seconds', type=float, nargs='+', help='Clip lengths to time')
+    parser.add_argument('--clips', type=int, default=4096, help='Clips per batch')
+    parser.add_argument('--workers', type=int, default=1, help='Threads per transform')
+    args = parser.parse_args()
+
+    bench(args.samplerate, args.seconds, args.clips, args.workers)
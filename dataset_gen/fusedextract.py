@@ -0,0 +1,296 @@
+'''
+**************************************************************************************************
+* Filename:    fusedextract.py                                                                   *
+*                                                                                                *
+* Description: Splits, normalizes and runs the FFT on a full length recording entirely in memory.*
+*              Produces the same rows as running splitaudio.py, normalizedb.py and               *
+*              extractFreqARFF.py one after the other, but no clip is ever written to disk. The  *
+*              recording is streamed a block at a time, so memory use does not grow with its     *
+*              length. The spectra of the clips can be saved to a spectrum cache along the way   *
+*              (see spectrumcache.py).                                                           *
+*                                                                                                *
+*              With a hop shorter than the clip length the clips overlap. They are rows of a     *
+*              strided view of the samples, so overlap costs more FFTs but no more reading or    *
+*              copying of the audio, and 50% overlap about doubles the time spent in the FFT.    *
+*                                                                                                *
+* Usage:       python3 fusedextract.py <file> <seconds> <harmonics> <outfile.csv> [spectra.npz]  *
+*                   <file>        - The full length wav file to analyze                          *
+*                   <seconds>     - How long each clip should be                                 *
+*                   <harmonics>   - Number of harmonics to keep from the FFT                     *
+*                   <outfile.csv> - Headerless csv of raw rows, the same format as the parts     *
+*                                   extractFreqARFF.py merges                                    *
+*                   <spectra.npz> - Optional spectrum cache chunk to write                       *
+*                   --hop <seconds> - Start a clip every this many seconds instead of one after  *
+*                                   the other                                                    *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+
+import numpy as np
+
+from splitaudio import iter_audio_blocks, gate_windows, iter_frame_blocks, gate_frames, frame_view, frame_sizes # pyright: ignore
+from normalizedb import normalize_samples # pyright: ignore
+from extractFreqARFF import gen_FFT_batch, instrument_from_filename # pyright: ignore
+from arffio import write_rows, feature_formats # pyright: ignore
+from spectrumcache import clip_spectra, write_chunk # pyright: ignore
+from clippack import to_pcm16 # pyright: ignore
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             analyze_clips                                                                *
+*                                                                                                *
+* Parameters:       np.array samples      - Float samples holding whole clips, the last one may  *
+*                                           be short                                             *
+*                   np.array keep         - Which clips passed the gate                          *
+*                   int samples_per_split - The number of samples in each clip                   *
+*                   int samplerate        - The sample rate of the samples                       *
+*                   int number_harmonics  - Number of harmonics to keep from the FFT             *
+*                   int target_dBFS       - The level each clip is normalized to                 *
+*                   list spectra          - When given, gets a (spectra, clip index) tuple for   *
+*                                           the full length clips that produced a row            *
+*                   int spectrum_pool     - Bins averaged together in the spectra                *
+*                                                                                                *
+* Returns:          np.array, np.array - The raw feature rows and the index of the clip in       *
+*                                        samples each row came from                              *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def analyze_clips(samples, keep, samples_per_split, samplerate, number_harmonics, target_dBFS=-20, spectra=None,
+                  spectrum_pool=1):
+    num_full = len(samples) // samples_per_split
+    full_clips = samples[:num_full * samples_per_split].reshape(num_full, samples_per_split)
+
+    clip_idx = np.flatnonzero(keep[:num_full])
+    normalized = normalize_samples(to_pcm16(full_clips[clip_idx]), target_dBFS)
+    features = gen_FFT_batch(normalized, samplerate, number_harmonics)
+    if len(features) == 0:
+        clip_idx = clip_idx[:0]
+    elif spectra is not None:
+        spectra.append((clip_spectra(normalized, spectrum_pool), clip_idx))
+
+    # The short clip at the end of a recording
+    if num_full < len(keep) and keep[-1]:
+        last = gen_FFT_batch(normalize_samples(to_pcm16(samples[num_full * samples_per_split:]), target_dBFS),
+                             samplerate, number_harmonics)
+        if len(last) > 0:
+            features = np.concatenate([features, last])
+            clip_idx = np.append(clip_idx, num_full)
+
+    return features, clip_idx
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             analyze_frames                                                               *
+*                                                                                                *
+* Parameters:       np.array samples      - Float samples holding whole clips                    *
+*                   np.array keep         - Which clips passed the gate                          *
+*                   int samples_per_split - The number of samples in each clip                   *
+*                   int hop_samples       - Samples between the starts of neighbouring clips     *
+*                   The rest are the same as analyze_clips                                       *
+*                                                                                                *
+* Purpose:          analyze_clips for overlapping clips. The clips are taken as a strided view   *
+*                   of samples, only the ones that passed the gate are gathered for the FFT      *
+*                                                                                                *
+* Returns:          np.array, np.array - The raw feature rows and the index of the clip in       *
+*                                        samples each row came from                              *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def analyze_frames(samples, keep, samples_per_split, hop_samples, samplerate, number_harmonics, target_dBFS=-20,
+                   spectra=None, spectrum_pool=1):
+    clip_idx = np.flatnonzero(keep)
+    normalized = normalize_samples(to_pcm16(frame_view(samples, samples_per_split, hop_samples)[clip_idx]), target_dBFS)
+    features = gen_FFT_batch(normalized, samplerate, number_harmonics)
+    if len(features) == 0:
+        clip_idx = clip_idx[:0]
+    elif spectra is not None:
+        spectra.append((clip_spectra(normalized, spectrum_pool), clip_idx))
+
+    return features, clip_idx
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             extract_audiofile                                                            *
+*                                                                                                *
+* Parameters:       str filename          - The full length audio file                           *
+*                   float seconds         - How long each clip should be                         *
+*                   int number_harmonics  - Number of harmonics to keep from the FFT             *
+*                   int target_dBFS       - The level each clip is normalized to                 *
+*                   float min_dbfs        - Skip clips quieter than this. None disables the gate *
+*                   bool dedupe           - Skip clips that exactly match an earlier clip        *
+*                   int start_clip        - The first clip to analyze                            *
+*                   int stop_clip         - Stop before this clip. None runs to the end          *
+*                   list spectra          - When given, gets a (samplerate, samples per clip,    *
+*                                           spectra, clip numbers) tuple for each block          *
+*                   int spectrum_pool     - Bins averaged together in the spectra                *
+*                   float hop             - Seconds between the starts of neighbouring clips.    *
+*                                           None puts them back to back. Clip numbers and the    *
+*                                           start and stop clips count hops                      *
+*                                                                                                *
+* Purpose:          The whole split, normalize, FFT chain for one recording, or a range of its   *
+*                   clips, without writing any clips to disk                                     *
+*                                                                                                *
+* Returns:          np.array, np.array, dict - Raw feature rows, the clip number each row came   *
+*                                              from and the gate counts                          *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def extract_audiofile(filename, seconds, number_harmonics, target_dBFS=-20, min_dbfs=None, dedupe=False,
+                      start_clip=0, stop_clip=None, spectra=None, spectrum_pool=1, hop=None):
+    seen_hashes = set() if dedupe else None
+    stats = {'windows': 0, 'written': 0, 'silent': 0, 'duplicate': 0}
+
+    features = []
+    clip_numbers = []
+    first_clip = start_clip
+
+    for samplerate, samples_per_split, hop_samples, samples in iter_blocks(filename, seconds, hop, start_clip, stop_clip):
+        block_spectra = [] if spectra is not None else None
+        if hop_samples is None:
+            keep, num_silent, num_duplicate = gate_windows(samples, samples_per_split, min_dbfs, seen_hashes)
+            block_features, clip_idx = analyze_clips(samples, keep, samples_per_split, samplerate, number_harmonics,
+                                                     target_dBFS, block_spectra, spectrum_pool)
+        else:
+            keep, num_silent, num_duplicate = gate_frames(samples, samples_per_split, hop_samples, min_dbfs, seen_hashes)
+            block_features, clip_idx = analyze_frames(samples, keep, samples_per_split, hop_samples, samplerate,
+                                                      number_harmonics, target_dBFS, block_spectra, spectrum_pool)
+        features.append(block_features)
+        clip_numbers.append(clip_idx + first_clip)
+        for block_spectrum, spectrum_idx in block_spectra or []:
+            spectra.append((samplerate, samples_per_split, block_spectrum, spectrum_idx + first_clip))
+
+        first_clip += len(keep)
+        stats['windows'] += len(keep)
+        stats['written'] += len(clip_idx)
+        stats['silent'] += num_silent
+        stats['duplicate'] += num_duplicate
+
+    if not features:
+        return np.empty((0, 2 * number_harmonics)), np.empty(0, dtype=int), stats
+
+    return np.concatenate(features), np.concatenate(clip_numbers), stats
+
+# The blocks of a file as (samplerate, samples per clip, samples per hop, samples). The hop is None for back to back
+# clips, which keep the short clip at the end of the file
+def iter_blocks(filename, seconds, hop, start_clip=0, stop_clip=None):
+    if hop is None:
+        for samplerate, samples_per_split, samples in iter_audio_blocks(filename, seconds, start_clip=start_clip,
+                                                                        stop_clip=stop_clip):
+            yield samplerate, samples_per_split, None, samples
+        return
+
+    for samplerate, samples_per_split, hop_samples, _, samples in iter_frame_blocks(filename, seconds, hop,
+                                                                                   start_clip=start_clip,
+                                                                                   stop_clip=stop_clip):
+        yield samplerate, samples_per_split, hop_samples, samples
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             sample_rows                                                                  *
+*                                                                                                *
+* Parameters:       np.array samples      - A whole recording already in memory, one row per     *
+*                                           sample and one column per channel or 1d for mono.    *
+*                                           Floats in [-1, 1] or 16 bit integers                 *
+*                   int samplerate        - The sample rate of samples                           *
+*                   float seconds         - How long each clip should be                         *
+*                   int number_harmonics  - Number of harmonics to keep from the FFT             *
+*                   int target_dBFS       - The level each clip is normalized to                 *
+*                   float min_dbfs        - Skip clips quieter than this. None disables the gate *
+*                   float hop             - Seconds between clip starts, None for back to back   *
+*                                                                                                *
+* Purpose:          The rows classinst.py would read back from its cleaned arff file for this    *
+*                   audio: amplitudes are rounded to the 6 places the arff keeps and the rows    *
+*                   cleandata.py would remove are dropped                                        *
+*                                                                                                *
+* Returns:          np.array, np.array - One feature row per clip and the clip number of each    *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def sample_rows(samples, samplerate, seconds, number_harmonics, target_dBFS=-20, min_dbfs=None, hop=None):
+    samples = np.asarray(samples)
+    if samples.ndim == 2:
+        samples = samples.mean(axis=1) if samples.shape[1] > 1 else samples[:, 0]
+    if np.issubdtype(samples.dtype, np.integer):
+        samples = samples / 32768.0
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+
+    samples_per_split, hop_samples = frame_sizes(seconds, hop, samplerate)
+    if hop is None:
+        keep, _, _ = gate_windows(samples, samples_per_split, min_dbfs)
+        rows, clip_idx = analyze_clips(samples, keep, samples_per_split, samplerate, number_harmonics, target_dBFS)
+    else:
+        keep, _, _ = gate_frames(samples, samples_per_split, hop_samples, min_dbfs)
+        rows, clip_idx = analyze_frames(samples, keep, samples_per_split, hop_samples, samplerate, number_harmonics,
+                                        target_dBFS)
+
+    return clean_rows(rows, clip_idx)
+
+# Rounds the rows to the 6 places the arff keeps and drops the ones cleandata.py would, with their clip numbers
+def clean_rows(rows, clip_numbers):
+    rows = np.round(rows, 6)
+    if len(rows) == 0:
+        return rows, clip_numbers
+
+    valid = (rows[:, 0] != 0) & ~np.isnan(rows[:, 0])
+    return rows[valid], clip_numbers[valid]
+
+# The start of each clip in seconds
+def clip_starts(clip_numbers, seconds, hop, samplerate):
+    _, hop_samples = frame_sizes(seconds, hop, samplerate)
+    return clip_numbers * hop_samples / samplerate
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             extract_to_csv                                                               *
+*                                                                                                *
+* Parameters:       str filename   - The full length audio file                                  *
+*                   str outfilename - Where to write the headerless csv of raw rows              *
+*                   str spectra_filename - Where to write the clip spectra as a spectrum cache   *
+*                                          chunk. None skips them                                *
+*                   The rest are passed on to extract_audiofile                                  *
+*                                                                                                *
+* Returns:          dict - The gate counts                                                       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def extract_to_csv(filename, outfilename, seconds, number_harmonics, target_dBFS=-20, min_dbfs=None, dedupe=False,
+                   start_clip=0, stop_clip=None, spectra_filename=None, spectrum_pool=1, hop=None):
+    spectra = [] if spectra_filename is not None else None
+    features, _, stats = extract_audiofile(filename, seconds, number_harmonics, target_dBFS, min_dbfs, dedupe,
+                                           start_clip, stop_clip, spectra, spectrum_pool, hop)
+
+    if spectra:
+        samplerate, samples_per_split = spectra[0][0], spectra[0][1]
+        block_spectra = np.concatenate([block[2] for block in spectra])
+        write_chunk(spectra_filename, block_spectra, [instrument_from_filename(filename)] * len(block_spectra),
+                    samplerate, samples_per_split, spectrum_pool, np.concatenate([block[3] for block in spectra]))
+
+    with open(outfilename, 'w') as outfile:
+        write_rows(outfile, features, [instrument_from_filename(filename)] * len(features),
+                   feature_formats(number_harmonics))
+
+    return stats
+
+__USAGE__ = 'python3 fusedextract.py <file> <seconds> <harmonics> <outfile.csv> [spectra.npz] [--hop <seconds>]'
+
+if __name__ == '__main__':
+    argv = sys.argv
+
+    hop = None
+    if '--hop' in argv and argv.index('--hop') + 1 < len(argv):
+        hop = float(argv[argv.index('--hop') + 1])
+        argv = argv[:argv.index('--hop')] + argv[argv.index('--hop') + 2:]
+    argc = len(argv)
+
+    if argc != 5 and argc != 6:
+        print(__USAGE__)
+        sys.exit(1)
+
+    print(extract_to_csv(argv[1], argv[4], float(argv[2]), int(argv[3]), spectra_filename=argv[5] if argc == 6 else None,
+                         hop=hop))
@@ -0,0 +1,343 @@
+'''
+**************************************************************************************************
+* Filename:    manifest.py                                                                       *
+*                                                                                                *
+* Description: Lists of files passed between the dataset_gen stages. Each stage writes a         *
+*              manifest (_manifest.csv) of the files it wrote into its output folder, and the    *
+*              next stage reads it instead of globbing a folder of millions of clips. Work is    *
+*              handed to the batch subprocesses the same way: each batch gets a small manifest   *
+*              of its inputs, so no paths go through the shell or onto the command line.         *
+*                                                                                                *
+*              One row per file, with what the later stages need to plan their work without      *
+*              opening anything:                                                                 *
+*                                                                                                *
+*                  file,size,duration,label,samplerate,clips,source,offset,dbfs                  *
+*                                                                                                *
+*              file       - Relative to the manifest's folder, or an absolute path for files     *
+*                           elsewhere. May end in @<start>-<stop> for a range of clips           *
+*              size       - Bytes on disk                                                        *
+*              duration   - Seconds of audio, estimated from the size when there is no header    *
+*              label      - The instrument tag                                                   *
+*              samplerate - Blank when unknown                                                   *
+*              clips      - 1 for a wav, the number of clips for a clip pack shard               *
+*              source     - The recording the file was cut from, blank for full recordings       *
+*              offset     - Seconds into the source recording the clip starts, blank if unknown  *
+*              dbfs       - The rms level of the clip, blank when unknown                        *
+*                                                                                                *
+*              A folder without a manifest, from an older run or another tool, gets one built    *
+*              by a single scan the first time it is read. A manifest is trusted after that, so  *
+*              rebuild it if files are added to the folder by hand.                              *
+*                                                                                                *
+* Usage:       python3 manifest.py build <folder> [extension ...]                                *
+*                   (Re)builds the manifest of a folder, of wavs unless other extensions given   *
+*                                                                                                *
+*              python3 manifest.py info <folder>                                                 *
+*                   Prints the number of files, clips, hours of audio and files per instrument   *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import csv
+import glob
+import shutil
+import tempfile
+from collections import Counter
+
+import soundfile as sf
+
+from workplan import duration_cost # pyright: ignore
+from clippack import is_pack, is_shard, read_shard_index, SHARD_EXT # pyright: ignore
+
+MANIFEST_NAME = '_manifest.csv'
+FIELDS = ['file', 'size', 'duration', 'label', 'samplerate', 'clips', 'source', 'offset', 'dbfs']
+# Rows handed out at a time by iter_manifest
+CHUNK_ROWS = 65536
+
+def manifest_filename(folder):
+    return os.path.join(folder, MANIFEST_NAME)
+
+def has_manifest(folder):
+    return os.path.isfile(manifest_filename(folder))
+
+# The name a file is stored under in a manifest kept in base_dir
+def relative_name(path, base_dir):
+    if os.path.dirname(os.path.abspath(path)) == os.path.abspath(base_dir):
+        return os.path.basename(path)
+
+    return os.path.abspath(path)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             describe_file                                                                *
+*                                                                                                *
+* Parameters:       str path     - The file to describe                                          *
+*                   str source   - The recording it was cut from, if any                         *
+*                                                                                                *
+* Purpose:          Makes a manifest row for a file that is already on disk. Wavs only have      *
+*                   their header read, shards only their index                                   *
+*                                                                                                *
+* Returns:          dict - The row, with the full path under 'path'                              *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def describe_file(path, source=''):
+    name = os.path.basename(path)
+    row = {'path': path, 'size': os.path.getsize(path), 'duration': 0.0, 'samplerate': None, 'clips': 1,
+           'source': os.path.basename(source), 'offset': None, 'dbfs': None,
+           # The instrument tag, the same way extractFreqARFF.instrument_from_filename reads it
+           'label': name.split('_')[0]}
+
+    if is_shard(path):
+        entries = read_shard_index(path)
+        labels = set(entry[4] for entry in entries)
+        row['clips'] = len(entries)
+        row['duration'] = sum(entry[2] / entry[5] for entry in entries)
+        row['samplerate'] = entries[0][5] if entries else None
+        row['label'] = labels.pop() if len(labels) == 1 else ''
+        return row
+
+    try:
+        info = sf.info(path)
+        row['duration'] = info.frames / info.samplerate
+        row['samplerate'] = info.samplerate
+    except RuntimeError:
+        row['duration'] = duration_cost(path)
+
+    return row
+
+# A row for a wav clip that was just written, without going back to the disk for its header
+def clip_row(path, num_samples, samplerate, source='', label=None, offset=None, dbfs=None):
+    if label is None:
+        label = os.path.basename(path).split('_')[0]
+
+    return {'path': path, 'size': os.path.getsize(path), 'duration': num_samples / samplerate, 'label': label,
+            'samplerate': samplerate, 'clips': 1, 'source': os.path.basename(source), 'offset': offset, 'dbfs': dbfs}
+
+# A number column, blank for None
+def format_number(value):
+    return '' if value is None else '%.6f' % value
+
+def parse_number(value):
+    return float(value) if value else None
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             open_manifest                                                                *
+*                                                                                                *
+* Parameters:       str filename  - The manifest to append to                                    *
+*                   str base_dir  - The folder file names are relative to. Defaults to the       *
+*                                   manifest's own folder                                        *
+*                                                                                                *
+* Returns:          dict - Pass it to add_row and close_manifest                                 *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def open_manifest(filename, base_dir=None):
+    if base_dir is None:
+        base_dir = os.path.dirname(filename)
+
+    is_new = not os.path.exists(filename)
+    f = open(filename, 'a', newline='')
+    writer = csv.writer(f)
+    if is_new:
+        writer.writerow(FIELDS)
+
+    return {'file': f, 'writer': writer, 'base_dir': base_dir, 'rows': 0}
+
+def add_row(manifest, row):
+    manifest['writer'].writerow([relative_name(row['path'], manifest['base_dir']), row['size'],
+                                 '%.6f' % row['duration'], row['label'],
+                                 '' if row['samplerate'] is None else row['samplerate'], row['clips'], row['source'],
+                                 format_number(row.get('offset')), format_number(row.get('dbfs'))])
+    manifest['rows'] += 1
+
+def close_manifest(manifest):
+    manifest['file'].close()
+
+def write_manifest(filename, rows, base_dir=None):
+    manifest = open_manifest(filename, base_dir)
+    for row in rows:
+        add_row(manifest, row)
+    close_manifest(manifest)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             iter_manifest                                                                *
+*                                                                                                *
+* Parameters:       str filename    - The manifest to read                                       *
+*                   int chunk_rows  - How many rows to hand out at a time                        *
+*                                                                                                *
+* Returns:          generator of [dict] - Rows with the numbers parsed and the full path to      *
+*                   each file under 'path'                                                       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def iter_manifest(filename, chunk_rows=CHUNK_ROWS):
+    base_dir = os.path.dirname(filename)
+
+    chunk = []
+    with open(filename, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            chunk.append({
+                'path': os.path.join(base_dir, row['file']),
+                'size': int(row['size']),
+                'duration': float(row['duration']),
+                'label': row['label'],
+                'samplerate': int(row['samplerate']) if row['samplerate'] else None,
+                'clips': int(row['clips']),
+                'source': row['source'],
+                # Manifests from before these columns were added read as unknown
+                'offset': parse_number(row.get('offset')),
+                'dbfs': parse_number(row.get('dbfs')),
+            })
+
+            if len(chunk) >= chunk_rows:
+                yield chunk
+                chunk = []
+
+    if chunk:
+        yield chunk
+
+def read_manifest(filename):
+    rows = []
+    for chunk in iter_manifest(filename):
+        rows.extend(chunk)
+
+    return rows
+
+# The paths listed in a batch input manifest
+def read_paths(filename):
+    return [row['path'] for row in read_manifest(filename)]
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             build_manifest                                                               *
+*                                                                                                *
+* Parameters:       str folder       - The folder to list                                        *
+*                   str[] extensions - The kinds of file to include                              *
+*                                                                                                *
+* Purpose:          Scans the folder once and writes its manifest. For clip packs the shards     *
+*                   are listed                                                                   *
+*                                                                                                *
+* Returns:          [dict] - The rows written                                                    *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def build_manifest(folder, extensions=('.wav',)):
+    if is_pack(folder):
+        extensions = (SHARD_EXT,)
+
+    with os.scandir(folder) as entries:
+        paths = sorted(entry.path for entry in entries if entry.is_file() and entry.name.endswith(tuple(extensions)))
+    rows = [describe_file(path) for path in paths]
+
+    # Written next to the real manifest and moved over it, so a reader never sees half of one
+    tempfilename = manifest_filename(folder) + '.tmp'
+    if os.path.exists(tempfilename):
+        os.remove(tempfilename)
+    write_manifest(tempfilename, rows, folder)
+    os.replace(tempfilename, manifest_filename(folder))
+
+    return rows
+
+# The rows of a folder's manifest, building it first if the folder does not have one
+def list_inputs(folder, extensions=('.wav',)):
+    if not has_manifest(folder):
+        return build_manifest(folder, extensions)
+
+    return read_manifest(manifest_filename(folder))
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             write_batches                                                                *
+*                                                                                                *
+* Parameters:       [[list, float]] batches - From workplan.plan_batches, each item a manifest   *
+*                                             row or a path                                      *
+*                                                                                                *
+* Purpose:          Writes the inputs of every batch to its own manifest in a new temp folder,   *
+*                   and picks where each batch writes the manifest of its outputs                *
+*                                                                                                *
+* Returns:          str, [(str, str, list)] - The temp folder, and the input manifest, output    *
+*                                             manifest part and items of each batch              *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def write_batches(batches):
+    batch_dir = tempfile.mkdtemp(prefix='batches_')
+
+    planned = []
+    for idx, (items, _) in enumerate(batches):
+        inputs = os.path.join(batch_dir, 'inputs%05d.csv' % idx)
+        # Items only need a path, the batch process does not plan anything
+        write_manifest(inputs, [item if isinstance(item, dict) else empty_row(item) for item in items], batch_dir)
+        planned.append((inputs, os.path.join(batch_dir, 'outputs%05d.csv' % idx), items))
+
+    return batch_dir, planned
+
+def empty_row(path):
+    return {'path': path, 'size': 0, 'duration': 0.0, 'label': '', 'samplerate': None, 'clips': 1, 'source': '',
+            'offset': None, 'dbfs': None}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             merge_manifests                                                              *
+*                                                                                                *
+* Parameters:       str[] parts    - Output manifests written by the batch processes             *
+*                   str folder     - The stage's output folder                                   *
+*                                                                                                *
+* Purpose:          Appends every part to the folder's manifest. Parts that were never written,  *
+*                   because their batch had no output, are skipped                               *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def merge_manifests(parts, folder):
+    filename = manifest_filename(folder)
+    is_new = not os.path.exists(filename)
+
+    with open(filename, 'a', newline='') as outfile:
+        if is_new:
+            csv.writer(outfile).writerow(FIELDS)
+
+        for part in parts:
+            if not os.path.exists(part):
+                continue
+            with open(part, 'r', newline='') as infile:
+                infile.readline() # The header
+                shutil.copyfileobj(infile, outfile)
+
+# Merges the output manifests the batches in batch_dir wrote into the folder's manifest and removes batch_dir
+def merge_batches(batch_dir, folder):
+    merge_manifests(sorted(glob.glob(os.path.join(batch_dir, 'outputs*.csv'))), folder)
+    shutil.rmtree(batch_dir)
+
+def print_info(folder):
+    rows = list_inputs(folder)
+
+    counts = Counter(row['label'] for row in rows)
+    print(folder + ':', len(rows), 'files,', sum(row['clips'] for row in rows), 'clips,',
+          '%.2f hours' % (sum(row['duration'] for row in rows) / 3600), '%.1f MB' % (sum(row['size'] for row in rows) / 1e6))
+    for inst, count in counts.most_common():
+        print('  ' + inst.ljust(12), count)
+
+__USAGE__ = 'python3 manifest.py build <folder> [extension ...]\n'\
+        'python3 manifest.py info <folder>'
+
+if __name__ == '__main__':
+    argv = sys.argv
+    argc = len(argv)
+
+    if argc >= 3 and argv[1] == 'build':
+        rows = build_manifest(argv[2], tuple(argv[3:]) or ('.wav',))
+        print('Listed', len(rows), 'files in', manifest_filename(argv[2]))
+    elif argc == 3 and argv[1] == 'info':
+        print_info(argv[2])
+    else:
+        print(__USAGE__)
+        sys.exit(1)
@@ -27,17 +27,33 @@
 *                   <outdir>        - Where to place the file                                    *
 *                   <filelist>      - A space delimited list of files to process                 *
 *                                                                                                *
+*             <indir> can also be a clip pack, and <filelist> can hold pack shards (clippack.py) *
+*             Add --pack to -m or -b to write the normalized clips into a pack at <outdir>       *
+*             -b also takes --inputs <manifest> to read its files from a manifest (manifest.py)  *
+*             and --manifest <file> to list the files it writes. -m reads the manifest of        *
+*             <indir> and writes one for <outdir>, and takes --catalog <db> to record the        *
+*             normalized clips in a catalog.py catalog                                           *
+*                                                                                                *
 **************************************************************************************************
 '''
 
 import os
-import glob
-import subprocess
 import sys
-from math import ceil
+import argparse
+from math import ceil, log
 
 from pydub import AudioSegment, effects
-import tqdm
+import numpy as np
+from scipy.io import wavfile
+
+from procpool import run_commands, parse_max_processes, planned_workers # pyright: ignore
+from workplan import num_batches, plan_batches # pyright: ignore
+from catalog import record_stage # pyright: ignore
+from manifest import list_inputs, read_manifest, open_manifest, add_row, close_manifest, clip_row, describe_file, write_batches, merge_batches, manifest_filename # pyright: ignore
+from clippack import is_shard, iter_shard_batches, open_writer, write_clip, close_writer, to_pcm16 # pyright: ignore
+
+# The most clips one normalize command is given
+FILES_PER_PROCESS = 150
 
 # TODO : Delete once the normalize_audio method is confirmed working
 # def match_target_amplitude(sound, target_dBFS):
@@ -55,6 +71,8 @@ import tqdm
 *                                                                                                *
 * Purpose:          Normalizes the db level of an audio file using pydub                         * 
 *                                                                                                *
+* Returns:          str - The normalized file                                                    *
+*                                                                                                *
 * ********************************************************************************************** *
 '''
 def normalize_audio(filename, outpath, target_dBFS=-20):
@@ -67,107 +85,142 @@ def normalize_audio(filename, outpath, target_dBFS=-20):
     normalized_sound = sound.apply_gain(change_in_dBFS)
     # normalized_sound = match_target_amplitude(sound, target_dBFS)
     normalized_sound.export(outpath +  noext[0] + '_norm.' + noext[1], format='wav')
+
+    return outpath +  noext[0] + '_norm.' + noext[1]
     
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             normalize_samples                                                            *
+*                                                                                                *
+* Parameters:       np.array clips      - 2d array of 16 bit samples, one clip per row           *
+*                   int target_dBFS     - The target db level                                    *
+*                                                                                                *
+* Purpose:          Does the same gain change as normalize_audio for every clip at once without  *
+*                   touching the disk. Clips of pure silence are left as they are                *
+*                                                                                                *
+* Returns:          np.array - The normalized 16 bit clips                                       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def normalize_samples(clips, target_dBFS=-20):
+    clips = np.asarray(clips, dtype=np.float64)
+    # pydub's rms comes from audioop, which truncates it to an integer
+    rms = np.floor(np.sqrt(np.mean(np.square(clips), axis=-1)))
+
+    # Same as pydub, gain of (target_dBFS - sound.dBFS) where dBFS is relative to the max 16 bit amplitude. Worked
+    # out a clip at a time with math.log like pydub, numpy's vectorized log can round the last bit differently
+    # and that is enough to change a sample
+    gain = [10 ** ((target_dBFS - 20 * log(value / 32768, 10)) / 20) if value > 0 else 1.0 for value in rms.ravel()]
+    gain = np.array(gain).reshape(rms.shape + (1,))
+
+    return np.floor(np.clip(clips * gain, -32768, 32767)).astype(np.int16)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             normalize_clips                                                              *
+*                                                                                                *
+* Parameters:       str filename      - A clip pack shard, or a single wav clip                  *
+*                   str outpath       - The path to place normalized files in                    *
+*                   int target_dBFS   - The target db level                                      *
+*                   dict writer       - A clip pack writer. None writes wavs into outpath        *
+*                   dict manifest     - From manifest.open_manifest, gets a row for each wav     *
+*                                       written                                                  *
+*                                                                                                *
+* Purpose:          Normalizes with normalize_samples instead of pydub, a whole run of clips of  *
+*                   a shard at a time. Output clips are named the same as normalize_audio names  *
+*                   them                                                                         *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def normalize_clips(filename, outpath, target_dBFS=-20, writer=None, manifest=None):
+    if is_shard(filename):
+        batches = iter_shard_batches(filename)
+    else:
+        samplerate, data = wavfile.read(filename)
+        if data.ndim > 1:
+            data = data.mean(axis=1)
+        if data.dtype.kind == 'f':
+            data = to_pcm16(data)
+
+        name = os.path.split(filename)[1]
+        # Entries in the same form as a shard index, the instrument tag read like instrument_from_filename
+        batches = [(samplerate, [(name, 0, len(data), name, name.split('_')[0], samplerate)], data[None, :])]
+
+    for samplerate, entries, clips in batches:
+        normalized = normalize_samples(clips, target_dBFS)
+
+        for entry, clip in zip(entries, normalized):
+            noext = os.path.splitext(entry[0])
+            out_name = noext[0] + '_norm' + noext[1]
+
+            if writer is not None:
+                write_clip(writer, out_name, clip, samplerate, entry[3], entry[4])
+            else:
+                wavfile.write(outpath + out_name, samplerate, clip)
+                if manifest is not None:
+                    add_row(manifest, clip_row(outpath + out_name, len(clip), samplerate, entry[3], entry[4],
+                                               dbfs=target_dBFS))
+
 '''
 * ********************************************************************************************** *
 *                                                                                                *
 * Name:             append_cmd                                                                   *
 *                                                                                                *
-* Parameters:       str[] filenames - The filenames to be appended on to the normalize cmd       *
+* Parameters:       str inputs      - Manifest of the files the command normalizes               *
+*                   str outputs     - Where the command writes the manifest of its files         *
 *                   str outdir      - The path to place normalized files in                      *
 *                   int target_dBFS - The target db level                                        *
 *                                                                                                *
-* Purpose:          Takes in a list of filenames and returns a completed batch mode command for  *
-*                   this script so that multithread_normalize can split up a massive list of     *
-*                   files between threads.                                                       *
+* Purpose:          Returns a completed batch mode command for this script so that               *
+*                   multithread_normalize can split up a massive list of files between threads.  *
+*                   The files are passed in a manifest rather than on the command line           *
 *                                                                                                *
-* Returns:          str - the filled out command template                                        *
+* Returns:          str[] - The command as a list of arguments                                   *
 *                                                                                                *
 * ********************************************************************************************** *
 '''
-def append_cmd(filenames, outdir, target_dBFS=-20):
-    cmd = 'python3 normalizedb.py -b ' + str(target_dBFS) + ' ' + outdir 
+def append_cmd(inputs, outputs, outdir, target_dBFS=-20, pack=False):
+    cmd = ['python3', 'normalizedb.py', '-b', str(target_dBFS), outdir, '--inputs', inputs, '--manifest', outputs]
+    if pack:
+        cmd.append('--pack')
 
-    process_cmd = cmd
-    for file in filenames:
-        process_cmd += ' ' + file
-    
-    return process_cmd
+    return cmd
 
 '''
 * ********************************************************************************************** *
 *                                                                                                *
 * Name:             make_cmds_arr                                                                *
 *                                                                                                *
-* Parameters:       str[] filenames   - The filenames to create commands for                     *
+* Parameters:       [dict] rows       - Manifest rows of the files to create commands for        *
 *                   str outdir        - The path to place normalized files in                    *
 *                   int max_processes - The maximum number of threads to be used at any one time *
 *                   int target_dBFS   - The target db level                                      *
 *                                                                                                *
-* Purpose:          Takes in a list of filenames and returns a 2d array with each element        *
-*                   containing a str in element zero, which is the command to process a          *
-*                   chunk of files, and an int in element 1 which is how many files that cmd     *
-*                   will process                                                                 *
+* Purpose:          Takes in a list of files and returns a 2d array with each element            *
+*                   containing a command in element zero, which processes a chunk of files, and  *
+*                   an int in element 1 which is how many clips that cmd will process. Files are *
+*                   shared out by their size in the manifest with workplan.py, so every command  *
+*                   does about the same amount of work, and the largest go first                 *
 *                                                                                                *
-* Returns:          [[str, int]] - str - the filled out command template                         *
-*                                  int - the number of files that command will process           *
+* Returns:          [[str[], int]], str - The commands and the clips each will process, and the  *
+*                                         temp folder of batch manifests to pass to              *
+*                                         manifest.merge_batches once they have run              *
 *                                                                                                *
 * ********************************************************************************************** *
 '''
-def make_cmds_arr(filenames, outdir, max_processes, target_dBFS=-20):
-    num_files = len(filenames) 
-    files_per_process = 150
-    num_processes = num_files // files_per_process
-    
-    if files_per_process == 0:
-        if num_files < max_processes:
-            files_per_process = 1
-        else:
-            files_per_process = filenames // max_processes 
+def make_cmds_arr(rows, outdir, max_processes, target_dBFS=-20, pack=False):
+    costs = [row['size'] for row in rows]
+    batches = num_batches(len(rows), max_processes, FILES_PER_PROCESS)
+    batch_dir, planned = write_batches(plan_batches(rows, costs, batches))
 
     cmds = []
-    start_idx = 0
-
-    for _ in range(0, num_processes):
-        end_idx = start_idx + files_per_process
-        
-        # Edge case checking
-        # Case reached if we have less files than max_processes or we somehow over reach array bounds
-        # Any extra files will get caught by leftover filenames
-        if end_idx > num_files: 
-            break
-        
-        process_files = filenames[start_idx:end_idx]
-
-        # Edge case - if somehow we get a blank array skip this array
-        # Would only happnen if my process splitting code failed
-        if len(process_files) == 0:
-            continue
-
-        process_cmd = append_cmd(process_files, outdir, target_dBFS)
-        cmds.append([process_cmd, len(process_files)])
-        start_idx = end_idx
-    
-    
-    leftover_filenames = filenames[start_idx:len(filenames)]
-    if len(leftover_filenames) > 0:
-        cmds.append([append_cmd(leftover_filenames, outdir, target_dBFS), len(leftover_filenames)])
-
-    '''
-    for _ in range(max_processes * numrounds):
-        end_idx = start_idx + files_per_process
-        process_files = filenames[start_idx:end_idx]
-        
-        process_cmd = append_cmd(process_files, outdir, target_dBFS) 
-        
-        cmds.append([process_cmd, len(process_files)])
-        print(len(process_files))
-        start_idx = end_idx
-    
-    leftover_filenames = filenames[start_idx:len(filenames)] 
-    cmds.append([append_cmd(leftover_filenames, outdir, target_dBFS), len(leftover_filenames)])
-    '''
-    return cmds
+    for inputs, outputs, process_rows in planned:
+        process_cmd = append_cmd(inputs, outputs, outdir, target_dBFS, pack)
+        cmds.append([process_cmd, sum(row['clips'] for row in process_rows)])
+
+    return cmds, batch_dir
 
 '''
 * ********************************************************************************************** *
@@ -177,14 +230,41 @@ def make_cmds_arr(filenames, outdir, max_processes, target_dBFS=-20):
 * Parameters:       str[] filenames   - The filenames to create commands for                     *
 *                   str outdir        - The path to place normalized files in                    *
 *                   int target_dBFS   - The target db level                                      *
+*                   str manifest_filename - Where to append a manifest row for every file        *
+*                                       written. None writes no manifest                         *
+*                   [dict] inputs     - The manifest row of each file. Its source and offset are *
+*                                       copied to the rows of the files written                  *
 *                                                                                                *
 * Purpose:          Takes in a list of filenames and normalizes them all with 1 thread           * 
 *                                                                                                *
 * ********************************************************************************************** *
 '''
-def batch_normalize(filenames, outdir, target_dBFS=-20):
-    for filename in filenames:
-        normalize_audio(filename, outdir, target_dBFS)
+def batch_normalize(filenames, outdir, target_dBFS=-20, pack=False, manifest_filename=None, inputs=None):
+    writer = open_writer(outdir) if pack else None
+    manifest = open_manifest(manifest_filename, outdir) if manifest_filename else None
+    if inputs is None:
+        inputs = [None] * len(filenames)
+
+    for filename, input_row in zip(filenames, inputs):
+        if writer is not None or is_shard(filename):
+            normalize_clips(filename, outdir, target_dBFS, writer, manifest)
+        else:
+            outfile = normalize_audio(filename, outdir, target_dBFS)
+            if manifest is not None:
+                row = describe_file(outfile)
+                row['dbfs'] = target_dBFS
+                if input_row is not None:
+                    row['source'], row['offset'] = input_row['source'], input_row['offset']
+                add_row(manifest, row)
+
+    if writer is not None:
+        close_writer(writer)
+        if manifest is not None:
+            for shard in writer['finished']:
+                add_row(manifest, describe_file(shard))
+
+    if manifest is not None:
+        close_manifest(manifest)
 
 '''
 * ********************************************************************************************** *
@@ -193,46 +273,33 @@ def batch_normalize(filenames, outdir, target_dBFS=-20):
 *                                                                                                *
 * Parameters:       str[] filenames   - The filenames to create commands for                     *
 *                   str outdir        - The path to place normalized files in                    *
-*                   int max_processes - The maximum number of threads to be used at any one time *
+*                   max_processes     - The maximum number of threads to be used at any one time,*
+*                                       or 'auto' to adjust it as it runs (see procpool.py)      *
 *                   int target_dBFS   - The target db level                                      *
 *                                                                                                *
 * Purpose:          Normalizes all files stored in indir, spawns subprocesses to do this and will*
-*                   not exceed max_processes subprocesses                                        *
+*                   not exceed max_processes subprocesses. The files come from the manifest of   *
+*                   indir, and a manifest of the normalized files is written to outdir. Given a  *
+*                   catalog (catalog.py), the normalized clips are recorded in it at the end     *
 *                                                                                                *
 * ********************************************************************************************** *
 '''
-def multithread_normalize(indir, outdir, max_processes, target_dBFS=-20):
-    filenames = glob.glob(indir + '*.wav') # locate all wavfiles in the supplied dir
+def multithread_normalize(indir, outdir, max_processes, target_dBFS=-20, pack=False, catalog=None):
+    rows = list_inputs(indir) # all wavfiles, or pack shards, in the supplied dir
+
+    # The batch processes append to the manifest, so start a fresh one
+    if os.path.exists(manifest_filename(outdir)):
+        os.remove(manifest_filename(outdir))
 
     if max_processes == 1: # If we're only running 1 process there is not need to split the workload
-        batch_normalize(filenames, outdir, target_dBFS)
-        return
+        batch_normalize([row['path'] for row in rows], outdir, target_dBFS, pack, manifest_filename(outdir), rows)
+    else:
+        cmds, batch_dir = make_cmds_arr(rows, outdir, planned_workers(max_processes), target_dBFS, pack) # Generates all of the commands we need
+        run_commands(cmds, max_processes, 'Normalizing dbfs')
+        merge_batches(batch_dir, outdir)
 
-    cmds = make_cmds_arr(filenames, outdir, max_processes) # Generates all of the commands we need
-    running_processes = []
-    
-    pbar = tqdm.tqdm(desc='Normalizing dbfs', total=len(filenames))
-
-    while cmds:
-        while len(running_processes) < max_processes:
-            cmd_and_count = cmds.pop()
-            # Pass on the selected process along with the number of files it will normalize 
-            running_processes.append([subprocess.Popen(cmd_and_count[0], shell=True), cmd_and_count[1]])
-        
-        # See if any of the processes have completed, and remove them if they are
-        completed_processes = []
-        for cmd_and_count in running_processes:
-            if cmd_and_count[0].poll() is not None:
-                completed_processes.append(cmd_and_count)
-                pbar.update(cmd_and_count[1])
-
-        for process in completed_processes:
-            running_processes.remove(process)
-    
-    # Wait for all processes to complete once all cmds have been run
-    for cmd_and_count in running_processes:
-        cmd_and_count[0].wait()
-        pbar.update(cmd_and_count[1])
+    if catalog is not None:
+        print('Recorded', record_stage(catalog, 'normalize', outdir), 'clips in', catalog)
 
 __USAGE__ = \
         'Normalizes a file or group of files to a target decible level\n'\
@@ -241,25 +308,38 @@ __USAGE__ = \
         'python3 normalizedb.py -b <dBFS> <outdir> <file1 ... file2 ... filen> - Normalize all files passed on the command line'
 
 if __name__ == "__main__":
-    argc = len(sys.argv)
-    argv = sys.argv
+    # The -- options can go anywhere, everything else is positional
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--pack', action='store_true', default=False)
+    parser.add_argument('--inputs', default=None)
+    parser.add_argument('--manifest', default=None)
+    parser.add_argument('--catalog', default=None)
+    options, argv = parser.parse_known_args()
+    argv = [sys.argv[0]] + argv
+    pack = options.pack
+    argc = len(argv)
     
-    if argv[1] == '-b' and argc > 4: # Batch normalization
+    if argv[1] == '-b' and (argc > 4 or options.inputs): # Batch normalization
         target_dBFS = int(argv[2])
         outdir = argv[3]
 
         filenames = [x for x in argv[4:argc]] # pulls in every argument after the outdir
+        inputs = [None] * len(filenames)
+        if options.inputs:
+            rows = read_manifest(options.inputs)
+            filenames.extend(row['path'] for row in rows)
+            inputs.extend(rows)
 
         os.makedirs(outdir, exist_ok=True) # Make sure we have a dir to put everything into
-        batch_normalize(filenames, outdir, target_dBFS)
+        batch_normalize(filenames, outdir, target_dBFS, pack, options.manifest, inputs)
 
     elif argv[1] == '-m' and argc == 6: # Multithreaded normalization
         target_dBFS = int(argv[2])
         indir = argv[3]
         outdir = argv[4]
-        max_processes = int(argv[5])
+        max_processes = parse_max_processes(argv[5])
 
-        multithread_normalize(indir, outdir, max_processes, target_dBFS)
+        multithread_normalize(indir, outdir, max_processes, target_dBFS, pack, options.catalog)
     elif argv[1] == '-s' and argc == 5: # Single file normalization
         target_dBFS = int(argv[2]) 
         filename = argv[3]
@@ -0,0 +1,210 @@
+'''
+**************************************************************************************************
+* Filename:    partitioned.py                                                                    *
+*                                                                                                *
+* Description: Stores a dataset as one arff file per instrument label instead of one big arff.  *
+*              Each partition is a complete arff file that Weka can still open. An index file    *
+*              (_partitions.json) records the row count and per attribute min/max/mean of every  *
+*              partition so loaders can read only the instruments they need without opening the  *
+*              rest of the dataset.                                                              *
+*                                                                                                *
+* Usage:       python3 partitioned.py <infile.arff> <outdir> - partitions an existing arff file  *
+*                   <infile.arff> - The dataset to partition. Should already be cleaned          *
+*                   <outdir>      - The directory to write the partitions and index into         *
+*                                                                                                *
+**************************************************************************************************
+'''
+import csv
+import sys
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from arffio import attribute_names, make_header, read_header, read_arff_frame, harmonic_columns # pyright: ignore
+
+INDEX_FILENAME = '_partitions.json'
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             write_partitioned                                                            *
+*                                                                                                *
+* Parameters:       str outdir              - The directory to place the partitions in           *
+*                   str relation            - The arff relation name                             *
+*                   int number_harmonics    - The number of harmonics in each row                *
+*                   iter rows               - Rows of strings with the instrument as the last    *
+*                                             element                                            *
+*                   bool clean              - Drop rows cleandata.py would remove (0.0, nan and  *
+*                                             short rows)                                        *
+*                                                                                                *
+* Purpose:          Streams rows into one arff file per instrument and writes the partition      *
+*                   index once every row has been seen                                           *
+*                                                                                                *
+* Returns:          dict - The partition index that was written                                  *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def write_partitioned(outdir, relation, number_harmonics, rows, clean=True):
+    os.makedirs(outdir, exist_ok=True)
+
+    names = attribute_names(number_harmonics)
+    numcols = len(names) + 1
+    files = {}
+    writers = {}
+    counts = {}
+    mins = {}
+    maxs = {}
+    sums = {}
+
+    for row in rows:
+        if clean and len(row) != numcols:
+            continue
+
+        values = np.array(row[:-1], dtype=float)
+        if clean and (values[0] == 0.0 or np.isnan(values[0])):
+            continue
+
+        inst = row[-1]
+        if inst not in writers:
+            files[inst] = open(os.path.join(outdir, inst + '.arff'), 'w', newline='')
+            files[inst].writelines(make_header(relation, number_harmonics, [inst]))
+            writers[inst] = csv.writer(files[inst])
+            counts[inst] = 0
+            mins[inst] = np.full(len(names), np.inf)
+            maxs[inst] = np.full(len(names), -np.inf)
+            sums[inst] = np.zeros(len(names))
+
+        writers[inst].writerow(row)
+
+        counts[inst] += 1
+        np.minimum(mins[inst], values, out=mins[inst])
+        np.maximum(maxs[inst], values, out=maxs[inst])
+        sums[inst] += values
+
+    for file in files.values():
+        file.close()
+
+    index = {'relation': relation, 'attributes': names, 'partitions': {}}
+    for inst in sorted(counts):
+        index['partitions'][inst] = {
+            'file': inst + '.arff',
+            'rows': counts[inst],
+            'stats': {
+                name: {'min': float(mins[inst][idx]), 'max': float(maxs[inst][idx]),
+                       'mean': float(sums[inst][idx] / counts[inst])}
+                for idx, name in enumerate(names)
+            },
+        }
+
+    with open(os.path.join(outdir, INDEX_FILENAME), 'w') as f:
+        json.dump(index, f, indent=1)
+
+    return index
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             partition_arff                                                               *
+*                                                                                                *
+* Parameters:       str arff_filename - The arff file to split up by instrument                  *
+*                   str outdir        - The directory to place the partitions in                 *
+*                                                                                                *
+* Purpose:          Converts an existing single file dataset into the partitioned layout         *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def partition_arff(arff_filename, outdir):
+    names, _, header_len = read_header(arff_filename)
+
+    file = open(arff_filename, 'r')
+    for _ in range(header_len):
+        file.readline()
+
+    relation = os.path.splitext(os.path.split(arff_filename)[1])[0]
+    # The last attribute is the instrument, the rest are ampl/freq pairs
+    index = write_partitioned(outdir, relation, (len(names) - 1) // 2, csv.reader(file))
+
+    file.close()
+
+    return index
+
+def is_partitioned(path):
+    return os.path.isfile(os.path.join(path, INDEX_FILENAME))
+
+def read_index(dataset_dir):
+    with open(os.path.join(dataset_dir, INDEX_FILENAME), 'r') as f:
+        return json.load(f)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             partition_files                                                              *
+*                                                                                                *
+* Parameters:       str dataset_dir            - A partitioned dataset directory                 *
+*                   str[] enabled_instruments  - The instruments to read, ['all'] for every one  *
+*                                                                                                *
+* Purpose:          Finds which partition files hold the requested instruments. Only the index  *
+*                   is read, so nothing is opened for instruments that are not wanted            *
+*                                                                                                *
+* Returns:          [str], int, int - The partition filenames, the rows they hold, and the       *
+*                                     rows in the whole dataset                                  *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def partition_files(dataset_dir, enabled_instruments = ['all']):
+    index = read_index(dataset_dir)
+
+    filenames = []
+    selected_rows = 0
+    total_rows = 0
+    for inst, partition in index['partitions'].items():
+        total_rows += partition['rows']
+        if enabled_instruments == ['all'] or inst in enabled_instruments:
+            filenames.append(os.path.join(dataset_dir, partition['file']))
+            selected_rows += partition['rows']
+
+    return filenames, selected_rows, total_rows
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             load_partitions                                                              *
+*                                                                                                *
+* Parameters:       str dataset_dir            - A partitioned dataset directory                 *
+*                   str[] enabled_instruments  - The instruments to read, ['all'] for every one  *
+*                   int number_harmonics       - Only read this many leading harmonics. None     *
+*                                                reads every harmonic                            *
+*                                                                                                *
+* Purpose:          Loads only the partitions for the requested instruments into one dataframe  *
+*                   with the instrument as the last column                                       *
+*                                                                                                *
+* Returns:          pd.DataFrame - The selected rows                                             *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def load_partitions(dataset_dir, enabled_instruments = ['all'], number_harmonics=None):
+    index = read_index(dataset_dir)
+    filenames, selected_rows, total_rows = partition_files(dataset_dir, enabled_instruments)
+    print('Reading', selected_rows, 'of', total_rows, 'rows from', len(filenames), 'partitions')
+
+    frames = [read_arff_frame(filename, number_harmonics=number_harmonics) for filename in filenames]
+    if not frames:
+        return pd.DataFrame(columns=harmonic_columns(index['attributes'] + ['instrument'], number_harmonics))
+
+    return pd.concat(frames, ignore_index=True)
+
+__USAGE__ = 'python3 partitioned.py <infile.arff> <outdir> - partitions an existing arff file by instrument'
+
+if __name__ == "__main__":
+    argv = sys.argv
+    argc = len(argv)
+
+    if argc != 3:
+        print(__USAGE__)
+        sys.exit(1)
+
+    index = partition_arff(argv[1], argv[2])
+    for inst, partition in index['partitions'].items():
+        print(inst + ':', partition['rows'], 'rows')
@@ -0,0 +1,304 @@
+'''
+**************************************************************************************************
+* Filename:    pipeline.py                                                                       *
+*                                                                                                *
+* Description: Builds the dataset with every stage running at the same time. Instead of waiting  *
+*              for all downloads to finish before converting anything, each source file moves on *
+*              to the next stage as soon as it is ready:                                         *
+*                                                                                                *
+*                  download -> convert -> extract (split, normalize and FFT in memory)           *
+*                                                                                                *
+*              Stages are connected by bounded queues. When a stage falls behind, the queue in   *
+*              front of it fills up and the stages before it wait, so a fast download never      *
+*              piles up more converted audio on disk than the extractors can keep up with. Each  *
+*              stage has its own number of worker processes.                                     *
+*                                                                                                *
+* Usage:       python3 pipeline.py <links.csv> <outfile.arff> [options]                          *
+*              python3 pipeline.py --from convert <audio dir> <outfile.arff> [options]           *
+*              python3 pipeline.py --from extract <wav dir> <outfile.arff> [options]             *
+*                   Run with --help for the worker counts and dataset settings                   *
+*                                                                                                *
+**************************************************************************************************
+'''
+import os
+import csv
+import glob
+import time
+import shutil
+import argparse
+import threading
+import multiprocessing
+from queue import Empty
+
+from converttowav import convert_to_wav # pyright: ignore
+from fusedextract import extract_to_csv # pyright: ignore
+from extractFreqARFF import combine_batches # pyright: ignore
+from spectrumcache import write_index # pyright: ignore
+from procpool import parse_max_processes, initial_workers, percentile # pyright: ignore
+from workplan import size_cost # pyright: ignore
+from manifest import list_inputs # pyright: ignore
+
+# Put on a queue once per downstream worker to tell it there is no more work
+STOP = None
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Stage functions. Each takes one item and the config dict and returns the item for the next     *
+* stage, or None to drop it.                                                                     *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def download_stage(item, config):
+    from audiodl import download_audio # pytube is only needed when downloading
+
+    instrument, link = item
+    return download_audio(link, instrument, config['download_dir'])
+
+def convert_stage(filename, config):
+    outfilename = config['wav_dir'] + os.path.splitext(os.path.split(filename)[1])[0] + '.wav'
+    # Lets a rerun pick up where it left off without ffmpeg asking to overwrite
+    if os.path.exists(outfilename):
+        return outfilename
+
+    return convert_to_wav(filename, config['wav_dir'])
+
+def extract_stage(filename, config):
+    name = os.path.splitext(os.path.split(filename)[1])[0]
+    shard = config['shard_dir'] + name + '.csv'
+    spectra_filename = None
+    if config.get('spectra_dir'):
+        spectra_filename = config['spectra_dir'] + name + '.npz'
+
+    extract_to_csv(filename, shard, config['seconds'], config['harmonics'], config['dbfs'], config['gatedb'],
+                   config['dedupe'], spectra_filename=spectra_filename, spectrum_pool=config.get('pool', 1),
+                   hop=config.get('hop'))
+    return shard
+
+STAGES = {
+    'download': download_stage,
+    'convert': convert_stage,
+    'extract': extract_stage,
+}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             stage_worker                                                                 *
+*                                                                                                *
+* Parameters:       str name       - The stage this worker runs                                  *
+*                   Queue inqueue  - Items to process, STOP ends the worker                      *
+*                   Queue outqueue - Where results go. Blocks when the next stage is behind      *
+*                   Queue stats    - Gets a (stage, seconds busy) tuple for every item, and a    *
+*                                    (stage, STOP) as the worker's last message before it exits  *
+*                   dict config    - Directories and dataset settings                            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def stage_worker(name, inqueue, outqueue, stats, config):
+    func = STAGES[name]
+
+    while True:
+        item = inqueue.get()
+        if item is STOP:
+            break
+
+        start = time.time()
+        try:
+            result = func(item, config)
+        except Exception as e:
+            print('Stage', name, 'failed on', item, '-', e)
+            result = None
+        stats.put((name, time.time() - start))
+
+        if result is not None:
+            outqueue.put(result)
+
+    stats.put((name, STOP))
+
+def feed(inqueue, items, num_workers):
+    for item in items:
+        inqueue.put(item)
+    for _ in range(num_workers):
+        inqueue.put(STOP)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             run_pipeline                                                                 *
+*                                                                                                *
+* Parameters:       list items        - The input to the first stage: (instrument, link) pairs  *
+*                                       for download, or audio file paths                        *
+*                   str first_stage   - Which stage the items go into                            *
+*                   str outfilename   - The arff file to build                                   *
+*                   dict workers      - Number of worker processes for each stage                *
+*                   int queue_size    - How many items may wait between two stages               *
+*                   dict config       - Directories and dataset settings                         *
+*                   bool partitioned  - Write one arff per instrument instead                    *
+*                                                                                                *
+* Purpose:          Starts every stage's workers, feeds the items in, and shuts each stage down  *
+*                   once the stage before it has finished. Prints how long each stage spent busy *
+*                   next to the total time, which should be close to the busiest stage's time.   *
+*                   The stats and shard queues are read the whole time, a worker cannot exit     *
+*                   until everything it put on a queue has been read                             *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def run_pipeline(items, first_stage, outfilename, workers, queue_size, config, partitioned=False):
+    stage_names = list(STAGES.keys())
+    stage_names = stage_names[stage_names.index(first_stage):]
+
+    # Each stage writes into the directory named after its output
+    stage_dirs = {'download': 'download_dir', 'convert': 'wav_dir', 'extract': 'shard_dir'}
+    for name in stage_names:
+        os.makedirs(config[stage_dirs[name]], exist_ok=True)
+    if config.get('spectra_dir'):
+        os.makedirs(config['spectra_dir'], exist_ok=True)
+
+    start = time.time()
+
+    # One queue in front of every stage, plus one unbounded queue collecting the finished shards
+    queues = [multiprocessing.Queue(queue_size) for _ in stage_names]
+    queues.append(multiprocessing.Queue())
+    stats = multiprocessing.Queue()
+
+    processes = []
+    for idx, name in enumerate(stage_names):
+        stage_processes = [multiprocessing.Process(target=stage_worker, args=(name, queues[idx], queues[idx + 1], stats, config))
+                           for _ in range(workers[name])]
+        for process in stage_processes:
+            process.start()
+        processes.append(stage_processes)
+
+    # Fed from a thread, it blocks whenever the first stage is full while this one keeps reading the stats
+    feeder = threading.Thread(target=feed, args=(queues[0], items, len(processes[0])), daemon=True)
+    feeder.start()
+
+    # Stop each stage in order, a stage is only told to stop once every worker before it has sent its STOP.
+    # That is also the last thing a worker puts on stats, so once the last stage has sent them all the stats
+    # have all been read
+    shards = []
+    # How long each item took in each stage, for the tail latency
+    durations = {name: [] for name in stage_names}
+    finished = [0 for _ in stage_names]
+    idx = 0
+    while idx < len(stage_names):
+        try:
+            name, seconds = stats.get(timeout=0.1)
+            if seconds is STOP:
+                finished[stage_names.index(name)] += 1
+            else:
+                durations[name].append(seconds)
+        except Empty:
+            # A worker that was killed never sends its STOP
+            if not any(process.is_alive() for process in processes[idx]):
+                finished[idx] = len(processes[idx])
+
+        while not queues[-1].empty():
+            shards.append(queues[-1].get())
+
+        while idx < len(stage_names) and finished[idx] >= len(processes[idx]):
+            idx += 1
+            if idx < len(stage_names):
+                for _ in processes[idx]:
+                    queues[idx].put(STOP)
+
+    # The last shards can still be on their way through the queue's pipe
+    for process in processes[-1]:
+        while process.is_alive():
+            process.join(0.1)
+            while not queues[-1].empty():
+                shards.append(queues[-1].get())
+    while not queues[-1].empty():
+        shards.append(queues[-1].get())
+    for stage_processes in processes:
+        for process in stage_processes:
+            process.join()
+
+    elapsed = time.time() - start
+
+    busy = {name: sum(durations[name]) for name in stage_names}
+
+    combine_batches(sorted(shards), outfilename, config['harmonics'], partitioned)
+    if config.get('spectra_dir'):
+        write_index(config['spectra_dir'])
+
+    print('Pipeline finished in %.1fs' % elapsed)
+    print('=================================')
+    for name in stage_names:
+        # Busy time divided by workers is roughly how long the stage would take on its own
+        print(name.ljust(9), len(durations[name]), 'items', '%.1fs busy' % busy[name],
+              '%.1fs per worker' % (busy[name] / workers[name]), end='')
+        if durations[name]:
+            print(', per item p50 %.2fs p99 %.2fs max %.2fs' % (percentile(durations[name], 0.5),
+                  percentile(durations[name], 0.99), max(durations[name])), end='')
+        print()
+
+    return elapsed, busy
+
+def read_links(links_csv):
+    with open(links_csv, 'r') as infile:
+        incsv = csv.reader(infile, delimiter=',', quotechar='"')
+        next(incsv) # Skip the Instrument,Link header
+        return [(row[0], row[1]) for row in incsv if len(row) >= 2]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='pipeline.py', description='Builds the dataset with all stages running at once')
+    parser.add_argument('input', help='The links csv, or a directory of audio/wav files when --from is given')
+    parser.add_argument('outfile', help='The arff file to create')
+    parser.add_argument('--from', dest='first', default='download', choices=list(STAGES.keys()),
+                        help='Which stage the input goes into. download takes the links csv, convert takes a directory of mp3/mp4 files and extract a directory of wav files')
+
+    # auto is one worker per cpu here, the stages hand files to each other so their sizes stay fixed
+    parser.add_argument('--dlworkers', type=parse_max_processes, default=5, help='Concurrent downloads')
+    parser.add_argument('--convertworkers', type=parse_max_processes, default=2, help='Concurrent ffmpeg conversions')
+    parser.add_argument('--extractworkers', type=parse_max_processes, default='auto', help='Concurrent extraction processes')
+    parser.add_argument('--queuesize', type=int, default=8, help='How many files may wait in front of each stage')
+
+    parser.add_argument('--downloaddir', default='download_audio/', help='Where downloads go')
+    parser.add_argument('--wavdir', default='full_wav/', help='Where converted wavs go')
+    parser.add_argument('--tempfolder', default='pipelinetemp/', help='Where the per file csv shards go, removed at the end')
+
+    parser.add_argument('-s', '--seconds', type=float, default=0.1, help='Length of each clip')
+    parser.add_argument('-r', '--harmonics', type=int, default=32, help='Number of harmonics to include in the fft')
+    parser.add_argument('-d', '--dbfs', type=int, default=-20, help='The db level each clip is normalized to')
+    parser.add_argument('--gatedb', type=float, default=None, help='Skip clips quieter than this level')
+    parser.add_argument('--hop', type=float, default=None, help='Start a clip every this many seconds so clips overlap. Defaults to back to back clips')
+    parser.add_argument('--dedupe', action='store_true', default=False, help='Skip exact duplicate clips within a file')
+    parser.add_argument('--partitioned', action='store_true', default=False, help='Write one arff per instrument')
+    parser.add_argument('--spectra', default=None, help='Also save every clip spectrum to this spectrum cache directory')
+    parser.add_argument('--pool', type=int, default=1, help='FFT bins averaged together in the spectrum cache')
+
+    args = parser.parse_args()
+
+    if args.first == 'download':
+        items = read_links(args.input)
+    elif args.first == 'convert':
+        items = glob.glob(args.input + '*.mp4') + glob.glob(args.input + '*.mp3')
+    else:
+        rows = list_inputs(args.input)
+        items = [row['path'] for row in sorted(rows, key=lambda row: row['size'], reverse=True)]
+
+    # Longest first, so the biggest recordings are not the last thing every other worker waits on
+    if args.first == 'convert':
+        items.sort(key=size_cost, reverse=True)
+
+    config = {
+        'download_dir': args.downloaddir,
+        'wav_dir': args.wavdir,
+        'shard_dir': args.tempfolder,
+        'seconds': args.seconds,
+        'harmonics': args.harmonics,
+        'dbfs': args.dbfs,
+        'gatedb': args.gatedb,
+        'dedupe': args.dedupe,
+        'spectra_dir': args.spectra,
+        'pool': args.pool,
+        'hop': args.hop,
+    }
+    workers = {'download': initial_workers(args.dlworkers), 'convert': initial_workers(args.convertworkers),
+               'extract': initial_workers(args.extractworkers)}
+
+    run_pipeline(items, args.first, args.outfile, workers, args.queuesize, config, args.partitioned)
+
+    shutil.rmtree(args.tempfolder)
@@ -0,0 +1,348 @@
+'''
+**************************************************************************************************
+* Filename:    procpool.py                                                                       *
+*                                                                                                *
+* Description: Runs a list of shell commands with a limited number of them going at once. Every *
+*              multithreaded stage of dataset_gen (downloading, converting, splitting,           *
+*              normalizing and the FFT) uses this runner.                                        *
+*                                                                                                *
+*              The limit can be a fixed number, or 'auto'. With 'auto', a controller watches how *
+*              fast commands are finishing, how busy the CPUs are, how much time they spend      *
+*              waiting on I/O and how much memory is left, and raises or lowers the number of    *
+*              running commands to keep the machine busy without swapping:                      *
+*                                                                                                *
+*                  memory low or swapping       -> one fewer                                     *
+*                  CPUs idle, little I/O wait   -> one more                                      *
+*                  I/O wait high                -> one more, unless the last raise did not help  *
+*                  a raise that made throughput drop is undone                                   *
+*                                                                                                *
+*              Running commands are never killed, lowering the limit just holds off new ones.    *
+*              Every decision is appended to a log file. System stats come from /proc, or from   *
+*              psutil if it is installed and /proc is not there. With neither the limit stays    *
+*              at its starting value.                                                            *
+*                                                                                                *
+**************************************************************************************************
+'''
+import os
+import sys
+import time
+import subprocess
+
+import tqdm
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+DEFAULT_LOG = 'concurrency.log'
+# Seconds between checks of the running commands
+POLL_SECONDS = 0.05
+# Seconds between controller decisions, long enough for a few commands to finish
+DECISION_SECONDS = 5.0
+
+# Thresholds the controller works to
+LOW_MEMORY = 0.10
+SWAP_PAGES_PER_SECOND = 256
+CPU_SATURATED = 0.90
+HIGH_IOWAIT = 0.20
+
+def parse_max_processes(value):
+    if str(value).lower() == 'auto':
+        return 'auto'
+
+    return int(value)
+
+# The number of processes to start with for a fixed or 'auto' limit
+def initial_workers(max_processes):
+    if max_processes == 'auto':
+        return os.cpu_count() or 1
+
+    return max_processes
+
+# The most processes 'auto' runs at once unless run_commands is given max_workers
+def default_max_workers():
+    return 4 * (os.cpu_count() or 1)
+
+# The number of workers to size work chunks by. Batches are fixed before any command starts and a command is never
+# split once it is running, so with 'auto' they are planned for the most workers it could raise the limit to.
+# Otherwise a raise would only help while batches were still queued
+def planned_workers(max_processes):
+    if max_processes == 'auto':
+        return default_max_workers()
+
+    return max_processes
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             read_system                                                                  *
+*                                                                                                *
+* Returns:          dict - Cumulative cpu time (total, idle, iowait), total and available memory *
+*                          and pages swapped so far. None if there is no way to read them        *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def read_system():
+    if os.path.exists('/proc/stat'):
+        with open('/proc/stat', 'r') as f:
+            # cpu user nice system idle iowait irq softirq steal ...
+            cpu = [int(x) for x in f.readline().split()[1:]]
+
+        meminfo = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                meminfo[key] = int(value.split()[0])
+
+        swap_pages = 0
+        with open('/proc/vmstat', 'r') as f:
+            for line in f:
+                key, value = line.split()
+                if key in ('pswpin', 'pswpout'):
+                    swap_pages += int(value)
+
+        return {'cpu_total': sum(cpu[:8]), 'cpu_idle': cpu[3], 'cpu_iowait': cpu[4],
+                'mem_total': meminfo['MemTotal'], 'mem_available': meminfo.get('MemAvailable', meminfo['MemFree']),
+                'swap_pages': swap_pages}
+
+    if psutil is not None:
+        times = psutil.cpu_times()
+        memory = psutil.virtual_memory()
+        swap = psutil.swap_memory()
+        return {'cpu_total': sum(times), 'cpu_idle': times.idle, 'cpu_iowait': getattr(times, 'iowait', 0),
+                'mem_total': memory.total, 'mem_available': memory.available,
+                'swap_pages': (swap.sin + swap.sout) / 4096}
+
+    return None
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             system_usage                                                                 *
+*                                                                                                *
+* Parameters:       dict before  - read_system at the start of the window                        *
+*                   dict after   - read_system at the end of the window                          *
+*                   float seconds - Length of the window                                         *
+*                                                                                                *
+* Returns:          dict - The fraction of cpu time busy and in iowait, the fraction of memory   *
+*                          available and the pages swapped per second over the window            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def system_usage(before, after, seconds):
+    total = max(after['cpu_total'] - before['cpu_total'], 1)
+    idle = after['cpu_idle'] - before['cpu_idle']
+    iowait = after['cpu_iowait'] - before['cpu_iowait']
+
+    return {
+        'cpu': 1 - (idle + iowait) / total,
+        'iowait': iowait / total,
+        'memory': after['mem_available'] / after['mem_total'],
+        'swap': (after['swap_pages'] - before['swap_pages']) / max(seconds, 1e-9),
+    }
+
+def make_controller(stage, max_processes, min_workers=1, max_workers=None, logfile=DEFAULT_LOG):
+    if max_workers is None:
+        max_workers = default_max_workers()
+
+    return {
+        'stage': stage,
+        'adaptive': max_processes == 'auto',
+        'workers': initial_workers(max_processes),
+        'min_workers': min_workers,
+        'max_workers': max_workers,
+        'logfile': logfile,
+        'last_time': time.time(),
+        'last_system': read_system(),
+        'completed': 0,
+        'last_throughput': None,
+        # Throughput before the most recent raise, so a raise that hurt can be undone
+        'before_raise': None,
+    }
+
+def log_decision(controller, usage, throughput, change, reason):
+    line = '%s %s workers=%d change=%+d throughput=%.2f/s cpu=%.2f iowait=%.2f memory=%.2f swap=%.0f/s %s\n' % (
+        time.strftime('%Y-%m-%d %H:%M:%S'), controller['stage'], controller['workers'], change, throughput,
+        usage['cpu'], usage['iowait'], usage['memory'], usage['swap'], reason)
+
+    with open(controller['logfile'], 'a') as f:
+        f.write(line)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             adjust                                                                       *
+*                                                                                                *
+* Parameters:       dict controller - From make_controller                                       *
+*                   int completed   - Work units finished since the last call                    *
+*                                                                                                *
+* Purpose:          Called every poll. Once per DECISION_SECONDS it looks at the throughput and  *
+*                   system usage over the last window and moves the worker limit by one. Until a *
+*                   unit finishes the window keeps growing, so throughput is only compared       *
+*                   between windows that have completions in them                                *
+*                                                                                                *
+* Returns:          int - The number of commands allowed to run right now                        *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def adjust(controller, completed):
+    controller['completed'] += completed
+
+    now = time.time()
+    seconds = now - controller['last_time']
+    if not controller['adaptive'] or controller['last_system'] is None or seconds < DECISION_SECONDS:
+        return controller['workers']
+
+    system = read_system()
+    usage = system_usage(controller['last_system'], system, seconds)
+    memory_low = usage['memory'] < LOW_MEMORY or usage['swap'] > SWAP_PAGES_PER_SECOND
+    # A window where nothing finished says nothing about throughput, commands longer than a window would look
+    # like a drop. The window is stretched until something finishes, only low memory is acted on before that
+    if controller['completed'] == 0 and not memory_low:
+        return controller['workers']
+    throughput = controller['completed'] / seconds
+
+    change = 0
+    reason = 'hold'
+    if memory_low:
+        change = -1
+        reason = 'memory low or swapping'
+    elif controller['before_raise'] is not None and throughput < 0.9 * controller['before_raise']:
+        change = -1
+        reason = 'last raise lowered throughput'
+    elif usage['cpu'] < CPU_SATURATED and usage['iowait'] < HIGH_IOWAIT:
+        change = 1
+        reason = 'cpu not saturated'
+    elif usage['iowait'] >= HIGH_IOWAIT and controller['before_raise'] is None:
+        # Waiting on disk or network, more requests in flight may hide the latency
+        change = 1
+        reason = 'waiting on io'
+    elif usage['cpu'] >= CPU_SATURATED:
+        reason = 'cpu saturated'
+
+    workers = min(max(controller['workers'] + change, controller['min_workers']), controller['max_workers'])
+    if workers != controller['workers'] + change:
+        reason += ', already at the worker limit'
+    change = workers - controller['workers']
+    controller['workers'] = workers
+    # Only the window right after a raise is compared against the throughput before it
+    controller['before_raise'] = controller['last_throughput'] if change > 0 else None
+
+    log_decision(controller, usage, throughput, change, reason)
+
+    controller['last_time'] = now
+    controller['last_system'] = system
+    if controller['completed'] > 0:
+        controller['last_throughput'] = throughput
+    controller['completed'] = 0
+
+    return workers
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             run_commands                                                                 *
+*                                                                                                *
+* Parameters:       list cmds          - Shell commands, either str or [cmd, units] where units  *
+*                                        is how much work the command does (files, clips...).   *
+*                                        cmd may also be an argument list, run without a shell   *
+*                   max_processes      - The number of commands to run at once, or 'auto'        *
+*                   str desc           - Progress bar label, also the stage name in the log      *
+*                   int max_workers    - The most commands 'auto' will run at once               *
+*                   str logfile        - Where 'auto' logs its decisions                         *
+*                   bool allow_failures - Only warn about commands that exit non-zero            *
+*                                                                                                *
+* Purpose:          Runs every command, starting a new one whenever fewer than the current limit *
+*                   are running. Commands are started in the order given, so put the longest     *
+*                   first (see workplan.py). Prints the run time percentiles of the commands     *
+*                   when done. Every command that exited non-zero is printed, and unless         *
+*                   allow_failures is set the stage exits with an error once the rest finish     *
+*                                                                                                *
+* Returns:          dict - The latency numbers from print_latency                                *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def run_commands(cmds, max_processes, desc, max_workers=None, logfile=DEFAULT_LOG, allow_failures=False):
+    cmds = [cmd if isinstance(cmd, (list, tuple)) else [cmd, 1] for cmd in cmds]
+    cmds.reverse() # So pop() takes them in order
+
+    controller = make_controller(desc, max_processes, max_workers=max_workers, logfile=logfile)
+    pbar = tqdm.tqdm(desc=desc, total=sum(count for _, count in cmds))
+
+    running = []
+    limit = controller['workers']
+    # How long every command ran, and when a worker first went idle because nothing was left to start
+    durations = []
+    # (command, exit code) of every command that failed
+    failed = []
+    start_time = time.time()
+    drained_time = None
+    while cmds or running:
+        # Fill up the currently running processes to the current limit
+        while len(running) < limit and cmds:
+            cmd, count = cmds.pop()
+            running.append([subprocess.Popen(cmd, shell=isinstance(cmd, str)), count, time.time()])
+
+        # See if any of the processes have completed, and remove them if they are
+        completed = [process for process in running if process[0].poll() is not None]
+        for process in completed:
+            running.remove(process)
+            pbar.update(process[1])
+            durations.append(time.time() - process[2])
+            if process[0].returncode != 0:
+                failed.append((process[0].args, process[0].returncode))
+
+        if completed and not cmds and drained_time is None:
+            drained_time = time.time()
+
+        limit = adjust(controller, sum(count for _, count, _ in completed))
+        if not completed:
+            time.sleep(POLL_SECONDS)
+
+    pbar.close()
+
+    end_time = time.time()
+    stats = print_latency(desc, durations, end_time - start_time, end_time - (drained_time or end_time))
+
+    for cmd, returncode in failed:
+        print('%s: exit code %d from %s' % (desc, returncode, cmd if isinstance(cmd, str) else ' '.join(cmd)))
+    if failed and not allow_failures:
+        print('Error: %d of the %s commands failed' % (len(failed), desc))
+        sys.exit(1)
+
+    return stats
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             print_latency                                                                *
+*                                                                                                *
+* Parameters:       str desc          - The stage name                                           *
+*                   float[] durations - How long each command ran                                *
+*                   float total       - How long the whole stage took                            *
+*                   float tail        - How long the stage ran on after the first worker went    *
+*                                       idle with nothing left to start                          *
+*                                                                                                *
+* Purpose:          Prints how long the commands of a stage took. A long tail next to a short   *
+*                   p50 means the work was split unevenly and most workers waited on a few       *
+*                                                                                                *
+* Returns:          dict - The numbers that were printed                                         *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def print_latency(desc, durations, total, tail):
+    if not durations:
+        return None
+
+    stats = {'commands': len(durations), 'total': total, 'tail': tail, 'p50': percentile(durations, 0.5),
+             'p90': percentile(durations, 0.9), 'p99': percentile(durations, 0.99), 'max': max(durations)}
+
+    print('%s: %d commands in %.1fs, per command p50 %.2fs p90 %.2fs p99 %.2fs max %.2fs, tail %.1fs' % (
+        desc, stats['commands'], total, stats['p50'], stats['p90'], stats['p99'], stats['max'], tail))
+
+    return stats
@@ -0,0 +1,215 @@
+'''
+**************************************************************************************************
+* Filename:    spectralfeatures.py                                                               *
+*                                                                                                *
+* Description: Feature plugins that run on the cached spectra from spectrumcache.py. A plugin    *
+*              takes a whole chunk of spectra at once:                                           *
+*                                                                                                *
+*                  plugin(spectra, freqs, **options) -> features, names                          *
+*                                                                                                *
+*              spectra  - 2d float array of 16 bit scale magnitudes, one clip per row            *
+*              freqs    - The frequency in Hz of each column of spectra                          *
+*              features - 2d float array, one row per clip                                       *
+*              names    - The arff attribute name of each feature column                         *
+*                                                                                                *
+*              New plugins are added with the register_feature decorator and can then be run   *
+*              with python3 spectrumcache.py features <cache dir> <outfile> --feature <name>     *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import shutil
+
+import numpy as np
+
+from spectrumcache import iter_spectra # pyright: ignore
+from arffio import make_named_header, write_rows, attribute_names # pyright: ignore
+
+FEATURES = {}
+
+def register_feature(name):
+    def register(plugin):
+        FEATURES[name] = plugin
+        return plugin
+
+    return register
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             top_bins                                                                     *
+*                                                                                                *
+* Options:          int k            - Number of (amplitude, frequency) pairs to keep            *
+*                   float min_freq   - Ignore bins below this frequency. gen_FFT uses 100 Hz     *
+*                                                                                                *
+* Purpose:          The same top-k bins extractFreqARFF.py writes, with the low cut adjustable.  *
+*                   Frequencies are in Hz rather than gen_FFT's bin numbers                      *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+@register_feature('topk')
+def top_bins(spectra, freqs, k=32, min_freq=100):
+    first = np.searchsorted(freqs, min_freq)
+    ampl = spectra[:, first:]
+
+    k = min(k, ampl.shape[1])
+
+    # Only the top k are sorted, by amplitude then bin like the stable sort in gen_FFT
+    top = np.argpartition(-ampl, k - 1, axis=1)[:, :k]
+    top_ampl = np.take_along_axis(ampl, top, axis=1)
+    order = np.lexsort((top, -top_ampl), axis=1)
+
+    features = np.empty((len(spectra), 2 * k))
+    features[:, 0::2] = np.take_along_axis(top_ampl, order, axis=1)
+    features[:, 1::2] = freqs[first:][np.take_along_axis(top, order, axis=1)]
+
+    return features, attribute_names(k)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             band_energies                                                                *
+*                                                                                                *
+* Options:          int bands        - Number of log spaced bands                                *
+*                   float min_freq   - Bottom edge of the lowest band                            *
+*                   float max_freq   - Top edge of the highest band, defaults to the top bin     *
+*                                                                                                *
+* Purpose:          The energy in each band in dB, relative to the clip's total energy so the    *
+*                   features do not depend on how loud the clip was                              *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+@register_feature('bands')
+def band_energies(spectra, freqs, bands=24, min_freq=50, max_freq=None):
+    if max_freq is None:
+        max_freq = freqs[-1]
+
+    edges = np.geomspace(min_freq, max_freq, bands + 1)
+    band_of_bin = np.searchsorted(edges, freqs, side='right') - 1
+    in_range = (band_of_bin >= 0) & (band_of_bin < bands)
+
+    # Sum the power of every bin into its band with one matrix product
+    membership = np.zeros((len(freqs), bands))
+    membership[np.flatnonzero(in_range), band_of_bin[in_range]] = 1
+    power = np.square(spectra, dtype=np.float64)
+    energy = power @ membership
+
+    total = power.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        features = 10 * np.log10(energy / total)
+    features[~np.isfinite(features)] = -200
+
+    return features, ['band' + str(i) for i in range(1, bands + 1)]
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             peak_harmonics                                                               *
+*                                                                                                *
+* Options:          int k            - Number of peaks to keep                                   *
+*                   float min_freq   - Ignore peaks below this frequency                         *
+*                                                                                                *
+* Purpose:          Like topk, but only bins louder than both neighbours count, so one wide peak *
+*                   does not fill several slots. Clips with fewer than k peaks are padded with 0 *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+@register_feature('peaks')
+def peak_harmonics(spectra, freqs, k=16, min_freq=100):
+    is_peak = np.zeros(spectra.shape, dtype=bool)
+    is_peak[:, 1:-1] = (spectra[:, 1:-1] > spectra[:, :-2]) & (spectra[:, 1:-1] >= spectra[:, 2:])
+    is_peak[:, freqs < min_freq] = False
+
+    ampl = np.where(is_peak, spectra, -1)
+    top = np.argsort(-ampl, axis=1, kind='stable')[:, :k]
+    top_ampl = np.take_along_axis(ampl, top, axis=1)
+    found = top_ampl >= 0
+
+    features = np.zeros((len(spectra), 2 * k))
+    features[:, 0:2 * top.shape[1]:2] = np.where(found, top_ampl, 0)
+    features[:, 1:2 * top.shape[1]:2] = np.where(found, freqs[top], 0)
+
+    return features, attribute_names(k)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             spectral_shape                                                               *
+*                                                                                                *
+* Options:          float rolloff - Fraction of the energy below the rolloff frequency           *
+*                                                                                                *
+* Purpose:          Centroid, spread, rolloff frequency and flatness of each spectrum            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+@register_feature('shape')
+def spectral_shape(spectra, freqs, rolloff=0.85):
+    spectra = spectra.astype(np.float64)
+    total = spectra.sum(axis=1, keepdims=True)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = spectra / total
+        centroid = weights @ freqs
+        spread = np.sqrt(np.sum(weights * np.square(freqs[None, :] - centroid[:, None]), axis=1))
+
+        power = np.square(spectra)
+        cumulative = np.cumsum(power, axis=1)
+        rolloff_bin = np.argmax(cumulative >= rolloff * cumulative[:, -1:], axis=1)
+
+        log_power = np.log(power + 1e-12)
+        flatness = np.exp(log_power.mean(axis=1)) / (power.mean(axis=1) + 1e-12)
+
+    features = np.column_stack([centroid, spread, freqs[rolloff_bin], flatness])
+    features[~np.isfinite(features)] = 0
+
+    return features, ['centroid', 'spread', 'rolloff', 'flatness']
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             features_to_arff                                                             *
+*                                                                                                *
+* Parameters:       str cache_dir              - The spectrum cache directory                    *
+*                   str outfilename            - The arff file to create                         *
+*                   str feature                - The name of a registered plugin                 *
+*                   dict options               - Keyword options for the plugin                  *
+*                   str[] enabled_instruments  - Only keep these instruments, ['all'] for all    *
+*                                                                                                *
+* Purpose:          Runs a plugin over every chunk of the cache and writes the result as an arff *
+*                   dataset that gen_model.py can train on                                       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def features_to_arff(cache_dir, outfilename, feature, options={}, enabled_instruments = ['all']):
+    if feature not in FEATURES:
+        print('Error: unknown feature', feature + '. Choose from', ', '.join(sorted(FEATURES.keys())))
+        sys.exit(1)
+
+    plugin = FEATURES[feature]
+    tempfilename = outfilename + '.rows'
+    names = None
+    seen_insts = set()
+    num_rows = 0
+
+    # Rows go to a temp file first since the header needs every instrument in it
+    with open(tempfilename, 'w') as rowfile:
+        for spectra, labels, freqs in iter_spectra(cache_dir, enabled_instruments):
+            features, names = plugin(spectra, freqs, **options)
+            write_rows(rowfile, features, labels)
+            seen_insts.update(labels.tolist())
+            num_rows += len(features)
+
+    if names is None:
+        print('Error: no spectra found in', cache_dir)
+        os.remove(tempfilename)
+        sys.exit(1)
+
+    relation = os.path.splitext(os.path.split(outfilename)[1])[0]
+    with open(outfilename, 'w') as outfile:
+        outfile.writelines(make_named_header(relation, names, seen_insts))
+        with open(tempfilename, 'r') as rowfile:
+            shutil.copyfileobj(rowfile, outfile)
+    os.remove(tempfilename)
+
+    print('Wrote', num_rows, 'rows of', len(names), feature, 'features to', outfilename)
@@ -0,0 +1,289 @@
+'''
+**************************************************************************************************
+* Filename:    spectrumcache.py                                                                  *
+*                                                                                                *
+* Description: Keeps the magnitude spectrum of every clip so new features can be tried without   *
+*              decoding the audio again. The cache is a directory of compressed npz chunks, each *
+*              holding float16 spectra for a batch of equal length clips along with their labels,*
+*              plus an index (_spectra.json) of what every chunk holds.                          *
+*                                                                                                *
+*              Spectra are the magnitudes of the real FFT of the normalized clip with samples    *
+*              scaled to [-1, 1], so they fit in float16. Multiply by the index's scale to get   *
+*              the magnitudes gen_FFT sees. Adjacent bins can be averaged together (pooled) to   *
+*              make the cache smaller at the cost of frequency resolution.                       *
+*                                                                                                *
+*              The cache is filled by fusedextract.py, pipeline.py and distextract.py when given *
+*              --spectra, or built here from a folder of normalized clips. Feature sets are      *
+*              computed from it by the plugins in spectralfeatures.py.                           *
+*                                                                                                *
+* Usage:       python3 spectrumcache.py build <clip folder> <cache dir> [--pool n]                *
+*                   Caches the spectra of a folder of normalized clips                           *
+*                                                                                                *
+*              python3 spectrumcache.py index <cache dir>                                        *
+*                   Rebuilds the index after chunks were added by the extraction scripts         *
+*                                                                                                *
+*              python3 spectrumcache.py features <cache dir> <outfile.arff> --feature <name>     *
+*                                       [--option key=value ...]                                 *
+*                   Computes a feature set from the cache into an arff file                      *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import glob
+import json
+import argparse
+
+import numpy as np
+import tqdm
+from scipy.io import wavfile
+
+from fftbackend import rfft_abs # pyright: ignore
+
+INDEX_FILENAME = '_spectra.json'
+# Spectra are stored for samples in [-1, 1], this brings them back to the 16 bit scale gen_FFT uses
+SCALE = 32768.0
+FLOAT16_MAX = float(np.finfo(np.float16).max)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             clip_spectra                                                                 *
+*                                                                                                *
+* Parameters:       np.array clips - 2d array of 16 bit samples, one clip per row                *
+*                   int pool       - Average this many adjacent bins together                    *
+*                                                                                                *
+* Returns:          np.array - float16 magnitude spectrum of each clip                           *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def clip_spectra(clips, pool=1):
+    clips = np.atleast_2d(clips)
+    spectra = rfft_abs(clips / SCALE)
+
+    if pool > 1:
+        num_bands = spectra.shape[1] // pool
+        spectra = spectra[:, :num_bands * pool].reshape(len(spectra), num_bands, pool).mean(axis=2)
+
+    return np.minimum(spectra, FLOAT16_MAX).astype(np.float16)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             bin_frequencies                                                              *
+*                                                                                                *
+* Parameters:       int samplerate   - The sample rate of the clips                              *
+*                   int clip_samples - The number of samples in each clip                        *
+*                   int num_bins     - The number of (pooled) bins stored                        *
+*                   int pool         - How many FFT bins were averaged into each stored bin      *
+*                                                                                                *
+* Returns:          np.array - The center frequency in Hz of each stored bin                     *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def bin_frequencies(samplerate, clip_samples, num_bins, pool=1):
+    return (np.arange(num_bins) * pool + (pool - 1) / 2) * samplerate / clip_samples
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             write_chunk                                                                  *
+*                                                                                                *
+* Parameters:       str filename          - The npz file to write                                *
+*                   np.array spectra      - float16 spectra from clip_spectra                    *
+*                   str[] labels          - The instrument of each clip                          *
+*                   int samplerate        - The sample rate of the clips                         *
+*                   int clip_samples      - The number of samples in each clip                   *
+*                   int pool              - How many FFT bins were averaged into each stored bin *
+*                   np.array clip_numbers - Where each clip came from in its recording, optional *
+*                                                                                                *
+* Purpose:          Writes one chunk to a temp file and moves it into place so a reader never    *
+*                   sees half of a chunk                                                         *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def write_chunk(filename, spectra, labels, samplerate, clip_samples, pool=1, clip_numbers=None):
+    if clip_numbers is None:
+        clip_numbers = np.arange(len(spectra))
+
+    tempfilename = filename + '.tmp.npz'
+    np.savez_compressed(tempfilename, spectra=spectra, labels=np.asarray(labels, dtype=str),
+                        clip_numbers=np.asarray(clip_numbers), samplerate=samplerate, clip_samples=clip_samples,
+                        pool=pool)
+    os.replace(tempfilename, filename)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             write_index                                                                  *
+*                                                                                                *
+* Parameters:       str cache_dir - The cache directory                                          *
+*                                                                                                *
+* Purpose:          Lists every chunk in the cache with its row count, clip format and the       *
+*                   number of clips of each instrument. Only the small arrays of each chunk are  *
+*                   read, the spectra stay compressed                                            *
+*                                                                                                *
+* Returns:          dict - The index that was written                                            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def write_index(cache_dir):
+    index = {'scale': SCALE, 'chunks': []}
+
+    for filename in sorted(glob.glob(os.path.join(cache_dir, '*.npz'))):
+        if filename.endswith('.tmp.npz'):
+            continue
+
+        with np.load(filename) as chunk:
+            insts, counts = np.unique(chunk['labels'], return_counts=True)
+            index['chunks'].append({
+                'file': os.path.split(filename)[1],
+                'rows': int(counts.sum()),
+                'samplerate': int(chunk['samplerate']),
+                'clip_samples': int(chunk['clip_samples']),
+                'pool': int(chunk['pool']),
+                'instruments': {str(inst): int(count) for inst, count in zip(insts, counts)},
+            })
+
+    with open(os.path.join(cache_dir, INDEX_FILENAME), 'w') as f:
+        json.dump(index, f, indent=1)
+
+    return index
+
+def read_index(cache_dir):
+    with open(os.path.join(cache_dir, INDEX_FILENAME), 'r') as f:
+        return json.load(f)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             iter_spectra                                                                 *
+*                                                                                                *
+* Parameters:       str cache_dir              - The cache directory                             *
+*                   str[] enabled_instruments  - Only keep these instruments, ['all'] for all    *
+*                                                                                                *
+* Purpose:          Reads the cache a chunk at a time. Chunks without any of the enabled         *
+*                   instruments are skipped using the index alone                                *
+*                                                                                                *
+* Returns:          generator of (np.array, np.array, np.array) - The float32 spectra scaled     *
+*                   back to 16 bit magnitudes, the instrument of each row and the frequency in  *
+*                   Hz of each bin                                                               *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def iter_spectra(cache_dir, enabled_instruments = ['all']):
+    index = read_index(cache_dir)
+
+    for info in index['chunks']:
+        if enabled_instruments != ['all'] and not set(info['instruments']) & set(enabled_instruments):
+            continue
+
+        with np.load(os.path.join(cache_dir, info['file'])) as chunk:
+            spectra = chunk['spectra'].astype(np.float32) * index['scale']
+            labels = chunk['labels']
+
+        if enabled_instruments != ['all']:
+            keep = np.isin(labels, enabled_instruments)
+            spectra = spectra[keep]
+            labels = labels[keep]
+
+        yield spectra, labels, bin_frequencies(info['samplerate'], info['clip_samples'], spectra.shape[1], info['pool'])
+
+# The samplerate, samples and instrument of every clip in a folder of wavs or a clip pack
+def iter_clips(audiofolder):
+    from extractFreqARFF import instrument_from_filename # pyright: ignore
+    from clippack import is_pack, iter_pack # pyright: ignore
+    from manifest import list_inputs # pyright: ignore
+
+    if is_pack(audiofolder):
+        for _, label, samplerate, samples in tqdm.tqdm(iter_pack(audiofolder), desc='Caching spectra'):
+            yield samplerate, samples, label
+        return
+
+    for row in tqdm.tqdm(list_inputs(audiofolder), desc='Caching spectra'):
+        samplerate, data = wavfile.read(row['path'])
+        if data.ndim > 1:
+            data = data[:, 0]
+
+        yield samplerate, data, instrument_from_filename(row['path'])
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             build_cache                                                                  *
+*                                                                                                *
+* Parameters:       str audiofolder  - Folder of normalized, instrument tagged wav clips, or a  *
+*                                      clip pack of them (see clippack.py)                       *
+*                   str cache_dir    - Where to write the chunks and index                       *
+*                   int pool         - Average this many adjacent bins together                  *
+*                   int chunk_rows   - Clips per chunk                                           *
+*                                                                                                *
+* Purpose:          Decodes every clip one last time and caches its spectrum. Clips are grouped  *
+*                   by length and sample rate since a chunk can only hold one spectrum size      *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def build_cache(audiofolder, cache_dir, pool=1, chunk_rows=65536):
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # (samplerate, clip_samples) -> clips waiting to be written
+    pending = {}
+    num_chunks = 0
+
+    def flush(key):
+        nonlocal num_chunks
+        clips, labels = pending.pop(key)
+        write_chunk(os.path.join(cache_dir, 'clips%05d.npz' % num_chunks), clip_spectra(np.array(clips), pool),
+                    labels, key[0], key[1], pool)
+        num_chunks += 1
+
+    for samplerate, data, label in iter_clips(audiofolder):
+        key = (samplerate, len(data))
+        clips, labels = pending.setdefault(key, ([], []))
+        clips.append(data)
+        labels.append(label)
+
+        if len(clips) >= chunk_rows:
+            flush(key)
+
+    for key in list(pending.keys()):
+        flush(key)
+
+    return write_index(cache_dir)
+
+def parse_options(options):
+    parsed = {}
+    for option in options:
+        key, value = option.split('=', 1)
+        try:
+            parsed[key] = int(value)
+        except ValueError:
+            parsed[key] = float(value)
+
+    return parsed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='spectrumcache.py', description='Builds and reads the clip spectrum cache')
+    parser.add_argument('mode', choices=['build', 'index', 'features'])
+    parser.add_argument('paths', nargs='+', help='build: <clip folder> <cache dir>, index: <cache dir>, features: <cache dir> <outfile.arff>')
+
+    parser.add_argument('--pool', type=int, default=1, help='Average this many adjacent FFT bins together when building')
+    parser.add_argument('--chunkrows', type=int, default=65536, help='Clips per chunk when building')
+    parser.add_argument('-f', '--feature', default='topk', help='The feature plugin to run, see spectralfeatures.py')
+    parser.add_argument('-o', '--option', action='append', default=[], help='key=value option passed to the plugin, can be repeated')
+    parser.add_argument('-i', '--instruments', nargs='*', default=['all'], help='Only compute features for these instruments')
+
+    args = parser.parse_args()
+
+    if args.mode == 'build' and len(args.paths) == 2:
+        index = build_cache(args.paths[0], args.paths[1], args.pool, args.chunkrows)
+        print('Cached', sum(info['rows'] for info in index['chunks']), 'spectra in', len(index['chunks']), 'chunks')
+    elif args.mode == 'index' and len(args.paths) == 1:
+        index = write_index(args.paths[0])
+        print('Indexed', sum(info['rows'] for info in index['chunks']), 'spectra in', len(index['chunks']), 'chunks')
+    elif args.mode == 'features' and len(args.paths) == 2:
+        from spectralfeatures import features_to_arff # pyright: ignore
+        features_to_arff(args.paths[0], args.paths[1], args.feature, parse_options(args.option), args.instruments)
+    else:
+        parser.print_help()
+        sys.exit(1)
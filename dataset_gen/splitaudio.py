@@ -19,7 +19,10 @@
 *           -b           - Flag for batch file processing                                        *
 *           <seconds>    - How long each split file should be                                    *  
 *           <output dir> - The directory to place split files into                               *
-*           <files>      - A space delimited list of files to split                              *
+*           <files>      - A space delimited list of files to split. <file>@<start>-<stop> only  *
+*                          writes clips start to stop - 1 of the file                            *
+*           --inputs <manifest> - Also split every file listed in this manifest (manifest.py)    *
+*           --manifest <file>   - Append a manifest row for every clip written to this file      *
 *                                                                                                *
 *       splitaudio.py -m <audio dir> <seconds> <output dir> <max_processes>                      *
 *           -m           - Flag for multithreaded file processing                                *
@@ -27,17 +30,259 @@
 *           <seconds>    - How long each split file should be                                    *  
 *           <output dir> - The directory to place split files into                               *
 *           <max_processes> - The maximum number of subprocess allowed to exist at once          *
+*                                                                                                *
+*       Any mode also accepts these optional flags:                                              *
+*           --gatedb <dBFS> - Skip clips quieter than this level instead of writing them         *
+*           --dedupe        - Skip clips that are an exact copy of an earlier clip in the file   *
+*           --samplerate <hz> - Resample to this rate first. Only this option needs librosa      *
+*           --pack          - Write the clips into a clip pack at <output dir> (see clippack.py) *
+*           --catalog <db>  - -m only. Records the recordings and clips in a catalog.py catalog  *
+*                                                                                                *
+*       Per source file rejection counts are appended to _gate_report.csv in <output dir>        *
+*       -m reads the manifest of <audio dir> and writes one listing the clips to <output dir>    *
 * ********************************************************************************************** *
 '''
 import sys
 import os
-import subprocess
-import glob
 import math
+import argparse
+import csv
+import hashlib
 
-import librosa
+import numpy as np
 import soundfile as sf
-import tqdm
+
+from procpool import run_commands, parse_max_processes, planned_workers # pyright: ignore
+from workplan import BATCHES_PER_WORKER, plan_batches, split_long_files, parse_range # pyright: ignore
+from clippack import open_writer, write_clip, close_writer, to_pcm16 # pyright: ignore
+from catalog import record_sources, record_stage # pyright: ignore
+from manifest import list_inputs, read_paths, open_manifest, add_row, close_manifest, clip_row, describe_file, write_batches, merge_batches, manifest_filename # pyright: ignore
+
+GATE_REPORT = '_gate_report.csv'
+# How many clips are decoded from the source file at a time. Bounds the memory used while splitting
+CLIPS_PER_BLOCK = 256
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             iter_audio_blocks                                                            *
+*                                                                                                *
+* Parameters:       str filename        - The audio file to read                                 *
+*                   float seconds       - The length of each clip                                *
+*                   int samplerate      - Rate to resample to. None keeps the file's own rate    *
+*                   int clips_per_block - How many clips worth of samples to decode at a time    *
+*                   int start_clip      - The first clip to read                                 *
+*                   int stop_clip       - Stop before this clip. None reads to the end           *
+*                                                                                                *
+* Purpose:          Decodes the file a block at a time, mixed down to mono float32 the same way  *
+*                   librosa.load does. Every block except the last holds a whole number of clips *
+*                   so clips never straddle two blocks. librosa is only imported when the file   *
+*                   has to be resampled, and then the whole file is decoded at once              *
+*                                                                                                *
+* Returns:          generator of (int, int, np.array) - The samplerate, the number of samples    *
+*                                                       per clip and the block of samples        *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def iter_audio_blocks(filename, seconds, samplerate=None, clips_per_block=CLIPS_PER_BLOCK, start_clip=0, stop_clip=None):
+    info = sf.info(filename)
+
+    if samplerate is not None and samplerate != info.samplerate:
+        import librosa # Heavy import, only pay for it when resampling
+        samples, samplerate = librosa.load(filename, sr=samplerate)
+        samples_per_split = math.ceil(seconds * samplerate)
+        stop = None if stop_clip is None else stop_clip * samples_per_split
+        yield samplerate, samples_per_split, samples[start_clip * samples_per_split : stop]
+        return
+
+    samples_per_split = math.ceil(seconds * info.samplerate)
+    stop = None if stop_clip is None else stop_clip * samples_per_split
+    for block in sf.blocks(filename, blocksize=samples_per_split * clips_per_block, dtype='float32', always_2d=True,
+                           start=start_clip * samples_per_split, stop=stop):
+        if block.shape[1] == 1:
+            yield info.samplerate, samples_per_split, np.ascontiguousarray(block[:, 0])
+        else:
+            yield info.samplerate, samples_per_split, block.mean(axis=1)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             gate_windows                                                                 *
+*                                                                                                *
+* Parameters:       np.array samples      - The samples of the whole file, floats in [-1, 1]     *
+*                   int samples_per_split - The number of samples in each clip                   *
+*                   float min_dbfs        - Clips with an rms level below this are rejected.     *
+*                                           None turns the silence gate off                      *
+*                   set seen_hashes       - Hashes of clips already kept. None turns duplicate   *
+*                                           detection off                                        *
+*                                                                                                *
+* Purpose:          Decides which clips are worth writing. The rms level of every clip is        *
+*                   computed at once, so the cost is a couple of passes over the samples         *
+*                                                                                                *
+* Returns:          np.array, int, int - Mask of the clips to keep, the number rejected for      *
+*                                        silence and the number rejected as duplicates           *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def gate_windows(samples, samples_per_split, min_dbfs=None, seen_hashes=None):
+    num_windows = math.ceil(len(samples) / samples_per_split)
+    keep = np.ones(num_windows, dtype=bool)
+    num_silent = 0
+    num_duplicate = 0
+
+    if min_dbfs is not None and num_windows > 0:
+        # Square and sum every full clip in one go, the last clip may be short so it is handled on its own
+        num_full = len(samples) // samples_per_split
+        squares = np.square(samples, dtype=np.float64)
+        energy = np.empty(num_windows)
+        lengths = np.full(num_windows, samples_per_split)
+        energy[:num_full] = squares[:num_full * samples_per_split].reshape(num_full, samples_per_split).sum(axis=1)
+        if num_full < num_windows:
+            energy[-1] = squares[num_full * samples_per_split:].sum()
+            lengths[-1] = len(samples) - num_full * samples_per_split
+
+        with np.errstate(divide='ignore'):
+            dbfs = 10 * np.log10(energy / lengths)
+
+        keep = dbfs >= min_dbfs
+        num_silent = int(num_windows - keep.sum())
+
+    if seen_hashes is not None:
+        for fileno in np.flatnonzero(keep):
+            digest = hashlib.blake2b(samples[fileno * samples_per_split : (fileno + 1) * samples_per_split].tobytes(),
+                                     digest_size=16).digest()
+            if digest in seen_hashes:
+                keep[fileno] = False
+                num_duplicate += 1
+            else:
+                seen_hashes.add(digest)
+
+    return keep, num_silent, num_duplicate
+
+# The rms level of a clip of float samples in dBFS, None for pure silence
+def clip_dbfs(samples):
+    power = np.mean(np.square(samples, dtype=np.float64))
+    return 10 * math.log10(power) if power > 0 else None
+
+# Samples per clip and between the starts of neighbouring clips. A hop of None puts the clips back to back
+def frame_sizes(seconds, hop, samplerate):
+    samples_per_split = math.ceil(seconds * samplerate)
+    hop_samples = samples_per_split if hop is None else max(1, round(hop * samplerate))
+    return samples_per_split, hop_samples
+
+# The number of full length clips in num_samples. Overlapping clips never include a short one at the end
+def count_frames(num_samples, samples_per_split, hop_samples):
+    if num_samples < samples_per_split:
+        return 0
+    return 1 + (num_samples - samples_per_split) // hop_samples
+
+# Every full length clip of samples as a row of a strided view. No samples are copied, overlapping rows share memory
+def frame_view(samples, samples_per_split, hop_samples):
+    if len(samples) < samples_per_split:
+        return np.empty((0, samples_per_split), dtype=samples.dtype)
+    return np.lib.stride_tricks.sliding_window_view(samples, samples_per_split)[::hop_samples]
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             iter_frame_blocks                                                            *
+*                                                                                                *
+* Parameters:       str filename        - The audio file to read                                 *
+*                   float seconds       - The length of each clip                                *
+*                   float hop           - Seconds between the starts of neighbouring clips       *
+*                   int samplerate      - Rate to resample to. None keeps the file's own rate    *
+*                   int clips_per_block - How many clips to decode at a time                     *
+*                   int start_clip      - The first clip to read                                 *
+*                   int stop_clip       - Stop before this clip. None reads to the end           *
+*                                                                                                *
+* Purpose:          iter_audio_blocks for overlapping clips. Each block holds the samples of a   *
+*                   run of whole clips, so a block overlaps the next one by the part of a clip   *
+*                   that is shared between them and is read twice. Clips are numbered by their   *
+*                   position in the file, clip n starts at sample n * hop                        *
+*                                                                                                *
+* Returns:          generator of (int, int, int, int, np.array) - The samplerate, samples per    *
+*                   clip, samples per hop, the number of the first clip in the block and the     *
+*                   block of mono float32 samples                                                *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def iter_frame_blocks(filename, seconds, hop, samplerate=None, clips_per_block=CLIPS_PER_BLOCK, start_clip=0, stop_clip=None):
+    info = sf.info(filename)
+
+    if samplerate is not None and samplerate != info.samplerate:
+        import librosa # Heavy import, only pay for it when resampling
+        samples, samplerate = librosa.load(filename, sr=samplerate)
+        samples_per_split, hop_samples = frame_sizes(seconds, hop, samplerate)
+        stop = count_frames(len(samples), samples_per_split, hop_samples)
+        stop = stop if stop_clip is None else min(stop, stop_clip)
+        if start_clip < stop:
+            yield (samplerate, samples_per_split, hop_samples, start_clip,
+                   samples[start_clip * hop_samples : (stop - 1) * hop_samples + samples_per_split])
+        return
+
+    samples_per_split, hop_samples = frame_sizes(seconds, hop, info.samplerate)
+    stop = count_frames(info.frames, samples_per_split, hop_samples)
+    stop = stop if stop_clip is None else min(stop, stop_clip)
+
+    with sf.SoundFile(filename) as f:
+        for first in range(start_clip, stop, clips_per_block):
+            last = min(first + clips_per_block, stop)
+            f.seek(first * hop_samples)
+            block = f.read((last - 1 - first) * hop_samples + samples_per_split, dtype='float32', always_2d=True)
+            if block.shape[1] == 1:
+                yield info.samplerate, samples_per_split, hop_samples, first, np.ascontiguousarray(block[:, 0])
+            else:
+                yield info.samplerate, samples_per_split, hop_samples, first, block.mean(axis=1)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             gate_frames                                                                  *
+*                                                                                                *
+* Parameters:       np.array samples      - Float samples holding whole clips                    *
+*                   int samples_per_split - The number of samples in each clip                   *
+*                   int hop_samples       - Samples between the starts of neighbouring clips     *
+*                   float min_dbfs        - Clips with an rms level below this are rejected.     *
+*                                           None turns the silence gate off                      *
+*                   set seen_hashes       - Hashes of clips already kept. None turns duplicate   *
+*                                           detection off                                        *
+*                                                                                                *
+* Purpose:          gate_windows for overlapping clips. The energy of every clip comes from one  *
+*                   running sum of the squared samples, so overlap does not add passes           *
+*                                                                                                *
+* Returns:          np.array, int, int - Mask of the clips to keep, the number rejected for      *
+*                                        silence and the number rejected as duplicates           *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def gate_frames(samples, samples_per_split, hop_samples, min_dbfs=None, seen_hashes=None):
+    num_frames = count_frames(len(samples), samples_per_split, hop_samples)
+    keep = np.ones(num_frames, dtype=bool)
+    num_silent = 0
+    num_duplicate = 0
+
+    if min_dbfs is not None and num_frames > 0:
+        running = np.concatenate(([0.0], np.cumsum(np.square(samples, dtype=np.float64))))
+        starts = np.arange(num_frames) * hop_samples
+        energy = np.maximum(running[starts + samples_per_split] - running[starts], 0)
+
+        with np.errstate(divide='ignore'):
+            dbfs = 10 * np.log10(energy / samples_per_split)
+
+        keep = dbfs >= min_dbfs
+        num_silent = int(num_frames - keep.sum())
+
+    if seen_hashes is not None:
+        frames = frame_view(samples, samples_per_split, hop_samples)
+        for frameno in np.flatnonzero(keep):
+            digest = hashlib.blake2b(frames[frameno].tobytes(), digest_size=16).digest()
+            if digest in seen_hashes:
+                keep[frameno] = False
+                num_duplicate += 1
+            else:
+                seen_hashes.add(digest)
+
+    return keep, num_silent, num_duplicate
 
 '''
 * ********************************************************************************************** *
@@ -48,140 +293,222 @@ import tqdm
 *                   int seconds     - The length each split audio file should be                 *
 *                   str outdir      - The directory to place the final file in. Assumes it       *
 *                                     already exists                                             *
+*                   float min_dbfs  - Skip clips quieter than this. None disables the gate       *
+*                   bool dedupe     - Skip clips that exactly match an earlier clip in the file  *
+*                   int samplerate  - Rate to resample to. None keeps the file's own rate        *
+*                   int start_clip  - The first clip to write                                    *
+*                   int stop_clip   - Stop before this clip. None splits to the end of the file  *
+*                   dict writer     - A clip pack writer from clippack.open_writer. When given   *
+*                                     the clips go into the pack instead of outdir               *
+*                   dict manifest   - From manifest.open_manifest, gets a row for each wav       *
+*                                     written                                                    *
 *                                                                                                *
-* Purpose:          Splits the given audio file into shorter files of length seconds             * 
+* Purpose:          Splits the given audio file into shorter files of length seconds. Clips that *
+*                   are rejected by the gate are never written. Clips keep the number of their   *
+*                   position in the source file, so rejected clips leave gaps in the numbering   *
+*                   The file is streamed a block at a time so memory use does not depend on how  *
+*                   long the recording is                                                        *
+*                                                                                                *
+* Returns:          dict - The number of clips in the file, written, silent and duplicate        *
 *                                                                                                *
 * ********************************************************************************************** *
 '''
-def split_audiofile(filename, seconds, outdir):
+def split_audiofile(filename, seconds, outdir, min_dbfs=None, dedupe=False, samplerate=None, start_clip=0, stop_clip=None,
+                    writer=None, manifest=None):
     # Gets the filename into a path and a filename
     split_filename = os.path.split(filename)
 
-    # Creates a np array of samples and the sampling rate of the file
+    # The filename split into
+    noext = split_filename[1].split('.')
 
-    samples, samplerate = librosa.load(filename, sr=None)
+    seen_hashes = set() if dedupe else None
+    stats = {'windows': 0, 'written': 0, 'silent': 0, 'duplicate': 0}
 
-    # The number of samples that will be in each second
-    samples_per_split = math.ceil(seconds * samplerate)
+    # The number of the first clip in the current block
+    first_fileno = start_clip
+
+    for samplerate, samples_per_split, samples in iter_audio_blocks(filename, seconds, samplerate,
+                                                                    start_clip=start_clip, stop_clip=stop_clip):
+        keep, num_silent, num_duplicate = gate_windows(samples, samples_per_split, min_dbfs, seen_hashes)
+
+        # iterate over each range of samples for the correct number of seconds
+        for blockno, idx in enumerate(range(0, len(samples), samples_per_split)):
+            if not keep[blockno]:
+                continue
+
+            newdata = samples[idx : idx + samples_per_split]
+            clip_filename = noext[0] +  '_' + str(first_fileno + blockno) + '.' + noext[1]
 
-    # iterate over each range of samples for the correct number of seconds
-    for fileno, idx in enumerate(range(0, len(samples), samples_per_split)):
-        newdata = samples[idx : idx + samples_per_split]
+            if writer is not None:
+                # The instrument tag, the same way extractFreqARFF.instrument_from_filename reads it
+                write_clip(writer, clip_filename, to_pcm16(newdata), samplerate, filename, noext[0].split('_')[0])
+            else:
+                sf.write(outdir + clip_filename, newdata, samplerate)
+                if manifest is not None:
+                    add_row(manifest, clip_row(outdir + clip_filename, len(newdata), samplerate, filename,
+                                               offset=(first_fileno + blockno) * seconds, dbfs=clip_dbfs(newdata)))
 
-        # The filename split into
-        noext = split_filename[1].split('.')
+        first_fileno += len(keep)
+        stats['windows'] += len(keep)
+        stats['written'] += int(keep.sum())
+        stats['silent'] += num_silent
+        stats['duplicate'] += num_duplicate
 
-        sf.write(outdir + noext[0] +  '_' + str(fileno) + '.' + noext[1], newdata, samplerate)
+    return stats
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             write_gate_report                                                            *
+*                                                                                                *
+* Parameters:       str outdir    - The split output directory the report lives in               *
+*                   str filename  - The source file the counts are for                           *
+*                   dict stats    - The counts returned by split_audiofile                       *
+*                                                                                                *
+* Purpose:          Appends one line per source file to the gate report. Each line is a single   *
+*                   small append, so batch processes can share the file                          *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def write_gate_report(outdir, filename, stats):
+    line = ','.join([os.path.split(filename)[1], str(stats['windows']), str(stats['written']),
+                     str(stats['silent']), str(stats['duplicate'])]) + '\n'
+    with open(outdir + GATE_REPORT, 'a') as f:
+        f.write(line)
+
+def print_gate_report(outdir):
+    if not os.path.exists(outdir + GATE_REPORT):
+        return
+
+    totals = [0, 0, 0, 0]
+    with open(outdir + GATE_REPORT, 'r') as f:
+        for row in csv.reader(f):
+            for idx in range(4):
+                totals[idx] += int(row[idx + 1])
+
+    print('Clips:', totals[0], 'written:', totals[1], 'silent:', totals[2], 'duplicate:', totals[3])
+    print('Per file counts are in', outdir + GATE_REPORT)
 
 '''
 * ********************************************************************************************** *
 *                                                                                                *
 * Name:             batch_split                                                                  *
 *                                                                                                *
-* Parameters:       str[] filenames   - All the audio files to be split                          *
+* Parameters:       str[] filenames   - All the audio files to be split, or clip ranges of them  *
+*                                       written as <file>@<start>-<stop>                         *
 *                   int seconds       - The length each split audio file should be               *
 *                   str outdir        - What the output directory to put split files in.         *
 *                                       length of the split gets appended to this                *
+*                   str manifest_filename - Where to append a manifest row for every file        *
+*                                       written, clips or pack shards. None writes no manifest   *
 *                                                                                                *
 * Purpose:         Takes in a list of audio filenames, and splits each of those files into       *
 *                  shorter files of length seconds. Runs on a single thread                      *
 *                                                                                                *
 * ********************************************************************************************** *
 '''
-def batch_split(filenames, seconds, outdir):
-    for filename in filenames:
-        split_audiofile(filename, seconds, outdir)
+def batch_split(filenames, seconds, outdir, min_dbfs=None, dedupe=False, samplerate=None, pack=False,
+                manifest_filename=None):
+    writer = open_writer(outdir) if pack else None
+    # Rows are relative to outdir, where the manifest ends up once the batches are merged
+    manifest = open_manifest(manifest_filename, outdir) if manifest_filename else None
+
+    for item in filenames:
+        filename, start_clip, stop_clip = parse_range(item)
+        stats = split_audiofile(filename, seconds, outdir, min_dbfs, dedupe, samplerate, start_clip, stop_clip, writer,
+                                manifest)
+        write_gate_report(outdir, filename, stats)
+
+    if writer is not None:
+        close_writer(writer)
+        if manifest is not None:
+            for shard in writer['finished']:
+                add_row(manifest, describe_file(shard))
+
+    if manifest is not None:
+        close_manifest(manifest)
 
 '''
 * ********************************************************************************************** *
 *                                                                                                *
 * Name:             append_cmd                                                                   *
 *                                                                                                *
-* Parameters:       str[] filenames   - All the audio files to be split                          *
+* Parameters:       str inputs        - Manifest of the audio files to be split                  *
+*                   str outputs       - Where the batch writes the manifest of its clips         *
 *                   int seconds       - The length each split audio file should be               *
 *                   str outdir        - What the output directory to put split files in.         *
 *                                       length of the split gets appended to this                *
 *                                                                                                *
-* Purpose:         Generates a batch mode command string that can be used to call this program   *
-*                  appends all filenames onto the template cmd                                   *
+* Purpose:         Generates a batch mode command that can be used to call this program. The     *
+*                  files to split are read from the inputs manifest, so no paths go through the  *
+*                  shell and the command line stays short however many files there are           *
 *                                                                                                *
-* Returns:         str - A filled out template command                                           *
+* Returns:         str[] - The command as a list of arguments                                    *
 *                                                                                                *
 * ********************************************************************************************** *
 '''
-def append_cmd(filenames, seconds, outdir):
-    cmd = 'python3 splitaudio.py -b ' + str(seconds) + ' ' + outdir
+def append_cmd(inputs, outputs, seconds, outdir, min_dbfs=None, dedupe=False, samplerate=None, pack=False):
+    cmd = ['python3', 'splitaudio.py', '-b', str(seconds), outdir, '--inputs', inputs, '--manifest', outputs]
 
-    process_cmd = cmd
-    for file in filenames:
-        process_cmd += ' ' + file
+    if min_dbfs is not None:
+        cmd += ['--gatedb', str(min_dbfs)]
+    if dedupe:
+        cmd += ['--dedupe']
+    if samplerate is not None:
+        cmd += ['--samplerate', str(samplerate)]
+    if pack:
+        cmd += ['--pack']
 
-    return process_cmd
+    return cmd
 
 '''
 * ********************************************************************************************** *
 *                                                                                                *
 * Name:             make_cmds_arr                                                                *
 *                                                                                                *
-* Parameters:       str[] filenames   - The filenames to create commands for                     *
+* Parameters:       [dict] rows       - Manifest rows of the files to create commands for        *
 *                   int seconds       - The length each split audio file should be               *
 *                   str outdir        - The path to place normalized files in                    *
 *                   int max_processes - The maximum number of threads to be used at any one time *
 *                                                                                                *
-* Purpose:          Takes in a list of filenames and returns a 2d array with each element        *
-*                   containing a str in element zero, which is the command to process a          *
-*                   chunk of files, and an int in element 1 which is how many files that cmd     *
-*                   will process                                                                 *
+* Purpose:          Takes in a list of files and returns a 2d array with each element            *
+*                   containing a command in element zero, which processes a chunk of files, and  *
+*                   an int in element 1 which is how many seconds of audio that cmd will split.  *
+*                   Work is shared out by the length of each recording from the manifest (see    *
+*                   workplan.py), and recordings longer than one command's share are cut into    *
+*                   clip ranges. Files are not cut when deduping, since duplicates are only      *
+*                   found within one piece, or when resampling, since that decodes the whole     *
+*                   file for every piece                                                         *
 *                                                                                                *
-* Returns:          [[str, int]] - str - the filled out command template                         *
-*                                  int - the number of files that command will process           *
+* Returns:          [[str[], int]], str - The commands and the seconds of audio each will split, *
+*                                         and the temp folder of batch manifests to pass to      *
+*                                         manifest.merge_batches once they have run              *
 *                                                                                                *
 * ********************************************************************************************** *
 '''
-def make_cmds_arr(filenames, seconds, outdir, max_processes):
-    numfiles = len(filenames)
-     
-    # No files to process
-    if numfiles == 0:
-        return [] 
-    elif numfiles == 1: # This function would technically work with 1 file, it's just needlessly overcomplex
-        split_audiofile(filenames[0], seconds, outdir)
-
-    numrounds = 2 
-    files_per_process = (numfiles // max_processes) // numrounds 
-    # files_remainder = numfiles - ((max_processes * numrounds) * files_per_process)
-         
-    cmds = []
-    start_idx = 0
-    
-    # If less files than there are max_processes * numrounds, just distribute the small number of files onto their own processes
-    if files_per_process == 0:
-        files_per_process = 1
-
-    for _ in range(max_processes * numrounds):
+def make_cmds_arr(rows, seconds, outdir, max_processes, min_dbfs=None, dedupe=False, samplerate=None, pack=False):
+    filenames = [row['path'] for row in rows]
+    costs = [row['duration'] for row in rows]
+    batches = max_processes * BATCHES_PER_WORKER
 
-        end_idx = start_idx + files_per_process
+    items = filenames
+    max_cost = sum(costs) / batches if filenames else 0
+    if dedupe or samplerate is not None:
+        num_long = sum(cost > max_cost for cost in costs)
+        if num_long > 0:
+            print('Note:', num_long, 'files are longer than one command\'s share but are split in one piece each,',
+                  '--dedupe and --samplerate do not cut files into clip ranges')
+    elif filenames:
+        items, costs = split_long_files(filenames, costs, seconds, max_cost)
 
-        if end_idx > numfiles:
-            break
+    planned = plan_batches(items, costs, batches)
+    batch_dir, written = write_batches(planned)
 
-        process_files = filenames[start_idx:end_idx]
-        
-        # Happens if we have already distributed all files we have
-        if len(process_files) == 0:
-            continue
-
-        process_cmd = append_cmd(process_files, seconds, outdir) 
-        
-        cmds.append([process_cmd, len(process_files)])
-        start_idx = end_idx
-    
-    # Reached if the number of files is not evenly divisible by max_processes * numrounds
-    leftover_filenames = filenames[start_idx:len(filenames)] 
-    if len(leftover_filenames) > 0:
-        cmds.append([append_cmd(leftover_filenames, seconds, outdir), len(leftover_filenames)])
+    cmds = []
+    for (inputs, outputs, _), (_, cost) in zip(written, planned):
+        cmds.append([append_cmd(inputs, outputs, seconds, outdir, min_dbfs, dedupe, samplerate, pack), max(1, round(cost))])
 
-    return cmds
+    return cmds, batch_dir
 
 
 '''
@@ -189,73 +516,81 @@ def make_cmds_arr(filenames, seconds, outdir, max_processes):
 *                                                                                                *
 * Name:             multithread_split                                                            *
 *                                                                                                *
-* Parameters:       str[] filenames   - All the audio files to be split                          *
+* Parameters:       str indir         - The folder of audio files to be split                    *
 *                   int seconds       - The length each split audio file should be               *
 *                   str outdir        - What the output directory to put split files in.         *
 *                                       length of the split gets appended to this                *
-*                   int max_processes - The maximum number of subprocesses allowed to exist      *
+*                   max_processes     - The maximum number of subprocesses allowed to exist, or  *
+*                                       'auto' to adjust it as it runs (see procpool.py)         *
 *                                                                                                *
 * Purpose:         Takes in a list of audio filenames, and splits each of those files into       *
 *                  shorter files of length seconds. Subprocess is used to multithread the process*
+*                  The files come from the manifest of indir, and a manifest of the clips is     *
+*                  written to outdir for the next stage. Given a catalog (catalog.py), the       *
+*                  recordings and their clips are recorded in it once the split is done          *
 *                                                                                                *
 * ********************************************************************************************** *
 '''
-def multithread_split(indir, seconds, outdir, max_processes):
-    filenames = glob.glob(indir + '*.wav')
+def multithread_split(indir, seconds, outdir, max_processes, min_dbfs=None, dedupe=False, samplerate=None, pack=False,
+                      catalog=None):
+    rows = list_inputs(indir)
+
+    # Start a fresh gate report and manifest, the batch processes append to them
+    for filename in [outdir + GATE_REPORT, manifest_filename(outdir)]:
+        if os.path.exists(filename):
+            os.remove(filename)
     
     # If we're only doing 1 thread, then splitting up the workload is useless
     if max_processes == 1:
-        batch_split(filenames, seconds, outdir)
-        return
+        batch_split([row['path'] for row in rows], seconds, outdir, min_dbfs, dedupe, samplerate, pack,
+                    manifest_filename(outdir))
+    else:
+        cmds, batch_dir = make_cmds_arr(rows, seconds, outdir, planned_workers(max_processes), min_dbfs, dedupe, samplerate, pack)
+        run_commands(cmds, max_processes, 'Splitting Audio')
+        merge_batches(batch_dir, outdir)
 
-    cmds = make_cmds_arr(filenames, seconds, outdir, max_processes) 
-    running_processes = []
-    
-    pbar = tqdm.tqdm(desc='Splitting Audio', total=len(filenames))
-
-    while cmds:
-        # Checking cmds as there is a chance we could try and pop off an empty list, and the outer check to cmds
-        # will not prevent this
-        while len(running_processes) < max_processes and cmds:
-            cmd_and_count = cmds.pop()
-            # Pass on the selected process along with the number of files it will normalize 
-            running_processes.append([subprocess.Popen(cmd_and_count[0], shell=True), cmd_and_count[1]])
-        
-        # See if any of the processes have completed, and remove them if they are
-        completed_processes = []
-        for cmd_and_count in running_processes:
-            if cmd_and_count[0].poll() is not None:
-                completed_processes.append(cmd_and_count)
-                pbar.update(cmd_and_count[1])
-        
-        # Remove any processes that have been completed
-        for process in completed_processes: 
-            running_processes.remove(process)
-    
-    # Wait for all processes to complete once all cmds have been run
-    for cmd_and_count in running_processes:
-        cmd_and_count[0].wait()
-        pbar.update(cmd_and_count[1])
+    print_gate_report(outdir)
+
+    if catalog is not None:
+        record_sources(catalog, rows, 'split')
+        print('Recorded', record_stage(catalog, 'split', outdir), 'clips in', catalog)
 
 __USAGE__ = 'splitaudio.py -m <audio dir> <len(seconds)> <output dir> <max_processes>- splits all files contained in <audio dir> to files of <len> seconds. Is multithreaded'\
         'splitaudio.py -b <len(seconds)> <output dir> <file1 ... file2 ... filen> - splits all files passed in on the command line into <len> second files'\
         'splitaudio.py -s <file> <len(seconds)> <output dir> - splits a single file into <len> second files and places the output somewhere'
 
 if __name__ == "__main__":
-    argv = sys.argv
+    # Pull the optional gate flags out, everything left over is the positional arguments for the mode
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--gatedb', type=float, default=None)
+    parser.add_argument('--dedupe', action='store_true', default=False)
+    parser.add_argument('--samplerate', type=int, default=None)
+    parser.add_argument('--pack', action='store_true', default=False)
+    parser.add_argument('--inputs', default=None)
+    parser.add_argument('--manifest', default=None)
+    parser.add_argument('--catalog', default=None)
+    gate_args, argv = parser.parse_known_args()
+    argv = [sys.argv[0]] + argv
     argc = len(argv)
     
     if argv[1] == '-s':
-        split_audiofile(argv[2], float(argv[3]), argv[4])
-    if argv[1] == '-b' and argc > 4:
+        writer = open_writer(argv[4]) if gate_args.pack else None
+        print(split_audiofile(argv[2], float(argv[3]), argv[4], gate_args.gatedb, gate_args.dedupe, gate_args.samplerate,
+                              writer=writer))
+        if writer is not None:
+            close_writer(writer)
+    if argv[1] == '-b' and (argc > 4 or gate_args.inputs):
         seconds = float(argv[2])
         
         outdir = argv[3]
         os.makedirs(outdir, exist_ok=True)
 
         filenames = [x for x in argv[4:argc]]
+        if gate_args.inputs:
+            filenames.extend(read_paths(gate_args.inputs))
 
-        batch_split(filenames, seconds, outdir) 
+        batch_split(filenames, seconds, outdir, gate_args.gatedb, gate_args.dedupe, gate_args.samplerate, gate_args.pack,
+                    gate_args.manifest)
     if argv[1] == '-m':
         indir = argv[2]
         seconds = float(argv[3])
@@ -263,7 +598,8 @@ if __name__ == "__main__":
         outdir = argv[4]
         os.makedirs(outdir, exist_ok=True)
         
-        max_processes = int(argv[5])
-        multithread_split(indir, seconds, outdir, max_processes)
+        max_processes = parse_max_processes(argv[5])
+        multithread_split(indir, seconds, outdir, max_processes, gate_args.gatedb, gate_args.dedupe, gate_args.samplerate,
+                          gate_args.pack, gate_args.catalog)
 
     # Run split_audiofile on a single file
@@ -0,0 +1,133 @@
+'''
+**************************************************************************************************
+* Filename:    workplan.py                                                                       *
+*                                                                                                *
+* Description: Splits a list of files into batches for the multithreaded stages by how long each *
+*              file should take instead of by how many files there are. Source recordings range  *
+*              from seconds to over an hour, so equal file counts leave one process stuck on the *
+*              longest tracks while the rest sit idle at the end.                                *
+*                                                                                                *
+*              A file's cost is the length of its audio, read from the file header, or its size  *
+*              on disk when there is no header to read. Batches are filled longest first, each   *
+*              file going to the batch with the least work so far (longest processing time       *
+*              first scheduling), and the batches are returned heaviest first since procpool.py  *
+*              starts commands in the order given. Files longer than a batch's fair share can be *
+*              cut into clip ranges so one recording no longer sets the length of the stage.     *
+*                                                                                                *
+**************************************************************************************************
+'''
+import os
+import re
+import math
+import heapq
+
+import soundfile as sf
+
+# How many batches each worker gets. More batches evens out the end of the stage and gives the
+# 'auto' concurrency controller finished commands to measure, at the cost of more process startups
+BATCHES_PER_WORKER = 4
+# 16 bit stereo at 44.1 kHz, used to guess a duration from the size of files soundfile can not read
+BYTES_PER_SECOND = 176400
+
+# A clip range on the command line, <file>@<first clip>-<stop clip>
+RANGE_PATTERN = re.compile(r'^(.*)@(\d+)-(\d+)$')
+
+def size_cost(filename):
+    return os.path.getsize(filename)
+
+# Seconds of audio in the file, from its header alone
+def duration_cost(filename):
+    try:
+        info = sf.info(filename)
+        return info.frames / info.samplerate
+    except RuntimeError:
+        return os.path.getsize(filename) / BYTES_PER_SECOND
+
+def num_batches(num_items, workers, max_items=None):
+    batches = workers * BATCHES_PER_WORKER
+    # Keeps batches of tiny files from getting too long to give useful progress
+    if max_items is not None:
+        batches = max(batches, math.ceil(num_items / max_items))
+
+    return max(1, min(batches, num_items))
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             plan_batches                                                                 *
+*                                                                                                *
+* Parameters:       list items       - The work to split up, filenames or clip ranges            *
+*                   float[] costs    - The estimated cost of each item                           *
+*                   int batches      - How many batches to make                                  *
+*                                                                                                *
+* Purpose:          Longest processing time first: items are taken from the most to the least    *
+*                   expensive and each goes to the batch with the least total cost so far        *
+*                                                                                                *
+* Returns:          [[list, float]] - The items of each batch and its total cost, heaviest batch *
+*                                     first. Empty batches are left out                          *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def plan_batches(items, costs, batches):
+    order = sorted(range(len(items)), key=lambda idx: costs[idx], reverse=True)
+
+    planned = [[[], 0] for _ in range(batches)]
+    # (total cost, batch number) of every batch, the least loaded on top
+    loads = [(0, batch) for batch in range(batches)]
+
+    for idx in order:
+        total, batch = heapq.heappop(loads)
+        planned[batch][0].append(items[idx])
+        planned[batch][1] = total + costs[idx]
+        heapq.heappush(loads, (planned[batch][1], batch))
+
+    planned = [batch for batch in planned if batch[0]]
+    planned.sort(key=lambda batch: batch[1], reverse=True)
+
+    return planned
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             split_long_files                                                             *
+*                                                                                                *
+* Parameters:       str[] filenames  - The files to be split into clips                          *
+*                   float[] costs    - The duration of each file in seconds                      *
+*                   float seconds    - The length of each clip                                   *
+*                   float max_cost   - The most audio, in seconds, one item should hold          *
+*                                                                                                *
+* Purpose:          Cuts files longer than max_cost into ranges of whole clips so the pieces can *
+*                   go to different processes. Clip numbering is kept, so the clips a range      *
+*                   writes have the same names they would have had from the whole file           *
+*                                                                                                *
+* Returns:          str[], float[] - The items, a filename or <file>@<start>-<stop>, and their  *
+*                                    costs                                                       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def split_long_files(filenames, costs, seconds, max_cost):
+    items = []
+    item_costs = []
+
+    clips_per_range = max(1, int(max_cost // seconds))
+    for filename, cost in zip(filenames, costs):
+        num_clips = math.ceil(cost / seconds)
+        if cost <= max_cost or num_clips <= clips_per_range:
+            items.append(filename)
+            item_costs.append(cost)
+            continue
+
+        for start in range(0, num_clips, clips_per_range):
+            stop = min(start + clips_per_range, num_clips)
+            items.append(filename + '@' + str(start) + '-' + str(stop))
+            item_costs.append(min(stop * seconds, cost) - start * seconds)
+
+    return items, item_costs
+
+# Splits a command line item back into its filename and clip range, a plain filename reads the whole file
+def parse_range(item):
+    match = RANGE_PATTERN.match(item)
+    if match is None or os.path.exists(item):
+        return item, 0, None
+
+    return match.group(1), int(match.group(2)), int(match.group(3))
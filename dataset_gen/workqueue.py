@@ -0,0 +1,340 @@
+'''
+**************************************************************************************************
+* Filename:    workqueue.py                                                                      *
+*                                                                                                *
+* Description: A lease based work queue that lives in a directory on a shared filesystem, so     *
+*              worker processes on any number of hosts can pull work from it with no server.     *
+*                                                                                                *
+*              <queue>/pending/<unit>.json          - Work waiting to be claimed                 *
+*              <queue>/leased/<unit>@<worker>.json  - Work a worker holds. The file's mtime is   *
+*                                                     the last time the lease was renewed        *
+*              <queue>/done/<unit>.json             - Finished work                              *
+*              <queue>/failed/<unit>.json           - Work that raised an error on every attempt *
+*              <queue>/shards/                      - Output written by the workers              *
+*                                                                                                *
+*              Every state change is a single rename, which is atomic on a shared filesystem, so *
+*              exactly one worker wins each claim. A worker that stops renewing its lease, for   *
+*              example because it died, has its unit moved back to pending by whoever notices.   *
+*              Lease times are compared against the filesystem's clock rather than the host's so *
+*              hosts with drifting clocks do not steal each other's work. A unit whose work      *
+*              raises is put back in pending with its attempts counted in its json, and after    *
+*              MAX_ATTEMPTS it is moved to failed instead so one bad input cannot stop a worker. *
+*                                                                                                *
+**************************************************************************************************
+'''
+import os
+import json
+import time
+import socket
+import threading
+
+PENDING_DIR = 'pending/'
+LEASED_DIR = 'leased/'
+DONE_DIR = 'done/'
+FAILED_DIR = 'failed/'
+SHARDS_DIR = 'shards/'
+CONFIG_FILENAME = 'config.json'
+CLOCK_FILENAME = '.clock'
+# Times a unit can raise before it is moved to failed
+MAX_ATTEMPTS = 3
+
+def make_worker_id():
+    return socket.gethostname() + '-' + str(os.getpid())
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             create_queue                                                                 *
+*                                                                                                *
+* Parameters:       str queue_dir - The shared directory for the queue                           *
+*                   dict[] units  - The work units. Each is saved as json                        *
+*                   dict config   - Settings every worker needs, saved next to the queue         *
+*                                                                                                *
+* Purpose:          Publishes work units. Units are numbered in the order given                  *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def create_queue(queue_dir, units, config):
+    for subdir in [PENDING_DIR, LEASED_DIR, DONE_DIR, FAILED_DIR, SHARDS_DIR]:
+        os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+
+    with open(os.path.join(queue_dir, CONFIG_FILENAME), 'w') as f:
+        json.dump(config, f, indent=1)
+
+    for idx, unit in enumerate(units):
+        unit_id = '%07d' % idx
+        write_atomic(os.path.join(queue_dir, PENDING_DIR, unit_id + '.json'), json.dumps(unit))
+
+def read_config(queue_dir):
+    with open(os.path.join(queue_dir, CONFIG_FILENAME), 'r') as f:
+        return json.load(f)
+
+def write_atomic(filename, text):
+    with open(filename + '.tmp', 'w') as f:
+        f.write(text)
+    os.replace(filename + '.tmp', filename)
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             shared_now                                                                   *
+*                                                                                                *
+* Parameters:       str queue_dir - The shared directory for the queue                           *
+*                                                                                                *
+* Purpose:          Touches a file and reads back its mtime. On a network filesystem the server  *
+*                   sets the time, so this is the same clock the lease mtimes come from          *
+*                                                                                                *
+* Returns:          float - The current time according to the filesystem                         *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def shared_now(queue_dir):
+    clock = os.path.join(queue_dir, CLOCK_FILENAME)
+    with open(clock, 'a'):
+        os.utime(clock, None)
+
+    return os.stat(clock).st_mtime
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             claim                                                                        *
+*                                                                                                *
+* Parameters:       str queue_dir  - The shared directory for the queue                          *
+*                   str worker_id  - Name of the worker taking the lease                         *
+*                                                                                                *
+* Purpose:          Takes the lease on the next pending unit. The pending file is touched before *
+*                   it is renamed so a fresh lease never looks expired                           *
+*                                                                                                *
+* Returns:          str, dict - The unit id and the unit, or None, None when nothing is pending *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def claim(queue_dir, worker_id):
+    pending_dir = os.path.join(queue_dir, PENDING_DIR)
+
+    for name in sorted(os.listdir(pending_dir)):
+        if not name.endswith('.json'):
+            continue
+
+        unit_id = name[:-len('.json')]
+        pending = os.path.join(pending_dir, name)
+        leased = lease_filename(queue_dir, unit_id, worker_id)
+
+        try:
+            os.utime(pending, None)
+            os.rename(pending, leased)
+        except FileNotFoundError:
+            continue # Another worker got it first
+
+        with open(leased, 'r') as f:
+            return unit_id, json.load(f)
+
+    return None, None
+
+def lease_filename(queue_dir, unit_id, worker_id):
+    return os.path.join(queue_dir, LEASED_DIR, unit_id + '@' + worker_id + '.json')
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             renew                                                                        *
+*                                                                                                *
+* Parameters:       str queue_dir  - The shared directory for the queue                          *
+*                   str unit_id    - The leased unit                                             *
+*                   str worker_id  - The worker holding the lease                                *
+*                                                                                                *
+* Returns:          bool - False if the lease was reclaimed and the unit is no longer ours       *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def renew(queue_dir, unit_id, worker_id):
+    try:
+        os.utime(lease_filename(queue_dir, unit_id, worker_id), None)
+        return True
+    except FileNotFoundError:
+        return False
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             complete                                                                     *
+*                                                                                                *
+* Parameters:       str queue_dir  - The shared directory for the queue                          *
+*                   str unit_id    - The leased unit                                             *
+*                   str worker_id  - The worker holding the lease                                *
+*                                                                                                *
+* Purpose:          Marks a unit done. The worker must have already moved its shard into place  *
+*                                                                                                *
+* Returns:          bool - False if the lease had been reclaimed first                           *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def complete(queue_dir, unit_id, worker_id):
+    try:
+        os.rename(lease_filename(queue_dir, unit_id, worker_id), os.path.join(queue_dir, DONE_DIR, unit_id + '.json'))
+        return True
+    except FileNotFoundError:
+        return False
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             reclaim_expired                                                              *
+*                                                                                                *
+* Parameters:       str queue_dir       - The shared directory for the queue                     *
+*                   float lease_seconds - How long a lease lasts without being renewed           *
+*                   str worker_id       - Name of the worker doing the reclaiming                *
+*                                                                                                *
+* Purpose:          Moves units whose lease has run out back to pending. An expired lease is     *
+*                   first renamed to a reclaim name, which only one worker can do, and its mtime *
+*                   is checked again there. The holder may have renewed it between the first     *
+*                   look and the rename, in which case it is given back instead                  *
+*                                                                                                *
+* Returns:          int - The number of units reclaimed                                          *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def reclaim_expired(queue_dir, lease_seconds, worker_id=None):
+    if worker_id is None:
+        worker_id = make_worker_id()
+    leased_dir = os.path.join(queue_dir, LEASED_DIR)
+    now = shared_now(queue_dir)
+    num_reclaimed = 0
+
+    for name in os.listdir(leased_dir):
+        if not name.endswith('.json'):
+            continue
+
+        leased = os.path.join(leased_dir, name)
+        reclaiming = leased + '.reclaim-' + worker_id
+        try:
+            if now - os.stat(leased).st_mtime < lease_seconds:
+                continue
+            os.rename(leased, reclaiming)
+        except FileNotFoundError:
+            continue # Completed or reclaimed by someone else in the meantime
+
+        # A rename keeps the mtime, so a renewal that landed before it shows up here
+        if shared_now(queue_dir) - os.stat(reclaiming).st_mtime < lease_seconds:
+            os.rename(reclaiming, leased)
+            continue
+
+        unit_id = name.split('@')[0]
+        os.rename(reclaiming, os.path.join(queue_dir, PENDING_DIR, unit_id + '.json'))
+        num_reclaimed += 1
+
+    return num_reclaimed
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             release_failed                                                               *
+*                                                                                                *
+* Parameters:       str queue_dir    - The shared directory for the queue                        *
+*                   str unit_id      - The leased unit                                           *
+*                   str worker_id    - The worker holding the lease                              *
+*                   int max_attempts - Attempts before the unit is given up on                   *
+*                                                                                                *
+* Purpose:          Counts a failed attempt in the unit's json and puts the unit back in pending *
+*                   or, once it has failed max_attempts times, in failed. The lease is renamed   *
+*                   away first so a reclaim cannot also move it                                  *
+*                                                                                                *
+* Returns:          str - 'pending' or 'failed', None if the lease had been reclaimed first      *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def release_failed(queue_dir, unit_id, worker_id, max_attempts=MAX_ATTEMPTS):
+    leased = lease_filename(queue_dir, unit_id, worker_id)
+    releasing = leased + '.failing'
+    try:
+        os.rename(leased, releasing)
+    except FileNotFoundError:
+        return None
+
+    with open(releasing, 'r') as f:
+        unit = json.load(f)
+    unit['attempts'] = unit.get('attempts', 0) + 1
+
+    state, subdir = ('failed', FAILED_DIR) if unit['attempts'] >= max_attempts else ('pending', PENDING_DIR)
+    os.makedirs(os.path.join(queue_dir, subdir), exist_ok=True)
+    write_atomic(os.path.join(queue_dir, subdir, unit_id + '.json'), json.dumps(unit))
+    os.remove(releasing)
+
+    return state
+
+def count_units(queue_dir):
+    counts = {}
+    for state, subdir in [('pending', PENDING_DIR), ('leased', LEASED_DIR), ('done', DONE_DIR), ('failed', FAILED_DIR)]:
+        state_dir = os.path.join(queue_dir, subdir)
+        names = os.listdir(state_dir) if os.path.isdir(state_dir) else []
+        counts[state] = len([name for name in names if name.endswith('.json')])
+
+    return counts
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             run_worker                                                                   *
+*                                                                                                *
+* Parameters:       str queue_dir      - The shared directory for the queue                      *
+*                   func process_unit  - Called as process_unit(unit, config, tempfilename). It  *
+*                                        must write all of its output to tempfilename            *
+*                   float lease_seconds - How long a lease lasts without being renewed           *
+*                   str worker_id      - Name of this worker, defaults to host-pid               *
+*                   str shard_ext      - Extension of the shard files                            *
+*                   int max_attempts   - Times a unit can raise before it is moved to failed     *
+*                                                                                                *
+* Purpose:          Claims and processes units until there are none left. A background thread   *
+*                   renews the lease while a unit is being processed. The shard is moved into    *
+*                   place before the unit is marked done, and work is deterministic, so a unit   *
+*                   finished twice after a reclaim just writes the same shard again. An error    *
+*                   from process_unit is printed and the unit released with release_failed, and  *
+*                   the worker carries on with the next unit                                     *
+*                                                                                                *
+* Returns:          int - The number of units this worker completed                              *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def run_worker(queue_dir, process_unit, lease_seconds=60, worker_id=None, shard_ext='.csv', max_attempts=MAX_ATTEMPTS):
+    if worker_id is None:
+        worker_id = make_worker_id()
+    config = read_config(queue_dir)
+    num_completed = 0
+
+    while True:
+        unit_id, unit = claim(queue_dir, worker_id)
+
+        if unit_id is None:
+            # Nothing pending, but a dead worker may be sitting on a lease
+            if reclaim_expired(queue_dir, lease_seconds, worker_id) > 0:
+                continue
+            if count_units(queue_dir)['leased'] == 0:
+                break
+            time.sleep(lease_seconds / 4)
+            continue
+
+        stop_renewing = threading.Event()
+        def keep_renewing():
+            # Keeps trying after a failed renew, a reclaim that finds the lease still fresh gives it back
+            while not stop_renewing.wait(lease_seconds / 3):
+                renew(queue_dir, unit_id, worker_id)
+        renewer = threading.Thread(target=keep_renewing, daemon=True)
+        renewer.start()
+
+        tempfilename = os.path.join(queue_dir, SHARDS_DIR, unit_id + '@' + worker_id + '.tmp')
+        try:
+            process_unit(unit, config, tempfilename)
+            os.replace(tempfilename, os.path.join(queue_dir, SHARDS_DIR, unit_id + shard_ext))
+            if complete(queue_dir, unit_id, worker_id):
+                num_completed += 1
+        except Exception as e:
+            state = release_failed(queue_dir, unit_id, worker_id, max_attempts)
+            print('Error: unit', unit_id, 'raised', repr(e) + ',', 'moved to', state or 'nowhere, it was reclaimed')
+        finally:
+            stop_renewing.set()
+            renewer.join()
+            if os.path.exists(tempfilename):
+                os.remove(tempfilename)
+
+    return num_completed
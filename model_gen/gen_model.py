@@ -1,28 +1,307 @@
 import pandas as pd
+import numpy as np
 from sklearn.model_selection import train_test_split
 from sklearn.tree import DecisionTreeClassifier
-from sklearn.metrics import confusion_matrix, accuracy_score
+from sklearn.linear_model import SGDClassifier, Perceptron
+from sklearn.naive_bayes import GaussianNB
+from sklearn.preprocessing import StandardScaler
+from sklearn.pipeline import Pipeline
+from sklearn.metrics import confusion_matrix, accuracy_score, pairwise_distances_argmin
+from sklearn.cluster import MiniBatchKMeans
 from sklearn.model_selection import RandomizedSearchCV
-from scipy.io import arff
 
 import pickle
 import os
 import sys
 import glob
 import zlib
+import time
+import argparse
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+parent_dir = os.path.abspath(os.path.join(script_dir, '..'))
+# Add the parent directory to sys.path
+sys.path.append(parent_dir)
+# Allow relative imports
+from dataset_gen.partitioned import is_partitioned, read_index, partition_files, load_partitions # pyright: ignore
+from dataset_gen.arffio import read_arff_frame, iter_arff_chunks, find_classes, read_header, stored_harmonics # pyright: ignore
+from cli_tool.modelregistry import add_model, splitlen_from_name # pyright: ignore
 
 MODELS_DIR = 'models/'
+# A modelregistry.py folder every saved model is also added to, None to only write the .pkl files
+REGISTRY_DIR = None
+
+# The most cost-complexity pruning levels tried when a budget is given, spread over the whole pruning path
+PRUNE_CANDIDATES = 25
+# Held out from the training split to pick the pruning level, so the test split still measures the chosen model
+PRUNE_VALIDATION = 0.2
+
+# How a coreset picks its rows, see make_coreset
+CORESET_METHODS = ['kmeans', 'stratified']
+# Passes over each instrument's rows when clustering them for a coreset
+KMEANS_PASSES = 3
+# Held out accuracy the coreset model may lose against the full data model before the check fails
+CORESET_TOLERANCE = 0.02
+# Held out from the training split for the coreset check, so the test split still measures the chosen model
+CORESET_VALIDATION = 0.2
+# Seeds the parameter search and the tree when the coreset and full data models are compared, so the only
+# difference between the two searches is their rows
+SEARCH_SEED = 0
+
+# Estimators that support partial_fit, used by the streaming training mode
+STREAMING_ESTIMATORS = {
+    'sgd': lambda: SGDClassifier(loss='log_loss', random_state=0),
+    'perceptron': lambda: Perceptron(random_state=0),
+    'nb': lambda: GaussianNB(),
+}
+
+# The number of harmonics a dataset was extracted with. Any smaller count can be trained on without
+# re-extracting, since the leading columns of each row are the strongest harmonics
+def dataset_harmonics(arff_filename):
+    if is_partitioned(arff_filename):
+        return len(read_index(arff_filename)['attributes']) // 2
+
+    names, _, _ = read_header(arff_filename)
+    return stored_harmonics(names)
+
+# Nodes, depth, pickled size and the time to predict each row of X, the costs a budget can limit
+def model_cost(model, X, repeats=3):
+    pickled = pickle.dumps(model)
+    best_time = min(timed_predict(model, X) for _ in range(repeats))
+
+    return {'nodes': model.tree_.node_count, 'depth': model.get_depth(), 'bytes': len(pickled),
+            'embedded_bytes': len(zlib.compress(pickled)), 'us_per_row': 1e6 * best_time / max(len(X), 1)}
+
+def timed_predict(model, X):
+    start = time.perf_counter()
+    model.predict(X)
+    return time.perf_counter() - start
+
+def within_budget(cost, budget):
+    return all(cost[key] <= limit for key, limit in budget.items() if limit is not None)
+
+# Candidates no other candidate beats on accuracy, size and latency at once
+def pareto_front(candidates):
+    def dominates(a, b):
+        at_least = a['accuracy'] >= b['accuracy'] and a['bytes'] <= b['bytes'] and a['us_per_row'] <= b['us_per_row']
+        better = a['accuracy'] > b['accuracy'] or a['bytes'] < b['bytes'] or a['us_per_row'] < b['us_per_row']
+        return at_least and better
+
+    return [not any(dominates(other, candidate) for other in candidates) for candidate in candidates]
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             prune_to_budget                                                              *
+*                                                                                                *
+* Parameters:       dict params       - The decision tree parameters the random search picked    *
+*                   np.array X_train  - Training rows                                            *
+*                   np.array y_train  - Their instruments                                        *
+*                   dict budget       - Limits on 'nodes', 'depth' and pickled 'bytes', None     *
+*                                       for no limit                                             *
+*                                                                                                *
+* Purpose:          Walks the cost-complexity pruning path of the tree. Each pruning level is    *
+*                   fit on part of the training rows and scored on the rest, then the most       *
+*                   accurate level within the budget is refit on all of them, the smallest level *
+*                   on a tie. Prints the accuracy, latency and size of every level so the trade  *
+*                   off can be seen. Exits with an error naming the smallest reachable tree when *
+*                   no level fits                                                                *
+*                                                                                                *
+* Returns:          DecisionTreeClassifier - The chosen tree                                     *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def prune_to_budget(params, X_train, y_train, budget):
+    X_fit, X_val, y_fit, y_val = train_test_split(X_train, y_train, test_size=PRUNE_VALIDATION, random_state=0)
+
+    path = DecisionTreeClassifier(**params, random_state=0).cost_complexity_pruning_path(X_fit, y_fit)
+    alphas = np.unique(path.ccp_alphas)
+    if len(alphas) > PRUNE_CANDIDATES:
+        alphas = alphas[np.unique(np.linspace(0, len(alphas) - 1, PRUNE_CANDIDATES).round().astype(int))]
+
+    candidates = []
+    for alpha in alphas:
+        model = DecisionTreeClassifier(**params, ccp_alpha=alpha, random_state=0).fit(X_fit, y_fit)
+        candidate = model_cost(model, X_val)
+        candidate.update({'alpha': alpha, 'accuracy': accuracy_score(y_val, model.predict(X_val))})
+        candidate['fits'] = within_budget(candidate, budget)
+        candidates.append(candidate)
+
+    fitting = [candidate for candidate in candidates if candidate['fits']]
+    chosen = max(fitting, key=lambda candidate: (candidate['accuracy'], -candidate['nodes'])) if fitting else None
+
+    print('Pruning frontier, budget:', ', '.join(key + ' <= ' + str(limit) for key, limit in budget.items() if limit is not None))
+    print('=================================')
+    print('     ccp_alpha   nodes  depth   pickle KB  embedded KB  us/row  val accuracy')
+    for candidate, on_front in zip(candidates, pareto_front(candidates)):
+        marks = ('chosen ' if candidate is chosen else '') + ('pareto ' if on_front else '') + ('' if candidate['fits'] else 'over budget')
+        print('%14.3g %7d %6d %11.1f %12.1f %7.2f %13.4f  ' % (candidate['alpha'], candidate['nodes'], candidate['depth'],
+              candidate['bytes'] / 1024, candidate['embedded_bytes'] / 1024, candidate['us_per_row'], candidate['accuracy']) + marks)
+    print()
+
+    if not fitting:
+        smallest = min(candidates, key=lambda candidate: (candidate['bytes'], candidate['nodes']))
+        print('Error: no pruning level fits the budget. The smallest reachable tree has', smallest['nodes'], 'nodes, depth',
+              smallest['depth'], 'and', smallest['bytes'], 'pickled bytes')
+        sys.exit(1)
+
+    # The chosen level is refit on every training row. More rows can grow a tree at the same ccp_alpha, so if it no
+    # longer fits the next more pruned level is tried
+    for alpha in alphas[alphas >= chosen['alpha']]:
+        model = DecisionTreeClassifier(**params, ccp_alpha=alpha, random_state=0).fit(X_train, y_train)
+        cost = model_cost(model, X_val)
+        if within_budget(cost, budget):
+            break
+    if not within_budget(cost, budget):
+        print('Warning: refit on all training rows even the most pruned level is over the budget')
+    print('Refit on all training rows at ccp_alpha %.3g: %d nodes, depth %d, %.1f pickle KB' % (alpha, cost['nodes'], cost['depth'],
+          cost['bytes'] / 1024))
+    print()
+
+    return model
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             make_coreset                                                                 *
+*                                                                                                *
+* Parameters:       np.array X         - Training rows                                           *
+*                   np.array y         - Their instruments                                       *
+*                   int per_instrument - Rows kept for each instrument                           *
+*                   str method         - 'kmeans' clusters each instrument's rows into           *
+*                                        per_instrument clusters and keeps the row closest to    *
+*                                        each centre. 'stratified' keeps a random sample         *
+*                   int seed           - Seeds the sampling and clustering                       *
+*                                                                                                *
+* Purpose:          Picks a small training set with the same number of rows for every            *
+*                   instrument. Clips cut from one recording are mostly near copies of each      *
+*                   other, so they land in the same few clusters and kmeans keeps one of them    *
+*                   instead of hundreds. Instruments with fewer rows than per_instrument are     *
+*                   kept whole. Clustering is done on standardized features so the bin numbers   *
+*                   do not outweigh the amplitudes                                               *
+*                                                                                                *
+* Returns:          np.array, np.array - The coreset rows and their instruments                  *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def make_coreset(X, y, per_instrument, method='kmeans', seed=0):
+    rng = np.random.default_rng(seed)
+    scaled = StandardScaler().fit_transform(X) if method == 'kmeans' else None
+
+    keep = []
+    for inst in np.unique(y):
+        rows = np.flatnonzero(y == inst)
+        if len(rows) <= per_instrument:
+            keep.append(rows)
+        elif method == 'stratified':
+            keep.append(rng.choice(rows, per_instrument, replace=False))
+        else:
+            # A few passes are enough to spread the centres over the data, this is not meant to converge
+            kmeans = MiniBatchKMeans(n_clusters=per_instrument, random_state=seed, n_init=1, max_iter=KMEANS_PASSES,
+                                     batch_size=max(1024, 4 * per_instrument), init_size=3 * per_instrument).fit(scaled[rows])
+            keep.append(rows[np.unique(pairwise_distances_argmin(kmeans.cluster_centers_, scaled[rows]))])
 
-def train_model(arff_filename, enabled_instruments = ['all']):
-    data, meta = arff.loadarff(arff_filename)
-    df = pd.DataFrame(data)
+    keep = np.sort(np.concatenate(keep))
+    return X[keep], y[keep]
+
+# Runs the random search over decision tree parameters and fits the best one, pruned to the budget if there is one
+def search_tree(X_train, y_train, budget=None, random_state=None):
+    # Now we will randomize parameters for the model to find the best
+    # Combination of attribute to get the best accuracy
+    random_params = {
+        'criterion': ['gini', 'entropy'],
+        'min_samples_split': list(range(2, 500)),
+        'min_samples_leaf': list(range(1, 500)),
+        'max_features': ['sqrt', 'log2']
+    }
     
-    df.columns = meta.names()
+    decision_tree = DecisionTreeClassifier(random_state=random_state)
+    random_search = RandomizedSearchCV(estimator=decision_tree, param_distributions=random_params, n_iter=5, scoring='accuracy', n_jobs=-1,
+                                       random_state=random_state)
+
+    random_search.fit(X_train, y_train)
+    best_params = random_search.best_params_
+
+    print('Best parameters found for the model:', best_params)
     
-    # Decodes the instrument names from byte strings
-    for column in df.columns:
-        if df[column].dtype == object:
-            df[column] = df[column].str.decode('utf-8')
+    if budget and any(limit is not None for limit in budget.values()):
+        return prune_to_budget(best_params, X_train, y_train, budget)
+
+    best_model = DecisionTreeClassifier(**best_params, random_state=random_state)
+    best_model.fit(X_train, y_train)
+
+    return best_model
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             train_coreset                                                                *
+*                                                                                                *
+* Parameters:       np.array X_train, y_train - The full training split                          *
+*                   dict coreset              - 'rows' per instrument, 'method', whether to      *
+*                                               'check' against full data and its 'tolerance'    *
+*                   dict budget               - Passed on to search_tree                         *
+*                                                                                                *
+* Purpose:          Searches and fits on a coreset of the training split instead of all of it.   *
+*                   With the check on, CORESET_VALIDATION of the training split is held out, the *
+*                   coreset is picked from the rest and the rest is also trained on in full,     *
+*                   both searches with the same seed. Both models are scored on the held out     *
+*                   rows, so the test split is never used to choose. If the coreset model is     *
+*                   more than the tolerance less accurate the check fails and the full data      *
+*                   model is kept instead. Prints the time each took                             *
+*                                                                                                *
+* Returns:          DecisionTreeClassifier - The model to save                                   *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def train_coreset(X_train, y_train, coreset, budget=None):
+    random_state = None
+    if coreset['check']:
+        X_train, X_val, y_train, y_val = train_test_split(X_train, y_train, test_size=CORESET_VALIDATION, random_state=0)
+        random_state = SEARCH_SEED
+
+    start = time.perf_counter()
+    X_core, y_core = make_coreset(X_train, y_train, coreset['rows'], coreset['method'])
+    select_time = time.perf_counter() - start
+    core_model = search_tree(X_core, y_core, budget, random_state)
+    core_time = time.perf_counter() - start
+
+    print('Coreset:', len(y_core), 'of', len(y_train), 'training rows by', coreset['method'] + ',',
+          round(select_time, 2), 's to pick,', round(core_time, 2), 's in all')
+    if not coreset['check']:
+        print()
+        return core_model
+
+    start = time.perf_counter()
+    full_model = search_tree(X_train, y_train, budget, random_state)
+    full_time = time.perf_counter() - start
+
+    core_accuracy = accuracy_score(y_val, core_model.predict(X_val))
+    full_accuracy = accuracy_score(y_val, full_model.predict(X_val))
+    print('Coreset check on', len(y_val), 'held out training rows')
+    print('=================================')
+    print('Full data:', len(y_train), 'rows, %.2f s, validation accuracy %.4f' % (full_time, full_accuracy))
+    print('Coreset:  ', len(y_core), 'rows, %.2f s, validation accuracy %.4f' % (core_time, core_accuracy))
+    print('Saved %.2f s (%.1fx faster), accuracy change %+.4f, tolerance %.4f' % (full_time - core_time,
+          full_time / core_time if core_time > 0 else 0, core_accuracy - full_accuracy, coreset['tolerance']))
+
+    if core_accuracy < full_accuracy - coreset['tolerance']:
+        print('Coreset check FAILED, keeping the full data model. Try more --coreset rows')
+        print()
+        return full_model
+
+    print('Coreset check passed')
+    print()
+    return core_model
+
+# budget holds limits on 'nodes', 'depth' and pickled 'bytes'. None, or all limits None, keeps the searched tree as is
+# coreset is the train_coreset settings, None trains on the whole training split
+def train_model(arff_filename, enabled_instruments = ['all'], number_harmonics=None, budget=None, coreset=None):
+    # Partitioned datasets only read the files for the enabled instruments
+    if is_partitioned(arff_filename):
+        df = load_partitions(arff_filename, enabled_instruments, number_harmonics)
+    else:
+        df = read_arff_frame(arff_filename, number_harmonics=number_harmonics)
 
     # print('Data head')
     # print('=================================')
@@ -45,25 +324,10 @@ def train_model(arff_filename, enabled_instruments = ['all']):
 
     # classifier = DecisionTreeClassifier(criterion='entropy', random_state=1029, min_samples_leaf=25)
     
-    # Now we will randomize parameters for the model to find the best
-    # Combination of attribute to get the best accuracy
-    random_params = {
-        'criterion': ['gini', 'entropy'],
-        'min_samples_split': list(range(2, 500)),
-        'min_samples_leaf': list(range(1, 500)),
-        'max_features': ['sqrt', 'log2']
-    }
-    
-    decision_tree = DecisionTreeClassifier()
-    random_search = RandomizedSearchCV(estimator=decision_tree, param_distributions=random_params, n_iter=5, scoring='accuracy', n_jobs=-1)
-
-    random_search.fit(X_train, y_train)
-    best_params = random_search.best_params_
-
-    print('Best parameters found for the model:', best_params)
-    
-    best_model = DecisionTreeClassifier(**best_params)
-    best_model.fit(X_train, y_train)
+    if coreset is not None:
+        best_model = train_coreset(X_train, y_train, coreset, budget)
+    else:
+        best_model = search_tree(X_train, y_train, budget)
     
     y_predict = best_model.predict(X_test)
 
@@ -72,6 +336,8 @@ def train_model(arff_filename, enabled_instruments = ['all']):
     matrix_df = pd.DataFrame(matrix, index=matrix_labels, columns=matrix_labels) # type: ignore
     print('Filename:', arff_filename)
     print('Enabled instruments:', enabled_instruments)
+    print('Harmonics:', attrib.shape[1] // 2)
+    print('Nodes:', best_model.tree_.node_count, 'Depth:', best_model.get_depth(), 'Pickled KB:', round(len(pickle.dumps(best_model)) / 1024, 1))
     print('=================================')
     print()
     print('Confusion matrix:')
@@ -108,48 +374,316 @@ def train_model(arff_filename, enabled_instruments = ['all']):
     # print(accuracy)
     # print()
     
-    ossplit = os.path.split(arff_filename)
+    save_model(best_model, arff_filename, number_harmonics)
+
+def model_name(arff_filename, number_harmonics=None):
+    ossplit = os.path.split(os.path.normpath(arff_filename))
     name, extension = os.path.splitext(ossplit[1])
+    # Partitioned datasets are directories like 0.1datasetRaw/, the dot in the split length is not an extension
+    if os.path.isdir(arff_filename):
+        name = ossplit[1]
+
+    # Models trained on a slice of the dataset are named after the slice so a sweep does not overwrite them
+    if number_harmonics is not None:
+        name += str(number_harmonics) + 'Harmonics'
+
+    return name
+
+def save_model(model, arff_filename, number_harmonics=None):
+    name = model_name(arff_filename, number_harmonics)
 
     # Save the model as an object file that can be loaded back into sklearn
     if not os.path.exists(MODELS_DIR):
         os.mkdir(MODELS_DIR)
 
     with open(MODELS_DIR + '/' + name + "Model.pkl", 'wb') as f:
-        pickle.dump(best_model, f)
+        pickle.dump(model, f)
     
     # Create a bytestring of the model so that it can be directly embedded into a script
     # Using w instaed of wb to write it as something I can just dump into another script straight from the txt file 
     with open(MODELS_DIR + '/' + name + 'ByteStr' + '.txt', 'w') as f:
-        byte_str = pickle.dumps(best_model)
+        byte_str = pickle.dumps(model)
         # Compress the byte string so that it does not cause hangs when we put it into the cli tool script
         compressed = zlib.compress(byte_str)
         f.write('MODEL=')
         f.write(str(compressed))
-    
+
+    if REGISTRY_DIR is not None:
+        add_model(REGISTRY_DIR, model, name + 'Model', splitlen_from_name(name), os.path.abspath(MODELS_DIR + '/' + name + 'Model.pkl'))
+        print('Added', name + 'Model', 'to the model registry', REGISTRY_DIR)
+
+# Reads a dataset a chunk at a time so the whole file never has to be in memory
+def iter_dataset_chunks(arff_filename, chunk_size, enabled_instruments = ['all'], number_harmonics=None):
+    if is_partitioned(arff_filename):
+        yield from iter_partition_chunks(arff_filename, chunk_size, enabled_instruments, number_harmonics)
+    else:
+        yield from iter_arff_chunks(arff_filename, chunk_size, enabled_instruments, number_harmonics)
+
+# Each partition holds a single instrument, so a chunk is built from every selected partition in proportion to
+# its size. Otherwise the shuffle buffer would only ever see one instrument at a time
+def iter_partition_chunks(dataset_dir, chunk_size, enabled_instruments = ['all'], number_harmonics=None):
+    _, selected_rows, _ = partition_files(dataset_dir, enabled_instruments)
+    if selected_rows == 0:
+        return
+
+    readers = []
+    for inst, partition in read_index(dataset_dir)['partitions'].items():
+        if enabled_instruments != ['all'] and inst not in enabled_instruments:
+            continue
+        part_chunk = max(1, (chunk_size * partition['rows']) // selected_rows)
+        readers.append(iter_arff_chunks(os.path.join(dataset_dir, partition['file']), part_chunk,
+                                        number_harmonics=number_harmonics))
+
+    while readers:
+        parts = []
+        for reader in list(readers):
+            try:
+                parts.append(next(reader))
+            except StopIteration:
+                readers.remove(reader)
+
+        if parts:
+            yield np.concatenate([X for X, _ in parts]), np.concatenate([y for _, y in parts])
+
+def find_dataset_classes(arff_filename, chunk_size):
+    if is_partitioned(arff_filename):
+        return sorted(read_index(arff_filename)['partitions'].keys())
+
+    return find_classes(arff_filename, chunk_size)
+
+# Keeps the validation_rows samples with the smallest random keys, which is a uniform sample of every
+# validation row seen so far that never grows past validation_rows
+def merge_validation_sample(val_X, val_y, val_keys, X, y, keys, validation_rows):
+    if val_X is not None:
+        X = np.concatenate([val_X, X])
+        y = np.concatenate([val_y, y])
+        keys = np.concatenate([val_keys, keys])
+
+    if len(keys) > validation_rows:
+        keep = np.argpartition(keys, validation_rows)[:validation_rows]
+        X, y, keys = X[keep], y[keep], keys[keep]
+
+    return X, y, keys
+
+# Shuffles the buffered rows and cuts them into chunks. Unless flush is set, one chunk worth of rows is held
+# back so that it gets mixed with the next rows read from disk
+def shuffle_buffer_chunks(buffer_X, buffer_y, chunk_size, rng, flush=False):
+    X = np.concatenate(buffer_X)
+    y = np.concatenate(buffer_y)
+
+    order = rng.permutation(len(y))
+    X = X[order]
+    y = y[order]
+
+    if flush:
+        num_emit = len(y)
+    else:
+        num_emit = ((len(y) - chunk_size) // chunk_size) * chunk_size
+
+    chunks = [(X[idx:idx + chunk_size], y[idx:idx + chunk_size]) for idx in range(0, num_emit, chunk_size)]
+
+    return chunks, [X[num_emit:]], [y[num_emit:]]
+
+def partial_fit_chunk(model, X, y, classes):
+    scaler = model.named_steps['scaler']
+    scaler.partial_fit(X)
+    model.named_steps['classifier'].partial_fit(scaler.transform(X), y, classes=classes)
+
+# epoch_chunks is how many chunks of the current epoch the model has already been trained on
+def save_checkpoint(model, checkpoint_filename, epoch, num_chunks, epoch_chunks=0):
+    # Write to a temp file first so a crash mid-write never leaves a corrupt checkpoint behind
+    with open(checkpoint_filename + '.tmp', 'wb') as f:
+        pickle.dump({'model': model, 'epoch': epoch, 'chunks': num_chunks, 'epoch_chunks': epoch_chunks}, f)
+    os.replace(checkpoint_filename + '.tmp', checkpoint_filename)
+
+def train_model_streaming(arff_filename, enabled_instruments = ['all'], chunk_size=50000, estimator='sgd', epochs=1,
+                          shuffle_buffer=8, validation_fraction=0.1, validation_rows=100000, checkpoint_every=20,
+                          resume=False, seed=0, number_harmonics=None):
+    # Memory use is bounded by chunk_size * (shuffle_buffer + 1) training rows plus validation_rows held out rows,
+    # no matter how big the arff file is
+    classes = find_dataset_classes(arff_filename, chunk_size)
+    if enabled_instruments != ['all']:
+        classes = [inst for inst in classes if inst in enabled_instruments]
+    classes = np.array(classes)
+
+    model = Pipeline([('scaler', StandardScaler()), ('classifier', STREAMING_ESTIMATORS[estimator]())])
+
+    name = model_name(arff_filename, number_harmonics)
+
+    if not os.path.exists(MODELS_DIR):
+        os.mkdir(MODELS_DIR)
+    checkpoint_filename = MODELS_DIR + '/' + name + 'Checkpoint.pkl'
+
+    # Resuming replays the epoch the checkpoint was taken in. Its chunks come out in the same order every time, so
+    # the ones the model was already trained on are skipped
+    start_epoch = 0
+    num_chunks = 0
+    skip_chunks = 0
+    if resume and os.path.exists(checkpoint_filename):
+        with open(checkpoint_filename, 'rb') as f:
+            checkpoint = pickle.load(f)
+        model = checkpoint['model']
+        start_epoch = checkpoint['epoch']
+        num_chunks = checkpoint['chunks']
+        skip_chunks = checkpoint.get('epoch_chunks', 0)
+        print('Resuming from checkpoint', checkpoint_filename, 'at epoch', start_epoch, 'chunk', skip_chunks)
+
+    val_X = val_y = val_keys = None
+
+    for epoch in range(start_epoch, epochs):
+        rng = np.random.default_rng([seed, epoch])
+        buffer_X = []
+        buffer_y = []
+        buffered_rows = 0
+        epoch_chunks = 0
+
+        for chunk_no, (X, y) in enumerate(iter_dataset_chunks(arff_filename, chunk_size, enabled_instruments,
+                                                                       number_harmonics)):
+            # Seeded on the chunk number so the same rows are held out every epoch
+            split_rng = np.random.default_rng([seed, chunk_no])
+            is_val = split_rng.random(len(y)) < validation_fraction
+
+            if epoch == start_epoch:
+                val_X, val_y, val_keys = merge_validation_sample(val_X, val_y, val_keys, X[is_val], y[is_val],
+                                                                 split_rng.random(is_val.sum()), validation_rows)
+
+            buffer_X.append(X[~is_val])
+            buffer_y.append(y[~is_val])
+            buffered_rows += (~is_val).sum()
+
+            if buffered_rows < chunk_size * shuffle_buffer:
+                continue
+
+            chunks, buffer_X, buffer_y = shuffle_buffer_chunks(buffer_X, buffer_y, chunk_size, rng)
+            buffered_rows = len(buffer_y[0])
+
+            for chunk_X, chunk_y in chunks:
+                epoch_chunks += 1
+                if epoch == start_epoch and epoch_chunks <= skip_chunks:
+                    continue
+                partial_fit_chunk(model, chunk_X, chunk_y, classes)
+                num_chunks += 1
+
+                if num_chunks % checkpoint_every == 0:
+                    save_checkpoint(model, checkpoint_filename, epoch, num_chunks, epoch_chunks)
+                    if val_y is not None and len(val_y) > 0:
+                        print('Chunk', num_chunks, 'validation accuracy:', accuracy_score(val_y, model.predict(val_X)))
+
+        # Train on whatever is left over at the end of the file
+        if buffered_rows > 0:
+            chunks, buffer_X, buffer_y = shuffle_buffer_chunks(buffer_X, buffer_y, chunk_size, rng, flush=True)
+            for chunk_X, chunk_y in chunks:
+                epoch_chunks += 1
+                if epoch == start_epoch and epoch_chunks <= skip_chunks:
+                    continue
+                partial_fit_chunk(model, chunk_X, chunk_y, classes)
+                num_chunks += 1
+
+        save_checkpoint(model, checkpoint_filename, epoch + 1, num_chunks)
+
+    # Scoring or saving a model no chunk was trained on fails in sklearn with a NotFittedError
+    if num_chunks == 0:
+        print('Error: no chunks of', arff_filename, 'were trained on. The dataset may be empty, --chunksize may be '
+              'larger than the rows left after the validation holdout, or --resume skipped every chunk')
+        sys.exit(1)
+
+    print('Filename:', arff_filename)
+    print('Enabled instruments:', enabled_instruments)
+    print('Harmonics:', number_harmonics if number_harmonics is not None else dataset_harmonics(arff_filename))
+    print('Chunks trained:', num_chunks)
+    print('=================================')
+    print()
+
+    if val_y is not None and len(val_y) > 0:
+        y_predict = model.predict(val_X)
+
+        matrix = confusion_matrix(val_y, y_predict)
+        matrix_labels = sorted(set(val_y) | set(y_predict))
+        matrix_df = pd.DataFrame(matrix, index=matrix_labels, columns=matrix_labels) # type: ignore
+        print('Confusion matrix:')
+        print('=================================')
+        print(matrix_df)
+        print()
+
+        print('Validation accuracy score:')
+        print('=================================')
+        print(accuracy_score(val_y, y_predict))
+        print()
+
+    save_model(model, arff_filename, number_harmonics)
+
 __USAGE__ = 'python3 gen_model.py <datasets> <outdir> ... - where <datasets> is a directory containing arff files and <outdir> is where to save models. ... is a space seperated list of the instruments to enable in the model'
 
 if __name__ == "__main__":
-    argv = sys.argv
-    argc = len(argv)
-    
-    if argc < 3:
-        print(__USAGE__)
-        sys.exit(1)
-     
-    in_dir = argv[1]
-    MODELS_DIR = argv[2] 
+    parser = argparse.ArgumentParser(prog='gen_model.py', usage=__USAGE__,
+                                     description='Trains a decision tree on every arff dataset in a directory')
+
+    parser.add_argument('datasets', help='Directory containing the arff datasets')
+    parser.add_argument('outdir', help='Where to save the models')
+    parser.add_argument('instruments', nargs='*', help='The instruments to enable in the model. Defaults to all of them')
+
+    parser.add_argument('--stream', action='store_true', default=False, help='Stream shuffled chunks from disk into an incremental estimator instead of loading the whole dataset')
+    parser.add_argument('--estimator', default='sgd', choices=list(STREAMING_ESTIMATORS.keys()), help='Incremental estimator used in stream mode')
+    parser.add_argument('--chunksize', type=int, default=50000, help='Rows per training chunk in stream mode')
+    parser.add_argument('--epochs', type=int, default=1, help='Passes over the dataset in stream mode')
+    parser.add_argument('--shufflebuffer', type=int, default=8, help='Number of chunks shuffled together in stream mode')
+    parser.add_argument('--valrows', type=int, default=100000, help='Max number of held out validation rows kept in stream mode')
+    parser.add_argument('--checkpoint', type=int, default=20, help='Save a checkpoint every this many chunks in stream mode')
+    parser.add_argument('--resume', action='store_true', default=False, help='Resume stream mode from the last checkpoint')
+    parser.add_argument('--harmonics', type=int, nargs='+', default=None, help='Train on only the strongest n harmonics of each dataset. Give several counts to train one model per count. Defaults to every harmonic in the dataset')
+    parser.add_argument('--maxnodes', type=int, default=None, help='Prune the tree to at most this many nodes')
+    parser.add_argument('--maxdepth', type=int, default=None, help='Prune the tree to at most this depth')
+    parser.add_argument('--maxbytes', type=int, default=None, help='Prune the tree until its pickle is at most this many bytes')
+    parser.add_argument('--coreset', type=int, default=None, help='Train on only this many rows per instrument, picked by --coresetmethod')
+    parser.add_argument('--coresetmethod', default='kmeans', choices=CORESET_METHODS, help='kmeans keeps the row nearest each cluster centre of every instrument, stratified keeps a random sample')
+    parser.add_argument('--coresetcheck', action='store_true', default=False, help='Also train on all the rows and check the coreset model is within --coresettol of its held out accuracy')
+    parser.add_argument('--coresettol', type=float, default=CORESET_TOLERANCE, help='Held out accuracy the coreset model may lose against the full data model')
+    parser.add_argument('--registry', default=None, help='Also add every model to this modelregistry.py folder, where classinst.py can pick models by instrument set')
+
+    # Intermixed so flags can come after the instrument list
+    args = parser.parse_intermixed_args()
+
+    in_dir = args.datasets
+    MODELS_DIR = args.outdir
+    REGISTRY_DIR = args.registry
     
+    # Inference budget for the decision tree, the streamed estimators are a fixed size
+    budget = {'nodes': args.maxnodes, 'depth': args.maxdepth, 'bytes': args.maxbytes}
+    if args.stream and any(limit is not None for limit in budget.values()):
+        print('Warning: --maxnodes, --maxdepth and --maxbytes only apply to decision trees, not --stream')
+
+    coreset = None
+    if args.coreset is not None:
+        coreset = {'rows': args.coreset, 'method': args.coresetmethod, 'check': args.coresetcheck, 'tolerance': args.coresettol}
+        if args.stream:
+            print('Warning: --coreset only applies to decision trees, not --stream')
+
     # Only train the model on the instruments passed in on the command line
-    enabled_instruments = []
-    idx = 3 
-    while idx < argc:
-        enabled_instruments.append(argv[idx])
-        print(argv[idx])
-        idx += 1
-
-    datasets = glob.glob(in_dir + '/*.arff')
+    enabled_instruments = args.instruments if args.instruments else ['all']
+    for inst in enabled_instruments:
+        print(inst)
+
+    # Partitioned datasets are directories holding an index file
+    datasets = [path for path in glob.glob(in_dir + '/*/') if is_partitioned(path)]
+    # The partition target writes the directory next to the arff it came from. Both would save to the same model
+    # name, so only the partitioned form is trained
+    partitioned_names = set(model_name(path) for path in datasets)
+    for filename in glob.glob(in_dir + '/*.arff'):
+        if model_name(filename) in partitioned_names:
+            print('Skipping', filename, '- using its partitioned form')
+        else:
+            datasets.append(filename)
     print('Datasets:', datasets)
     for filename in datasets:
-        train_model(filename, enabled_instruments)
-    
+        harmonic_counts = args.harmonics if args.harmonics else [None]
+        for number_harmonics in harmonic_counts:
+            if number_harmonics is not None and number_harmonics > dataset_harmonics(filename):
+                print('Skipping', number_harmonics, 'harmonics for', filename, '- it only has', dataset_harmonics(filename))
+                continue
+
+            if args.stream:
+                train_model_streaming(filename, enabled_instruments, chunk_size=args.chunksize, estimator=args.estimator,
+                                      epochs=args.epochs, shuffle_buffer=args.shufflebuffer, validation_rows=args.valrows,
+                                      checkpoint_every=args.checkpoint, resume=args.resume, number_harmonics=number_harmonics)
+            else:
+                train_model(filename, enabled_instruments, number_harmonics, budget, coreset)
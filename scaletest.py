@@ -0,0 +1,427 @@
+'''
+**************************************************************************************************
+* Filename:    scaletest.py                                                                      *
+*                                                                                                *
+* Description: End to end scale test. Builds a corpus of synthetic, instrument tagged, full      *
+*              length recordings on the local disk and runs them through the whole chain the     *
+*              same way the makefiles do:                                                        *
+*                                                                                                *
+*                  converttowav -> splitaudio -> normalizedb -> extractFreqARFF -> cleandata     *
+*                  -> gen_model -> classinst                                                     *
+*                                                                                                *
+*              Every stage is a separate process started from its own folder. For each stage the *
+*              wall time, cpu time, peak memory (largest single process, from os.wait4), disk    *
+*              used by its output and throughput are appended to a results csv along with the    *
+*              commit and the scale, so runs of different commits can be compared.               *
+*                                                                                                *
+*              Each instrument has its own harmonic profile and pitch range, with notes, rests,  *
+*              vibrato and noise, so the model has something real to learn and a drop in         *
+*              accuracy shows up as well as a drop in speed. Scale 1 is BASE_RECORDINGS          *
+*              recordings of BASE_SECONDS seconds per instrument, scale 10 has ten times as many *
+*                                                                                                *
+*              converttowav and classinst need ffmpeg. Without it the recordings are written     *
+*              straight to wav, the convert stage is skipped and classinst is not run.           *
+*                                                                                                *
+* Usage:       python3 scaletest.py run [--scales 1 10 100] [options]                            *
+*                   Run with --help for the clip length, worker count and folders                *
+*                                                                                                *
+*              python3 scaletest.py report [--results <file>]                                    *
+*                   Prints the throughput of every stage at every scale for each commit tested   *
+*                                                                                                *
+**************************************************************************************************
+'''
+import sys
+import os
+import csv
+import time
+import shutil
+import base64
+import argparse
+import datetime
+import subprocess
+
+import numpy as np
+import soundfile as sf
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATASET_DIR = os.path.join(ROOT_DIR, 'dataset_gen')
+MODEL_DIR = os.path.join(ROOT_DIR, 'model_gen')
+CLI_DIR = os.path.join(ROOT_DIR, 'cli_tool')
+
+DEFAULT_WORKDIR = 'scaletest_work/'
+DEFAULT_RESULTS = 'scaletest_results.csv'
+RESULT_FIELDS = ['commit', 'date', 'scale', 'stage', 'status', 'wall_s', 'cpu_s', 'peak_mb', 'disk_mb', 'items',
+                 'items_per_s', 'audio_s_per_s']
+
+# Recordings per instrument and their length in seconds at scale 1
+BASE_RECORDINGS = 2
+BASE_SECONDS = 30.0
+# Length of the held out recordings classinst is run on, one per instrument
+TEST_SECONDS = 5.0
+SAMPLERATE = 22050
+SEED = 0
+
+# The relative strength of harmonics 1, 2, 3... and the range of fundamentals in Hz of each instrument
+INSTRUMENTS = {
+    'violin': {'harmonics': [1 / n for n in range(1, 16)], 'pitch': (196, 1320), 'vibrato': 0.006, 'noise': 0.01},
+    'flute': {'harmonics': [1, 0.25, 0.12, 0.04, 0.02], 'pitch': (262, 2093), 'vibrato': 0.004, 'noise': 0.04},
+    'trumpet': {'harmonics': [0.5, 0.9, 1, 0.8, 0.6, 0.45, 0.3, 0.2, 0.12, 0.08], 'pitch': (165, 990),
+                'vibrato': 0.002, 'noise': 0.01},
+    'tuba': {'harmonics': [1, 0.7, 0.35, 0.15, 0.06], 'pitch': (44, 350), 'vibrato': 0.0, 'noise': 0.005},
+    'chello': {'harmonics': [1 / n ** 1.3 for n in range(1, 12)], 'pitch': (65, 700), 'vibrato': 0.005, 'noise': 0.01},
+}
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             synth_recording                                                              *
+*                                                                                                *
+* Parameters:       dict profile      - The instrument's entry in INSTRUMENTS                    *
+*                   float seconds     - Length of the recording                                  *
+*                   int samplerate    - Samples per second                                       *
+*                   np.random.Generator rng - Picks the notes, rests and noise                   *
+*                                                                                                *
+* Purpose:          Plays random notes of the instrument one after another, each with an attack  *
+*                   and release, with a rest now and then so the silence gate has work to do     *
+*                                                                                                *
+* Returns:          np.array - float32 samples in [-1, 1]                                        *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def synth_recording(profile, seconds, samplerate, rng):
+    samples = np.zeros(int(seconds * samplerate), dtype=np.float64)
+    low, high = profile['pitch']
+
+    start = 0
+    while start < len(samples):
+        length = min(int(rng.uniform(0.25, 1.0) * samplerate), len(samples) - start)
+        # About one note in eight is a rest
+        if rng.random() < 0.125:
+            start += length
+            continue
+
+        t = np.arange(length) / samplerate
+        f0 = np.exp(rng.uniform(np.log(low), np.log(high)))
+        # A 5.5 Hz vibrato
+        phase = 2 * np.pi * np.cumsum(f0 * (1 + profile['vibrato'] * np.sin(2 * np.pi * 5.5 * t))) / samplerate
+
+        note = np.zeros(length)
+        for number, amplitude in enumerate(profile['harmonics'], start=1):
+            if f0 * number >= samplerate / 2:
+                break
+            note += amplitude * rng.uniform(0.8, 1.2) * np.sin(number * phase)
+
+        envelope = np.minimum(1, np.minimum(t / 0.02, (t[-1] - t + 1e-3) / 0.05))
+        samples[start : start + length] = note * envelope * rng.uniform(0.2, 0.6) / sum(profile['harmonics'])
+        start += length
+
+    samples += rng.normal(0, profile['noise'] * 0.1, len(samples))
+    return np.clip(samples, -1, 1).astype(np.float32)
+
+# <instrument>_<base64 title>, the names audiodl.py gives downloads
+def recording_name(instrument, title):
+    return instrument + '_' + base64.urlsafe_b64encode(title.encode()).decode('UTF-8')
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             make_corpus                                                                  *
+*                                                                                                *
+* Parameters:       str outdir       - Where to write the recordings                             *
+*                   int recordings   - Recordings per instrument                                 *
+*                   float seconds    - Length of each recording                                  *
+*                   str title        - Put in the name of every recording                        *
+*                   int seed         - Seed for the notes                                        *
+*                                                                                                *
+* Returns:          str[], float - The wav files written and the seconds of audio in them        *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def make_corpus(outdir, recordings, seconds, title, seed=SEED):
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+
+    filenames = []
+    for instrument, profile in INSTRUMENTS.items():
+        for number in range(recordings):
+            filename = os.path.join(outdir, recording_name(instrument, '%s %s %d' % (title, instrument, number)) + '.wav')
+            sf.write(filename, synth_recording(profile, seconds, SAMPLERATE, rng), SAMPLERATE, subtype='PCM_16')
+            filenames.append(filename)
+
+    return filenames, len(filenames) * seconds
+
+# Encodes the wavs to mp3 for converttowav to decode, the way downloads arrive
+def encode_mp3s(filenames, outdir):
+    os.makedirs(outdir, exist_ok=True)
+    for filename in filenames:
+        mp3_filename = os.path.join(outdir, os.path.splitext(os.path.basename(filename))[0] + '.mp3')
+        subprocess.run(['ffmpeg', '-y', '-loglevel', 'quiet', '-i', filename, mp3_filename], check=True)
+
+def dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(dirpath, filename)) for filename in filenames)
+
+    return total
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             run_stage                                                                    *
+*                                                                                                *
+* Parameters:       str name          - The stage                                                *
+*                   [str[]] cmds      - The commands to run one after another                    *
+*                   str cwd           - The folder to run them from                              *
+*                   str output        - The file or folder the stage writes, for its disk use    *
+*                   int items         - Files, clips or rows the stage handles, for throughput   *
+*                   float audio_secs  - Seconds of audio the stage handles                       *
+*                   str logfilename   - Where the commands' output goes                          *
+*                                                                                                *
+* Purpose:          Runs the stage and measures it. os.wait4 gives the cpu time of each command  *
+*                   and every process it started, and the peak resident memory of the largest    *
+*                   of them                                                                      *
+*                                                                                                *
+* Returns:          dict - The stage's row of the results csv, less the commit, date and scale   *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def run_stage(name, cmds, cwd, output, items, audio_secs, logfilename):
+    print('Running', name + '...', flush=True)
+
+    wall = 0.0
+    cpu = 0.0
+    peak_kb = 0
+    status = 'ok'
+
+    with open(logfilename, 'a') as logfile:
+        for cmd in cmds:
+            logfile.write('$ ' + ' '.join(cmd) + '\n')
+            logfile.flush()
+
+            start = time.perf_counter()
+            process = subprocess.Popen(cmd, cwd=cwd, stdout=logfile, stderr=subprocess.STDOUT)
+            _, exit_status, usage = os.wait4(process.pid, 0)
+            # wait4 reaped it, so tell Popen it is done instead of letting it wait again
+            process.returncode = os.waitstatus_to_exitcode(exit_status)
+
+            wall += time.perf_counter() - start
+            cpu += usage.ru_utime + usage.ru_stime
+            peak_kb = max(peak_kb, usage.ru_maxrss)
+
+            if process.returncode != 0:
+                status = 'failed'
+                break
+
+    result = {'stage': name, 'status': status, 'wall_s': round(wall, 3), 'cpu_s': round(cpu, 3),
+              'peak_mb': round(peak_kb / 1024, 1), 'disk_mb': round(dir_size(output) / 1e6, 2) if os.path.exists(output) else 0,
+              'items': items, 'items_per_s': round(items / wall, 2) if wall > 0 else 0,
+              'audio_s_per_s': round(audio_secs / wall, 2) if wall > 0 else 0}
+
+    print('  %s in %.1fs, %.1fs cpu, peak %.0f MB, %.1f MB on disk, %.1f items/s, %.1fx realtime' %
+          (status, wall, cpu, result['peak_mb'], result['disk_mb'], result['items_per_s'], result['audio_s_per_s']))
+    if status != 'ok':
+        print('  See', logfilename)
+
+    return result
+
+# A stage that could not be run, recorded so the gap shows up in the report
+def skipped_stage(name):
+    print('Skipping', name)
+    return {'stage': name, 'status': 'skipped', 'wall_s': 0, 'cpu_s': 0, 'peak_mb': 0, 'disk_mb': 0, 'items': 0,
+            'items_per_s': 0, 'audio_s_per_s': 0}
+
+# Lines of data in an arff, the rows a model is trained on
+def count_rows(arff_filename):
+    if not os.path.exists(arff_filename):
+        return 0
+
+    with open(arff_filename, 'r') as f:
+        return sum(1 for line in f if line.strip() and not line.startswith('@') and not line.startswith('%'))
+
+def count_files(folder, extension):
+    if not os.path.isdir(folder):
+        return 0
+
+    return sum(1 for name in os.listdir(folder) if name.endswith(extension))
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             run_chain                                                                    *
+*                                                                                                *
+* Parameters:       str workdir   - Folder for this scale's corpus and every stage's output      *
+*                   int scale     - Multiplies the number of recordings                          *
+*                   args          - The parsed command line arguments                            *
+*                                                                                                *
+* Purpose:          Builds the corpus and runs every stage on it. A stage that fails stops the   *
+*                   chain, the stages after it are recorded as skipped                           *
+*                                                                                                *
+* Returns:          [dict] - The results of each stage                                           *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def run_chain(workdir, scale, args):
+    has_ffmpeg = shutil.which('ffmpeg') is not None
+    logfilename = os.path.join(workdir, 'stages.log')
+
+    download_dir = os.path.join(workdir, 'download/')
+    wav_dir = os.path.join(workdir, 'full_wav/')
+    split_dir = os.path.join(workdir, 'split/')
+    norm_dir = os.path.join(workdir, 'normalized/')
+    arff_dir = os.path.join(workdir, 'arff/')
+    temp_dir = os.path.join(workdir, 'csvtemp/')
+    models_dir = os.path.join(workdir, 'models')
+    test_dir = os.path.join(workdir, 'test/')
+    arff_filename = arff_dir + 'scaletestRaw.arff'
+
+    print('Scale', scale, '- generating', BASE_RECORDINGS * scale * len(INSTRUMENTS), 'recordings in', workdir)
+    corpus_dir = download_dir if has_ffmpeg else wav_dir
+    filenames, audio_secs = make_corpus(corpus_dir, BASE_RECORDINGS * scale, BASE_SECONDS, 'Scale test')
+    test_filenames, _ = make_corpus(test_dir, 1, TEST_SECONDS, 'Held out', SEED + 1)
+    os.makedirs(arff_dir, exist_ok=True)
+
+    stages = []
+    if has_ffmpeg:
+        encode_mp3s(filenames, download_dir)
+        for filename in filenames:
+            os.remove(filename)
+        stages.append(('convert', lambda: run_stage('convert', [['python3', 'converttowav.py', download_dir, wav_dir, args.threads]],
+                                        DATASET_DIR, wav_dir, len(filenames), audio_secs, logfilename)))
+    else:
+        stages.append(('convert', lambda: skipped_stage('convert')))
+
+    stages.append(('split', lambda: run_stage('split', [['python3', 'splitaudio.py', '-m', wav_dir, str(args.seconds), split_dir,
+                                               args.threads, '--gatedb', str(args.gatedb), '--dedupe']],
+                                    DATASET_DIR, split_dir, len(filenames), audio_secs, logfilename)))
+    stages.append(('normalize', lambda: run_stage('normalize', [['python3', 'normalizedb.py', '-m', str(args.dbfs), split_dir, norm_dir,
+                                                   args.threads]],
+                                    DATASET_DIR, norm_dir, count_files(split_dir, '.wav'), audio_secs, logfilename)))
+    stages.append(('extract', lambda: run_stage('extract', [['python3', 'extractFreqARFF.py', '--multithreaded', '--threads', args.threads,
+                                                 '--tempfolder', temp_dir, '--infolder', norm_dir, '--outfile', arff_filename,
+                                                 '--harmonics', str(args.harmonics)]],
+                                    DATASET_DIR, arff_filename, count_files(norm_dir, '.wav'), audio_secs, logfilename)))
+    stages.append(('clean', lambda: run_stage('clean', [['python3', 'cleandata.py', arff_filename, arff_filename]],
+                                    DATASET_DIR, arff_filename, count_rows(arff_filename), audio_secs, logfilename)))
+    stages.append(('train', lambda: run_stage('train', [['python3', 'gen_model.py', arff_dir, models_dir]],
+                                    MODEL_DIR, models_dir, count_rows(arff_filename), audio_secs, logfilename)))
+
+    if has_ffmpeg:
+        model_filename = os.path.join(models_dir, 'scaletestRawModel.pkl')
+        tmp_dir = os.path.join(workdir, 'classinsttmp/')
+        stages.append(('classify', lambda: run_stage('classify', [['python3', 'classinst.py', '--nocache', '-t', tmp_dir, '-s', str(args.seconds),
+                                                      '-m', model_filename, filename] for filename in test_filenames],
+                                        CLI_DIR, tmp_dir, len(test_filenames), len(test_filenames) * TEST_SECONDS, logfilename)))
+    else:
+        stages.append(('classify', lambda: skipped_stage('classify')))
+
+    results = []
+    for name, stage in stages:
+        if any(result['status'] == 'failed' for result in results):
+            results.append(skipped_stage(name))
+        else:
+            results.append(stage())
+
+    return results
+
+# The commit under test, with a + when the tree has uncommitted changes
+def current_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT_DIR, capture_output=True,
+                               text=True).stdout.strip()
+        return commit + ('+' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def write_results(filename, commit, scale, results):
+    is_new = not os.path.exists(filename)
+    date = datetime.datetime.now().isoformat(timespec='seconds')
+
+    with open(filename, 'a', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_FIELDS)
+        if is_new:
+            writer.writeheader()
+        for result in results:
+            writer.writerow(dict(result, commit=commit, date=date, scale=scale))
+
+'''
+* ********************************************************************************************** *
+*                                                                                                *
+* Name:             print_report                                                                 *
+*                                                                                                *
+* Parameters:       str filename  - The results csv                                              *
+*                                                                                                *
+* Purpose:          Prints a table per stage of audio seconds processed per second at each       *
+*                   scale, one line per commit, with the latest run of each commit and scale.    *
+*                   A stage that scales well keeps the same rate as the scale goes up            *
+*                                                                                                *
+* ********************************************************************************************** *
+'''
+def print_report(filename):
+    if not os.path.exists(filename):
+        print('Error: no results in', filename + ', run python3 scaletest.py run first')
+        sys.exit(1)
+
+    latest = {}
+    with open(filename, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            latest[(row['stage'], row['commit'], int(row['scale']))] = row
+
+    stages = list(dict.fromkeys(key[0] for key in latest))
+    scales = sorted(set(key[2] for key in latest))
+    commits = list(dict.fromkeys(key[1] for key in latest))
+
+    for stage in stages:
+        print(stage, '- seconds of audio per second (peak MB)')
+        print('  ' + 'commit'.ljust(12) + ''.join(('%dx' % scale).rjust(18) for scale in scales))
+        for commit in commits:
+            cells = []
+            for scale in scales:
+                row = latest.get((stage, commit, scale))
+                if row is None:
+                    cells.append('')
+                elif row['status'] != 'ok':
+                    cells.append(row['status'])
+                else:
+                    cells.append('%.1f (%.0f)' % (float(row['audio_s_per_s']), float(row['peak_mb'])))
+            if any(cells):
+                print('  ' + commit.ljust(12) + ''.join(cell.rjust(18) for cell in cells))
+        print()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='scaletest.py', description='Runs the whole dataset and model chain on a synthetic corpus')
+    parser.add_argument('mode', choices=['run', 'report'])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1], help='Corpus sizes to run, as multiples of the base corpus')
+    parser.add_argument('--workdir', default=DEFAULT_WORKDIR, help='Where the corpus and stage outputs go, one folder per scale')
+    parser.add_argument('--results', default=DEFAULT_RESULTS, help='The csv every run is appended to')
+    parser.add_argument('--threads', default='auto', help='Max processes per stage, or auto')
+    parser.add_argument('--seconds', type=float, default=0.1, help='Length of each clip')
+    parser.add_argument('--harmonics', type=int, default=32, help='Number of harmonics to include in the fft')
+    parser.add_argument('--dbfs', type=int, default=-20, help='The db level each clip is normalized to')
+    parser.add_argument('--gatedb', type=float, default=-60, help='Clips quieter than this are dropped while splitting')
+    parser.add_argument('--keep', action='store_true', default=False, help='Keep each scale\'s folder instead of removing it after the run')
+    args = parser.parse_args()
+
+    if args.mode == 'report':
+        print_report(args.results)
+        sys.exit()
+
+    commit = current_commit()
+    for scale in args.scales:
+        workdir = os.path.abspath(os.path.join(args.workdir, 'scale%d' % scale)) + '/'
+        if os.path.exists(workdir):
+            shutil.rmtree(workdir)
+        os.makedirs(workdir)
+
+        results = run_chain(workdir, scale, args)
+        write_results(args.results, commit, scale, results)
+
+        if not args.keep:
+            shutil.rmtree(workdir)
+        print()
+
+    print_report(args.results)